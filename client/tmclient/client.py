@@ -1,13 +1,28 @@
 import os, time
 import asyncio
+import itertools
 import json
+import re
 import websockets
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
 import urwid
 
 from .config import Config
 from . import ui
 from .ui import Screen, Form, FormField, menu, menu_button, sub_menu
-from .screens import Splash, MainMenu, GameMain
+from .screens import Splash, MainMenu, GameMain, busy_message
+
+REPLY_RE = re.compile(r'^#([\w.-]+) (.*)$', re.DOTALL)
+# the server's default limit on commands per BATCH
+MAX_BATCH = 32
+
+def split_reply(server_msg):
+    """Splits a server message into the request id it's a reply to (or None)
+    and the message proper."""
+    match = REPLY_RE.fullmatch(server_msg)
+    if match is None:
+        return None, server_msg
+    return match.groups()
 
 class Client:
     def __init__(self, loop):
@@ -17,6 +32,11 @@ class Client:
         self.ui = ui.UI(self.loop)
         self.listening = False
         self.authenticated = False
+        # whether the server tags replies with request ids; if so, commands
+        # can be pipelined as BATCHes.
+        self.framed = False
+        self.request_ids = itertools.count(1)
+        self.queued_commands = []
         self.ui.base = urwid.Overlay(
             urwid.Filler(urwid.Text('connecting..', align='center')),
             ui.solidfill('░', 'background'),
@@ -36,24 +56,51 @@ class Client:
             host=self.config.get('server_host'),
             port=self.config.get('server_port'))
 
+    def deflate_extension(self):
+        """permessage-deflate settings for the connection. Most of what's
+        worth compressing comes from the server, which decides how it
+        compresses; these bound what we ask it to use (its window bits) and
+        what we use ourselves."""
+        return ClientPerMessageDeflateFactory(
+            server_max_window_bits=self.config.get('deflate_window_bits'),
+            client_max_window_bits=self.config.get('deflate_window_bits'),
+            compress_settings={'memLevel': self.config.get('deflate_mem_level')})
+
     def set_on_recv(self, handler):
         self.recv_handler = handler
 
     async def connect(self):
-        self.connection = await websockets.connect(self.login_url)
+        self.connection = await websockets.connect(
+            self.login_url, extensions=[self.deflate_extension()])
         time.sleep(0.3) # people love to wait
         self.ui.base = Splash(lambda _:self.show_menu())
 
     async def start_listen_loop(self):
         self.listening = True
         async for server_msg in self.connection:
+            _, server_msg = split_reply(server_msg)
             await self.recv_handler(server_msg)
 
+    async def request(self, text):
+        """Sends text tagged with a request id and returns the server's reply
+        and whether it came tagged. Servers that predate request ids don't
+        understand tagged messages, so it's resent untagged to them. Only for
+        use before the listen loop starts."""
+        request_id = str(next(self.request_ids))
+        await self.connection.send('#{} {}'.format(request_id, text))
+        reply_id, response = split_reply(await self.connection.recv())
+        if reply_id is None and response == 'ERROR: message not understood':
+            await self.connection.send(text)
+            return await self.connection.recv(), False
+        return response, reply_id == request_id
+
     async def authenticate(self, username, password):
-        await self.connection.send('LOGIN {}:{}'.format(username, password))
-        response = await self.connection.recv()
-        if response == 'LOGIN OK':
+        response, framed = await self.request('LOGIN {}:{}'.format(username, password))
+        if response.startswith('BUSY'):
+            self.ui.base.message(busy_message(response), 'error')
+        elif response == 'LOGIN OK':
             self.authenticated = True
+            self.framed = framed
             self.ui.base = GameMain(self, self.loop, self.ui.loop, self.config)
             await self.start_listen_loop()
             await self.refresh()
@@ -64,9 +111,10 @@ class Client:
         await self.connection.send('REFRESH')
 
     async def register(self, username, password):
-        await self.connection.send('REGISTER {}:{}'.format(username, password))
-        response = await self.connection.recv()
-        if response == 'REGISTER OK':
+        response, _ = await self.request('REGISTER {}:{}'.format(username, password))
+        if response.startswith('BUSY'):
+            self.ui.base.message(busy_message(response), 'error')
+        elif response == 'REGISTER OK':
             self.config.set('username', username)
             self.config.set('password', password)
             self.config.sync()
@@ -78,3 +126,25 @@ class Client:
 
     async def send(self, text):
         await self.connection.send(text)
+
+    async def send_command(self, text):
+        """Sends text as a COMMAND. Once logged in with request ids, commands
+        sent in the same turn of the loop (say, a burst of movement keys) go
+        out together as a BATCH instead of one frame each."""
+        command = 'COMMAND {}'.format(text)
+        if not self.framed:
+            await self.send(command)
+            return
+        self.queued_commands.append(command)
+        if len(self.queued_commands) > 1:
+            # whoever queued first sends it
+            return
+        await asyncio.sleep(0)
+        commands, self.queued_commands = self.queued_commands, []
+        for i in range(0, len(commands), MAX_BATCH):
+            chunk = commands[i:i + MAX_BATCH]
+            request_id = next(self.request_ids)
+            if len(chunk) == 1:
+                await self.send('#{} {}'.format(request_id, chunk[0]))
+            else:
+                await self.send('#{} BATCH {}'.format(request_id, json.dumps(chunk)))
@@ -5,7 +5,9 @@ DEFAULT_CONFIG_PATH = os.path.expanduser('~/.config/tildemush/config.json')
 
 CONFIG_DEFAULTS = {
     'server_host':'localhost',
-    'server_port': 10014}
+    'server_port': 10014,
+    'deflate_window_bits': 15,
+    'deflate_mem_level': 5}
 
 def ensure_config_file(path):
     if not os.path.exists(os.path.dirname(path)):
@@ -13,6 +13,13 @@ def quit_client(screen):
     asyncio.ensure_future(screen.client_state.send('QUIT'), loop=screen.loop)
     raise urwid.ExitMainLoop()
 
+def busy_message(server_msg):
+    """Turns a BUSY reply from an overloaded server into something to show
+    the user."""
+    retry_after = server_msg[len('BUSY '):]
+    return 'the server is busy right now; try again in {}s'.format(retry_after)
+
+
 class Splash(Screen):
     def __init__(self, exit=lambda _:True):
         bt = urwid.BigText('WELCOME TO TILDEMUSH', urwid.font.HalfBlock5x4Font())
@@ -152,6 +159,10 @@ class GameMain(urwid.Frame):
     async def on_server_message(self, server_msg):
         if server_msg == 'COMMAND OK':
             pass
+        elif server_msg == 'BATCH OK' or server_msg.startswith('BATCH STOPPED'):
+            pass
+        elif server_msg.startswith('BUSY '):
+            self.game_tab.add_message('{yellow}' + busy_message(server_msg) + '{/}')
         elif server_msg.startswith('STATE'):
             self.update_state(server_msg[6:])
         elif server_msg.startswith('OBJECT'):
@@ -237,9 +248,7 @@ class GameMain(urwid.Frame):
             else:
                 text = 'say {'+chat_color+'}...{/}'
 
-        server_msg = 'COMMAND {}'.format(text)
-
-        asyncio.ensure_future(self.client_state.send(server_msg), loop=self.loop)
+        asyncio.ensure_future(self.client_state.send_command(text), loop=self.loop)
         self.prompt.edit_text = ''
 
     def handle_keypress(self, size, key):
@@ -254,8 +263,8 @@ class GameMain(urwid.Frame):
             if self.body == self.game_tab:
                 self.game_tab.game_area.keypress(size, key)
         elif key in self.hotkeys.get("movement").keys():
-            asyncio.ensure_future(self.client_state.send(
-                    "COMMAND {}".format(self.hotkeys.get("movement").get(key))
+            asyncio.ensure_future(self.client_state.send_command(
+                    self.hotkeys.get("movement").get(key)
                 ), loop=self.loop)
         elif key in self.hotkeys.get("rlwrap").keys() and isinstance(self.prompt, ui.GamePrompt):
             self.prompt.handle_rlwrap(self.hotkeys.get("rlwrap").get(key))
@@ -0,0 +1,145 @@
+"""Measures the CPU vs bandwidth trade-off of permessage-deflate settings.
+
+Run from the server directory:
+
+    python benchmarks/deflate.py [--traffic recorded.jsonl] [--sessions 20]
+
+--traffic is a recording made by running the server with
+TILDEMUSH_TRAFFIC_RECORD set (see tmserver/compression.py); without one, a
+synthetic mix of replies, chatter, STATE, OBJECT and MAP frames is used. Each
+recorded session gets its own compressor, as each connection would, and
+every frame is compressed the way websockets' permessage-deflate does it.
+
+For each combination of window bits, memory level, compression level and
+minimum size, reports the bytes sent as a percentage of the uncompressed
+bytes, the microseconds of compression per frame and roughly how much memory
+each connection's compressor holds on to."""
+import argparse
+import base64
+import collections
+import itertools
+import json
+import random
+import time
+import zlib
+
+_EMPTY_UNCOMPRESSED_BLOCK = b'\x00\x00\xff\xff'
+
+WITCH = '''
+(incantation by vilmibm
+  (has {"name" "jar of pickles"
+        "description" "a murky jar. something is looking out of it."})
+  (hears "*pickle*"
+    (says "I heard that."))
+  (provides "open $this"
+    (if (> (random-number 10) 5)
+      (says "the lid won't budge")
+      (do
+        (says "POP")
+        (tell-sender "it smells like vinegar and regret")))))
+'''
+
+MAP = '\n'.join([
+    '+--------------+     +--------------+',
+    '| the foyer    |-----| the kitchen  |',
+    '+--------------+     +--------------+',
+    '       |                    |       ',
+    '+--------------+     +--------------+',
+    '| the cellar   |     | the pantry   |',
+    '+--------------+     +--------------+'] * 3)
+
+
+def synthetic_traffic(sessions, frames_per_session=200, seed=1):
+    rand = random.Random(seed)
+    traffic = []
+    for session in range(sessions):
+        for i in range(frames_per_session):
+            kind = rand.random()
+            if kind < 0.35:
+                frame = 'COMMAND OK'
+            elif kind < 0.7:
+                frame = 'user{} says, "{}"'.format(
+                    rand.randrange(50), ' '.join(rand.choice(('hi', 'pickles', 'where', 'is', 'the',
+                                                              'cellar', 'lol', 'ok')) for _ in range(6)))
+            elif kind < 0.9:
+                contains = [{'name': 'jar {}'.format(j),
+                             'description': 'a murky jar. something is looking out of it.',
+                             'shortname': 'vilmibm/jar-{}'.format(j)}
+                            for j in range(rand.randrange(3, 30))]
+                frame = 'STATE ' + json.dumps({
+                    'motd': 'welcome to tildemush',
+                    'user': {'username': 'user{}'.format(session), 'display_name': 'someone',
+                             'description': 'a shadowy figure in a very large hat'},
+                    'room': {'name': 'the pickling room', 'shortname': 'vilmibm/pickling-room',
+                             'description': 'A long, low room lined with shelves of jars.',
+                             'contains': contains, 'exits': {}},
+                    'inventory': []})
+            elif kind < 0.95:
+                frame = 'OBJECT ' + json.dumps({'shortname': 'vilmibm/jar', 'code': WITCH,
+                                                'current_rev': i, 'edit': True})
+            else:
+                frame = 'MAP\n' + MAP
+            traffic.append((session, frame.encode('utf-8')))
+    return traffic
+
+
+def recorded_traffic(path):
+    traffic = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if 'data' in record:
+                frame = base64.b64decode(record['data'])
+            else:
+                frame = record['text'].encode('utf-8')
+            traffic.append((record['session'], frame))
+    return traffic
+
+
+def run(traffic, window_bits, mem_level, level, min_size):
+    encoders = collections.defaultdict(
+        lambda: zlib.compressobj(level=level, wbits=-window_bits, memLevel=mem_level))
+    sent = 0
+    started = time.perf_counter()
+    for session, frame in traffic:
+        if len(frame) < min_size:
+            sent += len(frame)
+            continue
+        encoder = encoders[session]
+        data = encoder.compress(frame) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_EMPTY_UNCOMPRESSED_BLOCK):
+            data = data[:-4]
+        sent += len(data)
+    elapsed = time.perf_counter() - started
+    return sent, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--traffic', help='a recording made with TILDEMUSH_TRAFFIC_RECORD')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--window-bits', type=int, nargs='+', default=[9, 12, 15])
+    parser.add_argument('--mem-levels', type=int, nargs='+', default=[5, 8])
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6])
+    parser.add_argument('--min-sizes', type=int, nargs='+', default=[0, 128, 512])
+    opts = parser.parse_args()
+
+    if opts.traffic:
+        traffic = recorded_traffic(opts.traffic)
+    else:
+        traffic = synthetic_traffic(opts.sessions)
+    raw = sum(len(frame) for _, frame in traffic)
+    print('{} frames, {} bytes uncompressed'.format(len(traffic), raw))
+    print('{:>6} {:>6} {:>6} {:>9} {:>9} {:>12} {:>10}'.format(
+        'wbits', 'mem', 'level', 'min size', 'sent %', 'us/frame', 'KiB/conn'))
+    for window_bits, mem_level, level, min_size in itertools.product(
+            opts.window_bits, opts.mem_levels, opts.levels, opts.min_sizes):
+        sent, elapsed = run(traffic, window_bits, mem_level, level, min_size)
+        memory = (2 ** (window_bits + 2) + 2 ** (mem_level + 9)) / 1024
+        print('{:>6} {:>6} {:>6} {:>9} {:>8.1f}% {:>12.2f} {:>10.0f}'.format(
+            window_bits, mem_level, level, min_size, 100 * sent / raw,
+            elapsed / len(traffic) * 1e6, memory))
+
+
+if __name__ == '__main__':
+    main()
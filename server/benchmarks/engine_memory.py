@@ -0,0 +1,77 @@
+"""Reports how many bytes a live WITCH script engine costs.
+
+Run from the server directory:
+
+    python benchmarks/engine_memory.py [--engines 1000]
+
+Builds the given number of engines for each script in witch_backends.py and
+measures the memory they hold with tracemalloc, both the way engines are built
+now (a symbol table layered over one shared set of builtins) and the way they
+used to be built (a full asteval symbol table, node handler dict and builtin
+handler dict per engine)."""
+import argparse
+import gc
+import tracemalloc
+
+import asteval
+
+from tmserver import scripting
+from tmserver.scripting import ScriptEngine, WitchInterpreter, compile_witch
+
+from witch_backends import BenchReceiver, scripts
+
+
+class UnsharedInterpreter(scripting.MeteredInterpreter):
+    """Builds itself the way every interpreter was built before the symbol
+    table was shared."""
+    def __init__(self, usersyms, **kwargs):
+        asteval.Interpreter.__init__(self, usersyms=usersyms, **kwargs)
+        self.metering = False
+        self.steps = 0
+        self.step_limit = None
+        self.deadline = None
+        self.exceeded = None
+
+
+def build(asts, unshared):
+    wi = WitchInterpreter(BenchReceiver())
+    for witch_ast in asts:
+        wi.evaluate_ast(witch_ast)
+    engine = wi.script_engine
+    if unshared:
+        for action, handler in ScriptEngine.BUILTIN_PROVIDES.items():
+            engine.provides.setdefault(action, handler.__get__(engine, ScriptEngine))
+    return engine
+
+
+def bytes_per_engine(asts, count, unshared):
+    scripting.MeteredInterpreter = UnsharedInterpreter if unshared else SHARED
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    engines = [build(asts, unshared) for _ in range(count)]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del engines
+    return total / count
+
+
+SHARED = scripting.MeteredInterpreter
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', type=int, default=1000)
+    opts = parser.parse_args()
+
+    tracemalloc.start()
+    print('{:<28} {:>14} {:>14}'.format('script', 'before (B)', 'after (B)'))
+    for name, code, _ in scripts():
+        asts = compile_witch(code)
+        unshared = bytes_per_engine(asts, opts.engines, True)
+        shared = bytes_per_engine(asts, opts.engines, False)
+        print('{:<28} {:>14.0f} {:>14.0f}'.format(name, unshared, shared))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compares the text and MessagePack wire encodings of typical STATE frames.
+
+Run from the server directory (needs msgpack):
+
+    python benchmarks/wire_encoding.py [--objects 5 20 80] [--rounds 2000]
+
+Builds client states shaped like GameWorld.client_state for a room holding
+--objects objects (with a few exits and a small inventory), then reports, per
+encoding, the bytes per frame and the microseconds to encode a frame on the
+server and to decode it the way a client would. No database is needed."""
+import argparse
+import json
+import time
+
+import msgpack
+
+from tmserver.wire import MsgpackWire, TextWire
+
+DESCRIPTION = ('A long, low room lined with shelves of jars. Something in one of '
+               'them is definitely looking at you.')
+
+
+def client_state(objects):
+    return {
+        'motd': 'welcome to tildemush',
+        'user': {
+            'username': 'vilmibm',
+            'display_name': 'vilmibm',
+            'description': 'a shadowy figure in a very large hat',
+        },
+        'room': {
+            'name': 'the pickling room',
+            'shortname': 'vilmibm/pickling-room',
+            'description': DESCRIPTION,
+            'contains': [dict(name='jar {}'.format(i),
+                              description=DESCRIPTION,
+                              shortname='vilmibm/jar-{}'.format(i))
+                         for i in range(objects)],
+            'exits': {d: {'exit_name': 'a door', 'room_name': 'the {} room'.format(d)}
+                      for d in ('north', 'south', 'east', 'west')},
+        },
+        'inventory': [{'name': 'lantern', 'shortname': 'vilmibm/lantern', 'contains': []},
+                      {'name': 'bag', 'shortname': 'vilmibm/bag',
+                       'contains': [{'name': 'coin', 'shortname': 'vilmibm/coin', 'contains': []}]}],
+    }
+
+
+def decode_text(frame):
+    return json.loads(frame[len('STATE '):])
+
+
+def decode_msgpack(frame):
+    return msgpack.unpackb(frame, raw=False)['p']
+
+
+def measure(wire, decode, state, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        frame = wire.encode('STATE', payload=state)
+    encode_us = (time.perf_counter() - started) / rounds * 1e6
+    started = time.perf_counter()
+    for _ in range(rounds):
+        decode(frame)
+    decode_us = (time.perf_counter() - started) / rounds * 1e6
+    size = len(frame.encode('utf-8')) if isinstance(frame, str) else len(frame)
+    return size, encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[5, 20, 80])
+    parser.add_argument('--rounds', type=int, default=2000)
+    opts = parser.parse_args()
+
+    print('{:>8} {:>8} {:>10} {:>12} {:>12}'.format(
+        'objects', 'wire', 'bytes', 'encode us', 'decode us'))
+    for objects in opts.objects:
+        state = client_state(objects)
+        for name, wire, decode in (('text', TextWire(), decode_text),
+                                   ('msgpack', MsgpackWire(), decode_msgpack)):
+            size, encode_us, decode_us = measure(wire, decode, state, opts.rounds)
+            print('{:>8} {:>8} {:>10} {:>12.1f} {:>12.1f}'.format(
+                objects, name, size, encode_us, decode_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Compares WITCH handler latency between the asteval and bytecode backends.
+
+Run from the server directory:
+
+    python benchmarks/witch_backends.py [--number 2000]
+
+For every script template and a handful of scripts modeled on ones people
+actually write, this times loading the (already Hy compiled) script under each
+backend and calling each of its handlers. No database is needed; handlers run against an in-memory
+stand-in for a game object."""
+import argparse
+import timeit
+
+from tmserver import scripting
+from tmserver.sandbox import TrialReceiver
+from tmserver.scripting import SCRIPT_TEMPLATES, WitchInterpreter, compile_witch
+
+BACKENDS = ('asteval', 'bytecode')
+
+REALISTIC_SCRIPTS = {
+    'horse': ('''
+    (incantation by vilmibm
+      (has {"num-pets" 0 "name" "snoozy" "description" "a horse"})
+      (provides "pet"
+        (set-data "num-pets" (+ 1 (get-data "num-pets")))
+        (if (= 0 (% (get-data "num-pets") 5))
+          (says "neigh neigh neigh i am horse"))))''', [('provides', 'pet', '')]),
+    'vending machine': ('''
+    (incantation by vilmibm
+      (has {"name" "Vending Machine" "description" "A Japanese-style vending machine."})
+      (provides "give $this"
+        (if (= "yen" (get args 2))
+          (if (<= 100 (int (get args 1)))
+            (says "have a pocari sweat. enjoy.")
+            (says "need more yen"))
+          (says "i only take yen sorry"))))''', [('provides', 'give $this', 'machine 100 yen')]),
+    'cave echo': ('''
+    (incantation by vilmibm
+      (has {"name" "Cave Echo" "description" "it echoes"})
+      (hears "*"
+        (says (+ heard " but spookily"))))''', [('hears', '*', 'hello there')]),
+    'slot machine': ('''
+    (incantation by vilmibm
+      (has {"name" "slot machine" "description" "it has a lever"})
+      (provides "pull"
+        (says "KA CHANK")
+        (says (.join " " (list (map str [(random-number 1 9) (random-number 1 9) (random-number 1 9)]))))))''',
+                     [('provides', 'pull', '')]),
+    'counter': ('''
+    (incantation by vilmibm
+      (has {"name" "abacus" "description" "it counts"})
+      (provides "count"
+        (setv total 0)
+        (for [i (range 200)]
+          (setv total (+ total i)))
+        (set-data "total" total)))''', [('provides', 'count', '')]),
+}
+
+
+class Proxy:
+    def __init__(self, id, name):
+        self.id = id
+        self.shortname = name
+        self.name = name
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+
+class BenchReceiver(TrialReceiver):
+    def get_by_id(self, id):
+        return self
+
+    def tell_sender(self, *args):
+        pass
+
+    def move_sender(self, *args):
+        pass
+
+    def teleport_sender(self, *args):
+        pass
+
+
+TEMPLATE_CALLS = {
+    'exit': [('provides', 'go', 'north')],
+    'portkey': [('provides', 'touch $this', 'stone')],
+}
+
+
+def load(asts, backend):
+    scripting.WITCH_BACKEND = backend
+    wi = WitchInterpreter(BenchReceiver())
+    for witch_ast in asts:
+        wi.evaluate_ast(witch_ast)
+    return wi.script_engine
+
+
+def handler_calls(engine, calls):
+    this, sender = Proxy(1, 'this'), Proxy(2, 'sender')
+    out = []
+    for kind, key, args in calls:
+        if kind == 'provides':
+            fn = engine.provides[key]
+            out.append(('{} {}'.format(kind, key), lambda: fn(this, sender, key, args)))
+        else:
+            fn = engine.hears[key]
+            out.append(('{} {}'.format(kind, key), lambda: fn(this, sender, args)))
+    return out
+
+
+def scripts():
+    for obj_type, template in SCRIPT_TEMPLATES.items():
+        code = template.format(
+            author='vilmibm', name=obj_type, description='a benchmark',
+            target_room_name='god/foyer')
+        yield 'template {}'.format(obj_type), code, TEMPLATE_CALLS.get(obj_type, [])
+    for name, (code, calls) in REALISTIC_SCRIPTS.items():
+        yield name, code, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    opts = parser.parse_args()
+
+    print('{:<28} {:<22} {:>12} {:>12} {:>8}'.format(
+        'script', 'handler', 'asteval us', 'bytecode us', 'speedup'))
+    for name, code, calls in scripts():
+        asts = compile_witch(code)
+        timings = {}
+        for backend in BACKENDS:
+            load_number = max(1, opts.number // 10)
+            seconds = timeit.timeit(lambda: load(asts, backend), number=load_number)
+            timings.setdefault('(load)', {})[backend] = seconds / load_number * 1e6
+            engine = load(asts, backend)
+            for label, call in handler_calls(engine, calls):
+                seconds = timeit.timeit(call, number=opts.number)
+                timings.setdefault(label, {})[backend] = seconds / opts.number * 1e6
+        for label, by_backend in timings.items():
+            a, b = by_backend['asteval'], by_backend['bytecode']
+            print('{:<28} {:<22} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(name, label, a, b, a / b))
+
+
+if __name__ == '__main__':
+    main()
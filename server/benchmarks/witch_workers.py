@@ -0,0 +1,90 @@
+"""Measures WITCH handler throughput against the number of script workers.
+
+Run from the server directory:
+
+    python benchmarks/witch_workers.py [--objects 32] [--rounds 20] [--workers 1 2 4 8]
+
+Loads a CPU heavy hears handler into --objects objects spread over a worker
+pool, then times --rounds batches in which every object hears something, the
+way everything in a crowded room hears a say. No database is needed; effects
+are applied to in-memory stand-ins for game objects."""
+import argparse
+import os
+import time
+
+from tmserver.scripting import ProxyGameObject
+from tmserver.workers import RemoteEngine, WorkerPool
+
+BUSY_SCRIPT = '''
+(incantation by vilmibm
+  (has {"name" "abacus" "description" "it counts"})
+  (hears "*"
+    (setv total 0)
+    (for [i (range 20000)] (setv total (+ total i)))
+    (set-data "total" total)))'''
+
+BUDGET = (10 ** 8, 60.0)
+
+
+class BenchObject:
+    def __init__(self, obj_id):
+        self.id = obj_id
+        self.shortname = 'bench/{}'.format(obj_id)
+        self.name = 'abacus'
+        self.data = {}
+        self.editing_set = []
+
+    def get_by_id(self, obj_id):
+        return self
+
+    def _ensure_data(self, data):
+        self.data = data
+
+    def set_data(self, key, value):
+        self.data[key] = value
+
+    def set_perms(self, **kwargs):
+        pass
+
+    def say(self, message):
+        pass
+
+    def emote(self, message):
+        pass
+
+
+def rounds_per_second(workers, objects, rounds):
+    pool = WorkerPool(size=workers)
+    try:
+        engines = [RemoteEngine(BenchObject(i), pool, BUSY_SCRIPT, BUDGET) for i in range(objects)]
+        sender = ProxyGameObject(BenchObject(-1))
+        started = time.perf_counter()
+        for _ in range(rounds):
+            with pool.batch():
+                for engine in engines:
+                    engine.hears['*'](ProxyGameObject(engine.receiver_model), sender, 'hello')
+        elapsed = time.perf_counter() - started
+        assert all(e.receiver_model.data.get('total') for e in engines)
+        return rounds / elapsed
+    finally:
+        pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[n for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)])
+    opts = parser.parse_args()
+
+    print('{:>8} {:>14} {:>10}'.format('workers', 'rounds/s', 'speedup'))
+    baseline = None
+    for workers in opts.workers:
+        rate = rounds_per_second(workers, opts.objects, opts.rounds)
+        baseline = baseline or rate
+        print('{:>8} {:>14.2f} {:>9.2f}x'.format(workers, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,8 +29,13 @@ setup(
     extras_require={
         'testing': [
             'pytest==3.5.0',
-            'pytest-asyncio==0.8.0'
-        ]
+            'pytest-asyncio==0.8.0',
+            'msgpack==0.6.1',
+        ],
+        # for the binary wire protocol; see tmserver/wire.py
+        'msgpack': [
+            'msgpack==0.6.1',
+        ],
     },
     #include_package_data=True,
     package_data={
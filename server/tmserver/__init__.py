@@ -1,21 +1,39 @@
 import sys
+import time
 
 import click
 
+from .cluster import Cluster
+from .config import WARMUP_BUDGET, CLUSTER_NODES
 from .core import GameServer
+from .frontend import start_frontends
 from .logs import get_logger
 from .world import GameWorld
 from .migrations import init_db
+from .workers import get_pool
 
 
 @click.command()
 @click.option('--debug/--no-debug', default=False, help='Log to the console.')
 @click.option('--bind', default='127.0.0.1', help='bind IP')
 @click.option('--port', default=10014, help='server port')
-def _main(debug, bind, port):
-    gs = GameServer(GameWorld, logger=get_logger(debug), bind=bind, port=port)
-    init_db()
-    gs.start()
+@click.option('--warmup/--no-warmup', default=False, help='Precompile active WITCH scripts before accepting connections.')
+@click.option('--warmup-budget', default=WARMUP_BUDGET, help='Seconds to spend on warmup before compiling lazily.')
+@click.option('--frontends', default=0, help='Number of websocket front-end processes sharing the port; 0 serves websockets in this process.')
+def _main(debug, bind, port, warmup, warmup_budget, frontends):
+    boot_started = time.monotonic()
+    # workers and front-ends are forked before anything else starts threads,
+    # opens connections or adds log handlers
+    get_pool()
+    start_frontends(bind, port, frontends, debug=debug)
+    logger = get_logger(debug)
+    cluster = None
+    if CLUSTER_NODES > 1:
+        cluster = Cluster(GameWorld, logger=logger)
+    gs = GameServer(GameWorld, logger=logger, bind=bind, port=port, cluster=cluster)
+    init_db(warmup_budget=warmup_budget if warmup else None,
+            bust=cluster is None or cluster.node == 0)
+    gs.start(boot_started=boot_started, frontends=frontends)
 
 
 def main():
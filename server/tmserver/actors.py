@@ -0,0 +1,139 @@
+"""Per room serialization of commands.
+
+Every command runs while holding the lock of each room it touches, so commands
+in one room happen one at a time and in the order they arrived while commands
+in other rooms don't wait on them. The protocol is:
+
+- a command holds the locks of the rooms GameWorld.rooms_for says it touches:
+  normally just the sender's room, plus the destination for movement;
+- locks are always taken in ascending room id order, so two commands that
+  touch the same rooms from opposite ends (someone going north while someone
+  else comes south) can't deadlock;
+- a command that touches the whole world (announce) takes the world
+  exclusively: it waits for every running command to finish and holds off new
+  ones until it's done.
+
+The rooms a command touches are worked out before its locks are taken, so once
+they're held they're worked out again; if someone or something moved in the
+meantime, the command lets go and tries again with the rooms it touches now.
+
+Everything a command causes (handlers, the cascade of actions they set off)
+runs under the locks of the command that started it, except what's left to
+run later (an action suspended partway through, or the rest of a cascade too
+long to run in one go), which holds the lock of the place it happens in while
+it runs. Locks only ever matter across an await; a command that never awaits
+runs to completion either way."""
+import asyncio
+
+
+class RoomLocks:
+    def __init__(self):
+        # room id -> [asyncio.Lock, number of commands holding or waiting on it]
+        self._locks = {}
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._cond = None
+
+    @property
+    def cond(self):
+        # created lazily so it binds to whatever loop is running the server
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def hold(self, room_ids, exclusive=False):
+        """Returns an async context manager holding room_ids (or, if
+        exclusive, the whole world) for the duration of its block."""
+        return Hold(self, room_ids, exclusive)
+
+    async def _acquire_world(self, exclusive):
+        async with self.cond:
+            if exclusive:
+                self._exclusive_waiting += 1
+                try:
+                    await self.cond.wait_for(lambda: self._shared == 0 and not self._exclusive)
+                finally:
+                    self._exclusive_waiting -= 1
+                self._exclusive = True
+            else:
+                await self.cond.wait_for(
+                    lambda: not self._exclusive and not self._exclusive_waiting)
+                self._shared += 1
+
+    async def _release_world(self, exclusive):
+        async with self.cond:
+            if exclusive:
+                self._exclusive = False
+            else:
+                self._shared -= 1
+            self.cond.notify_all()
+
+    def _entry(self, room_id):
+        entry = self._locks.get(room_id)
+        if entry is None:
+            entry = self._locks[room_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _forget(self, room_id):
+        entry = self._locks[room_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[room_id]
+
+    async def acquire(self, room_ids, exclusive=False):
+        await self._acquire_world(exclusive)
+        if exclusive:
+            return
+        acquired = []
+        try:
+            for room_id in room_ids:
+                lock = self._entry(room_id)
+                try:
+                    await lock.acquire()
+                except BaseException:
+                    self._forget(room_id)
+                    raise
+                acquired.append(room_id)
+        except BaseException:
+            self._release_rooms(acquired)
+            await self._release_world(exclusive)
+            raise
+
+    def _release_rooms(self, room_ids):
+        for room_id in reversed(room_ids):
+            self._locks[room_id][0].release()
+            self._forget(room_id)
+
+    async def release(self, room_ids, exclusive=False):
+        if not exclusive:
+            self._release_rooms(room_ids)
+        await self._release_world(exclusive)
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class Hold:
+    def __init__(self, locks, room_ids, exclusive):
+        self.locks = locks
+        self.room_ids = sorted(set(room_ids))
+        self.exclusive = exclusive
+
+    def covers(self, room_ids, exclusive=False):
+        """Whether holding this also holds room_ids (or the whole world)."""
+        return self.exclusive or (not exclusive and set(room_ids) <= set(self.room_ids))
+
+    async def acquire(self):
+        await self.locks.acquire(self.room_ids, self.exclusive)
+
+    async def release(self):
+        await self.locks.release(self.room_ids, self.exclusive)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
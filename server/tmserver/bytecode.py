@@ -0,0 +1,175 @@
+"""An alternative to asteval for running WITCH scripts.
+
+asteval walks the Python AST in Python every time a handler runs. This backend
+instead validates the AST Hy produces against a whitelist, compiles it to a real
+code object once and runs it with a namespace containing only the safe builtins
+asteval would have offered plus the WITCH API closures from WitchInterpreter.
+
+The whitelist is asteval's own list of supported nodes, so a script that runs
+under one backend runs under the other. On top of that we refuse any attribute
+or name that starts with a double underscore as well as the attributes asteval
+considers unsafe, which is what keeps scripts from walking their way from a
+string to object.__subclasses__.
+
+Since nothing walks the tree at runtime there's no node count for metering.
+Instead a call to a tick function is inserted at the top of every function body
+and loop body, and comprehensions iterate through a wrapper that ticks for
+each item; the budget's step limit counts those ticks."""
+from collections import OrderedDict
+import ast
+import copy
+import time
+
+from asteval.asteval import ALL_NODES
+from asteval.astutils import UNSAFE_ATTRS, make_symbol_table
+
+from .config import WITCH_AST_CACHE_SIZE, WITCH_SLICE_STEPS
+from .errors import WitchError, WitchBudgetExceeded
+from .timeslice import checkpoint
+
+TICK_NAME = '__witch_tick__'
+TICKING_NAME = '__witch_ticking__'
+ALLOWED_NODES = set(ALL_NODES) | {'constant'}
+# str.format can reach arbitrary attributes through its format string.
+UNSAFE_BYTECODE_ATTRS = set(UNSAFE_ATTRS) | {'format', 'format_map'}
+
+# Names in asteval's symbol table that reach outside the sandbox. asteval's
+# open reads any file the server can; WITCH gets a stub of its own instead.
+UNSAFE_NAMES = frozenset({'open'})
+
+
+def safe_symbol_table():
+    """Returns asteval's builtins and math less UNSAFE_NAMES. Both backends
+    share one of these under every interpreter, so anything in it is what a
+    script finds after deleting its own definition of the same name."""
+    return {name: value for name, value in make_symbol_table(use_numpy=False).items()
+            if name not in UNSAFE_NAMES}
+
+
+# Shared by every BytecodeInterpreter. exec needs a real dict for globals, so
+# instead of layering these under each namespace they're handed to Python as
+# the namespace's builtins, which it consults after globals.
+BASE_NAMESPACE = safe_symbol_table()
+
+# id(witch_ast) -> (witch_ast, code). The AST is kept so its id can't be
+# reused while the entry lives.
+_CODE_CACHE = OrderedDict()
+
+
+def _checked_node_name(node):
+    return node.__class__.__name__.lower()
+
+
+def validate(witch_ast):
+    """Raises WitchError if witch_ast contains anything that isn't
+    whitelisted."""
+    for node in ast.walk(witch_ast):
+        if isinstance(node, (ast.stmt, ast.expr, ast.excepthandler, ast.mod)):
+            name = _checked_node_name(node)
+            if name not in ALLOWED_NODES:
+                raise WitchError("'{}' not supported".format(node.__class__.__name__))
+        if isinstance(node, ast.Attribute):
+            if node.attr.startswith('__') or node.attr in UNSAFE_BYTECODE_ATTRS:
+                raise WitchError("no safe attribute '{}'".format(node.attr))
+        elif isinstance(node, ast.Name):
+            if node.id.startswith('__'):
+                raise WitchError("no safe name '{}'".format(node.id))
+        elif isinstance(node, ast.arg):
+            if node.arg.startswith('__'):
+                raise WitchError("no safe name '{}'".format(node.arg))
+
+
+class TickInserter(ast.NodeTransformer):
+    def _tick(self):
+        return ast.Expr(value=ast.Call(
+            func=ast.Name(id=TICK_NAME, ctx=ast.Load()), args=[], keywords=[]))
+
+    def _with_tick(self, node):
+        self.generic_visit(node)
+        node.body.insert(0, self._tick())
+        return node
+
+    visit_FunctionDef = _with_tick
+    visit_While = _with_tick
+    visit_For = _with_tick
+
+    def visit_comprehension(self, node):
+        # covers list, set and dict comprehensions and generator expressions,
+        # whose loops have no body to put a tick in
+        self.generic_visit(node)
+        node.iter = ast.Call(func=ast.Name(id=TICKING_NAME, ctx=ast.Load()),
+                             args=[node.iter], keywords=[])
+        return node
+
+
+def compile_ast(witch_ast):
+    """Validates, instruments and compiles witch_ast, caching the result."""
+    key = id(witch_ast)
+    cached = _CODE_CACHE.get(key)
+    if cached is not None and cached[0] is witch_ast:
+        _CODE_CACHE.move_to_end(key)
+        return cached[1]
+
+    validate(witch_ast)
+    instrumented = TickInserter().visit(copy.deepcopy(witch_ast))
+    ast.fix_missing_locations(instrumented)
+    code = compile(instrumented, '<witch>', 'exec')
+
+    _CODE_CACHE[key] = (witch_ast, code)
+    while len(_CODE_CACHE) > WITCH_AST_CACHE_SIZE:
+        _CODE_CACHE.popitem(last=False)
+
+    return code
+
+
+class BytecodeInterpreter:
+    """Quacks enough like MeteredInterpreter for WitchInterpreter to use it
+    interchangeably."""
+    def __init__(self, usersyms):
+        self.namespace = dict(usersyms)
+        self.namespace['__builtins__'] = BASE_NAMESPACE
+        self.namespace[TICK_NAME] = self._tick
+        self.namespace[TICKING_NAME] = self._ticking
+        self.error_msg = None
+        self.metering = False
+        self.steps = 0
+        self.step_limit = None
+        self.deadline = None
+        self.exceeded = None
+
+    def start_metering(self, step_limit, time_limit):
+        self.metering = True
+        self.exceeded = None
+        self.steps = 0
+        self.step_limit = step_limit
+        self.deadline = time.monotonic() + time_limit
+
+    def stop_metering(self):
+        self.metering = False
+        self.exceeded = None
+
+    def _tick(self):
+        if not self.metering:
+            return
+        self.steps += 1
+        if WITCH_SLICE_STEPS and self.steps % WITCH_SLICE_STEPS == 0:
+            self.deadline += checkpoint()
+        if self.steps > self.step_limit:
+            self.exceeded = 'evaluated more than {} steps'.format(self.step_limit)
+        elif time.monotonic() > self.deadline:
+            self.exceeded = 'ran for more than its time limit'
+        if self.exceeded:
+            raise WitchBudgetExceeded(self.exceeded)
+
+    def _ticking(self, iterable):
+        for item in iterable:
+            self._tick()
+            yield item
+
+    def __call__(self, witch_ast):
+        try:
+            exec(compile_ast(witch_ast), self.namespace)
+        except WitchBudgetExceeded:
+            pass
+        except Exception as e:
+            self.error_msg = str(e)
@@ -0,0 +1,292 @@
+"""Running one game world across several server processes.
+
+In cluster mode (TILDEMUSH_CLUSTER_NODES > 1) every room belongs to a region
+and every region to one node (a tmserver process). A room's region is looked
+up in TILDEMUSH_CLUSTER_REGIONS, first by its shortname and then by its
+author's username; rooms not mentioned there are spread over the nodes by a
+hash of their author's username, which keeps each sanctum and everything built
+off of it together.
+
+All nodes share the database. What they don't share is memory: sessions and
+script engines. So:
+
+- a client stays connected to whichever node it connected to;
+- its commands run on the node that owns the room its player is in, so a
+  region's engines are only ever loaded on one node. When a command leaves the
+  player somewhere in another region, the player is handed off: the new owner
+  is told, and from then on commands are forwarded there;
+- every node keeps a RemoteSession for each user connected to another node,
+  so anything that happens to a player anywhere (a whisper, an announce, a
+  state update) reaches their client, and a username can only be logged in
+  once across the cluster.
+
+Nodes talk over a message bus of unix sockets in TILDEMUSH_CLUSTER_SOCKET_DIR,
+one per node, carrying newline separated JSON. Anyone who can connect to one
+can act as any user, so the directory has to be private to the server's user
+(see util.private_dir); nodes refuse to start otherwise."""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import zlib
+
+from .config import CLUSTER_NODE, CLUSTER_NODES, CLUSTER_REGIONS, CLUSTER_SOCKET_DIR
+from .errors import ClientError, UserError
+from .models import GameObject, UserAccount
+from .util import private_dir
+
+
+def region_of(room, nodes=CLUSTER_NODES, regions=CLUSTER_REGIONS):
+    """Returns the node that owns room."""
+    if room.shortname in regions:
+        return regions[room.shortname]
+    username = room.author.username
+    if username in regions:
+        return regions[username]
+    return zlib.crc32(username.encode('utf-8')) % nodes
+
+
+class MessageBus:
+    def __init__(self, node, handler, socket_dir=CLUSTER_SOCKET_DIR, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.node = node
+        self.handler = handler
+        self.socket_dir = socket_dir
+        self.server = None
+        self._writers = {}
+
+    def path(self, node):
+        return os.path.join(self.socket_dir, 'node-{}.sock'.format(node))
+
+    async def start(self):
+        private_dir(self.socket_dir)
+        path = self.path(self.node)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._serve, path=path)
+
+    async def stop(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                msg = json.loads(line.decode('utf-8'))
+                await self.handler(msg)
+            except Exception as e:
+                self.logger.error('failed to handle bus message {}: {}'.format(line[:100], e))
+        writer.close()
+
+    async def send(self, node, msg):
+        """Sends msg to node. Returns False if node couldn't be reached."""
+        msg = dict(msg, sender=self.node)
+        data = (json.dumps(msg) + '\n').encode('utf-8')
+        for attempt in range(2):
+            writer = self._writers.get(node)
+            try:
+                if writer is None:
+                    _, writer = await asyncio.open_unix_connection(self.path(node))
+                    self._writers[node] = writer
+                writer.write(data)
+                await writer.drain()
+                return True
+            except (OSError, ConnectionError) as e:
+                # the node may have restarted since we last connected
+                self._writers.pop(node, None)
+                if attempt == 1:
+                    self.logger.error('could not reach node {}: {}'.format(node, e))
+        return False
+
+    async def broadcast(self, msg, nodes):
+        for node in nodes:
+            if node != self.node:
+                await self.send(node, msg)
+
+
+class RemoteSession:
+    """Stands in for the UserSession of a user connected to another node;
+    whatever the world tells it is passed along over the bus."""
+    def __init__(self, cluster, node, user_account_id):
+        self.cluster = cluster
+        self.node = node
+        self.user_account_id = user_account_id
+
+    def _forward(self, method, payload):
+        # this may be called from the database thread; see dbthread.py
+        asyncio.run_coroutine_threadsafe(self.cluster.bus.send(self.node, {
+            'type': 'session',
+            'user_account_id': self.user_account_id,
+            'method': method,
+            'payload': payload}), self.cluster.loop)
+
+    def handle_hears(self, sender_obj, message):
+        self._forward('handle_hears', message)
+
+    def handle_client_update(self, client_state):
+        self._forward('handle_client_update', client_state)
+
+    def send_object_state(self, object_state):
+        self._forward('send_object_state', object_state)
+
+    def __str__(self):
+        return 'RemoteSession<{} on node {}>'.format(self.user_account_id, self.node)
+
+
+class Cluster:
+    def __init__(self, game_world, node=CLUSTER_NODE, nodes=CLUSTER_NODES,
+                 socket_dir=CLUSTER_SOCKET_DIR, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.game_world = game_world
+        self.loop = asyncio.get_event_loop()
+        self.node = node
+        self.nodes = nodes
+        self.bus = MessageBus(node, self.handle, socket_dir=socket_dir, logger=logger)
+        # user account id -> the UserSession connected to this node
+        self.local_sessions = {}
+        # user account id -> the RemoteSession for a user on another node
+        self.remote_sessions = {}
+        self._requests = itertools.count(1)
+        self._pending = {}
+
+    async def start(self):
+        await self.bus.start()
+        await self.bus.broadcast({'type': 'hello'}, range(self.nodes))
+
+    def owner_of(self, player_obj):
+        room = player_obj.room
+        if room is None:
+            return self.node
+        return region_of(room, nodes=self.nodes)
+
+    async def session_opened(self, user_session):
+        user_id = user_session.user_account.id
+        self.local_sessions[user_id] = user_session
+        await self.bus.broadcast({'type': 'online', 'user_account_id': user_id}, range(self.nodes))
+
+    async def session_closed(self, user_account_id):
+        self.local_sessions.pop(user_account_id, None)
+        await self.bus.broadcast({'type': 'offline', 'user_account_id': user_account_id},
+                                 range(self.nodes))
+
+    async def run_command(self, user_session, action, action_args):
+        """Runs a command for a user connected here on whichever node owns
+        their room. Raises UserError like a local command would. Returns what
+        GameWorld.dispatch_action does for a command run here, or None once
+        another node says it's run."""
+        run = self.game_world.run_off_loop
+        player_obj = await run(lambda: user_session.user_account.player_obj)
+        owner = await run(self.owner_of, player_obj)
+        if owner == self.node:
+            root = await run(user_session.dispatch_action, action, action_args)
+            await self.check_handoff(player_obj, owner)
+            return root
+
+        request_id = next(self._requests)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        sent = await self.bus.send(owner, {
+            'type': 'command',
+            'request_id': request_id,
+            'user_account_id': user_session.user_account.id,
+            'action': action,
+            'action_args': action_args})
+        if not sent:
+            del self._pending[request_id]
+            raise UserError('That part of the world is unreachable right now.')
+        error = await future
+        if error is not None:
+            raise UserError(error)
+        return None
+
+    async def check_handoff(self, player_obj, previous_owner):
+        run = self.game_world.run_off_loop
+        owner = await run(self.owner_of, player_obj)
+        if owner != previous_owner:
+            self.logger.info('handing {} off from node {} to node {}'.format(
+                player_obj, previous_owner, owner))
+            user_account = await run(lambda: player_obj.user_account)
+            await self.bus.send(owner, {
+                'type': 'handoff',
+                'user_account_id': user_account.id})
+
+    async def handle(self, msg):
+        kind = msg['type']
+        sender = msg['sender']
+        if kind == 'hello':
+            # a node (re)started, so whoever was connected to it is gone; tell
+            # it who's connected here
+            for user_id, session in list(self.remote_sessions.items()):
+                if session.node == sender:
+                    self.detach(user_id)
+            for user_id in self.local_sessions:
+                await self.bus.send(sender, {'type': 'online', 'user_account_id': user_id})
+        elif kind == 'online':
+            # a node can hear about a session both from its own hello and from
+            # the session opening
+            user_id = msg['user_account_id']
+            session = self.remote_sessions.get(user_id)
+            if session is None or session.node != sender:
+                session = self.remote_sessions[user_id] = RemoteSession(self, sender, user_id)
+                self.game_world.attach_session(user_id, session)
+        elif kind == 'offline':
+            self.detach(msg['user_account_id'])
+        elif kind == 'session':
+            session = self.local_sessions.get(msg['user_account_id'])
+            if session is not None:
+                if msg['method'] == 'handle_hears':
+                    session.handle_hears(None, msg['payload'])
+                else:
+                    getattr(session, msg['method'])(msg['payload'])
+        elif kind == 'command':
+            await self.handle_remote_command(sender, msg)
+        elif kind == 'command_done':
+            future = self._pending.pop(msg['request_id'], None)
+            if future is not None and not future.done():
+                future.set_result(msg['error'])
+        elif kind == 'handoff':
+            await self.game_world.run_off_loop(self.take_over, sender, msg['user_account_id'])
+
+    def detach(self, user_account_id):
+        self.remote_sessions.pop(user_account_id, None)
+        self.game_world.detach_session(user_account_id)
+
+    def take_over(self, sender, user_account_id):
+        user_account = UserAccount.get_by_id(user_account_id)
+        self.logger.info('took over {} from node {}'.format(user_account.username, sender))
+        self.game_world.send_client_update(user_account)
+
+    def run_forwarded(self, msg):
+        player_obj = UserAccount.get_by_id(msg['user_account_id']).player_obj
+        root = self.game_world.dispatch_action(player_obj, msg['action'], msg['action_args'])
+        return player_obj, root
+
+    async def handle_remote_command(self, sender, msg):
+        error = None
+        player_obj = None
+        try:
+            player_obj, root = await self.game_world.run_off_loop(self.run_forwarded, msg)
+            await self.game_world.finished(root)
+        except (UserError, ClientError) as e:
+            error = str(e)
+        except Exception as e:
+            self.logger.error('failed to run forwarded command {}: {}'.format(msg, e))
+            error = 'Something went wrong.'
+        await self.bus.send(sender, {
+            'type': 'command_done',
+            'request_id': msg['request_id'],
+            'error': error})
+        if player_obj is not None:
+            await self.check_handoff(player_obj, self.node)
@@ -0,0 +1,80 @@
+"""permessage-deflate settings for client websockets.
+
+Most of what the server sends compresses well: STATE frames repeat room and
+object descriptions, OBJECT frames carry whole WITCH scripts and MAP frames are
+box drawing. Most of what it sends by count, though, is short: COMMAND OK,
+PONG, a line of something someone said. Deflating those costs CPU (and a
+flush's worth of framing bytes) for next to no savings, so frames shorter than
+TILDEMUSH_WS_DEFLATE_MIN_SIZE bytes go out uncompressed; the extension allows
+that per message, so it needs nothing from clients.
+
+The window bits and memory level bound the memory each connection's
+compressor holds on to (roughly 2**(window_bits + 2) + 2**(mem_level + 9)
+bytes) as well as how well it compresses; see benchmarks/deflate.py for the
+trade-off on recorded traffic.
+
+Outgoing frames can be recorded for that benchmark by setting
+TILDEMUSH_TRAFFIC_RECORD to a path; each is appended as a line of JSON."""
+import base64
+import json
+
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate, ServerPerMessageDeflateFactory)
+from websockets.framing import CTRL_OPCODES, OP_CONT
+
+from .config import (WS_DEFLATE, WS_DEFLATE_WINDOW_BITS, WS_DEFLATE_MEM_LEVEL,
+                     WS_DEFLATE_LEVEL, WS_DEFLATE_MIN_SIZE, TRAFFIC_RECORD)
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """PerMessageDeflate that leaves messages shorter than min_size alone."""
+    def __init__(self, *args, min_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        # websockets never fragments what it sends, so each data frame is a
+        # whole message.
+        if frame.opcode not in CTRL_OPCODES and frame.opcode != OP_CONT \
+           and len(frame.data) < self.min_size:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size=0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size)
+
+
+def serve_options():
+    """Keyword arguments for websockets.serve setting up compression."""
+    if not WS_DEFLATE:
+        return {'compression': None}
+    return {'extensions': [ThresholdDeflateFactory(
+        min_size=WS_DEFLATE_MIN_SIZE,
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={'memLevel': WS_DEFLATE_MEM_LEVEL, 'level': WS_DEFLATE_LEVEL})]}
+
+
+def record_frame(session, frame, path=TRAFFIC_RECORD):
+    """Appends an outgoing frame to the traffic recording, if there is one."""
+    if not path:
+        return
+    record = {'session': session}
+    if isinstance(frame, bytes):
+        record['data'] = base64.b64encode(frame).decode('ascii')
+    else:
+        record['text'] = frame
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
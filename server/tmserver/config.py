@@ -1,4 +1,6 @@
 from os import environ
+import json
+import os
 
 from playhouse.postgres_ext import PostgresqlExtDatabase
 
@@ -11,6 +13,156 @@ TEST_DB_NAME = DB_NAME + '_test'
 
 env = environ.get('TILDEMUSH_ENV', 'live')
 
+# How many distinct pieces of compiled WITCH code to keep in memory.
+WITCH_AST_CACHE_SIZE = int(environ.get('TILDEMUSH_WITCH_AST_CACHE_SIZE', 10000))
+
+# Boot time precompilation of every active object's script. The budget is in
+# seconds; whatever isn't compiled by then compiles lazily on first use.
+WARMUP_WORKERS = int(environ.get('TILDEMUSH_WARMUP_WORKERS', 0)) or None
+WARMUP_BUDGET = float(environ.get('TILDEMUSH_WARMUP_BUDGET', 30))
+
+# Limits for trial compiling a submitted REVISION in a child process. The
+# timeout is in seconds and the memory limit in bytes.
+REVISION_TIMEOUT = float(environ.get('TILDEMUSH_REVISION_TIMEOUT', 5))
+REVISION_MEMORY_LIMIT = int(environ.get('TILDEMUSH_REVISION_MEMORY_LIMIT', 512 * 1024 * 1024))
+
+# Bound on how many script engines are kept alive. Objects in rooms no player
+# has been in for HIBERNATE_AFTER seconds have their engines dropped too (0
+# disables that); they're rebuilt the next time something happens to them.
+ENGINE_CACHE_SIZE = int(environ.get('TILDEMUSH_ENGINE_CACHE_SIZE', 5000))
+HIBERNATE_AFTER = float(environ.get('TILDEMUSH_HIBERNATE_AFTER', 600))
+HIBERNATE_INTERVAL = float(environ.get('TILDEMUSH_HIBERNATE_INTERVAL', 60))
+
+# Whether database and world work runs on a dedicated thread instead of the
+# event loop (see dbthread.py), and how many pieces of it may queue up there.
+DB_THREAD = environ.get('TILDEMUSH_DB_THREAD', '') not in ('', '0')
+DB_QUEUE_SIZE = int(environ.get('TILDEMUSH_DB_QUEUE_SIZE', 256))
+
+# Rate limits on what clients send; see ratelimit.py. Off by default in tests,
+# which send commands as fast as they can.
+RATE_LIMIT = environ.get('TILDEMUSH_RATE_LIMIT', '0' if env == 'test' else '1') not in ('', '0')
+RATE_LIMITS = json.loads(environ.get('TILDEMUSH_RATE_LIMITS', '{}'))
+RATE_LIMIT_MODE = environ.get('TILDEMUSH_RATE_LIMIT_MODE', 'reject')
+RATE_LIMIT_MAX_DELAY = float(environ.get('TILDEMUSH_RATE_LIMIT_MAX_DELAY', 2))
+
+# How many client messages are handled at once, in all and per priority
+# class; see scheduler.py. Bulk messages that have waited MAX_WAIT seconds go
+# ahead of interactive ones.
+SCHEDULER_CONCURRENCY = int(environ.get('TILDEMUSH_SCHEDULER_CONCURRENCY', 16))
+SCHEDULER_LIMITS = json.loads(environ.get('TILDEMUSH_SCHEDULER_LIMITS', '{"bulk": 4}'))
+SCHEDULER_MAX_WAIT = float(environ.get('TILDEMUSH_SCHEDULER_MAX_WAIT', 2))
+
+# Load shedding by event loop lag; see overload.py. Lags are in seconds; 0
+# turns that kind of shedding off.
+OVERLOAD_INTERVAL = float(environ.get('TILDEMUSH_OVERLOAD_INTERVAL', 0.1))
+OVERLOAD_PUSH_LAG = float(environ.get('TILDEMUSH_OVERLOAD_PUSH_LAG', 0.1))
+OVERLOAD_BULK_LAG = float(environ.get('TILDEMUSH_OVERLOAD_BULK_LAG', 0.25))
+OVERLOAD_LOGIN_LAG = float(environ.get('TILDEMUSH_OVERLOAD_LOGIN_LAG', 0.5))
+OVERLOAD_RETRY_AFTER = int(environ.get('TILDEMUSH_OVERLOAD_RETRY_AFTER', 5))
+
+# Report what's on the event loop's stack whenever it goes this many
+# milliseconds without turning; see watchdog.py. 0 (the default) disables it.
+WATCHDOG_MS = int(environ.get('TILDEMUSH_WATCHDOG_MS', 0))
+WATCHDOG_FILE = environ.get('TILDEMUSH_WATCHDOG_FILE', 'watchdog.log')
+WATCHDOG_MAX_BYTES = int(environ.get('TILDEMUSH_WATCHDOG_MAX_BYTES', 10 * 1024 * 1024))
+WATCHDOG_BACKUPS = int(environ.get('TILDEMUSH_WATCHDOG_BACKUPS', 3))
+
+# Serve metrics in the Prometheus text format on this port (see stats.py); 0,
+# the default, doesn't.
+STATS_PORT = int(environ.get('TILDEMUSH_STATS_PORT', 0))
+STATS_BIND = environ.get('TILDEMUSH_STATS_BIND', '127.0.0.1')
+
+# Log commands that take at least this many milliseconds, with the queries and
+# WITCH handlers they ran, to a JSON lines file or (if it's 'db') the Log
+# table; see slowlog.py. 0, the default, doesn't.
+SLOW_COMMAND_MS = float(environ.get('TILDEMUSH_SLOW_COMMAND_MS', 0))
+SLOW_COMMAND_LOG = environ.get('TILDEMUSH_SLOW_COMMAND_LOG', 'slow-commands.jsonl')
+
+# Write a trace of what each message from a client causes to this file, in
+# Chrome's trace event format; see tracing.py. The sample is the fraction of
+# messages traced.
+TRACE_FILE = environ.get('TILDEMUSH_TRACE_FILE')
+TRACE_SAMPLE = float(environ.get('TILDEMUSH_TRACE_SAMPLE', 1))
+
+# A god's /profile samples every thread's stack this often (in seconds) for
+# at most this long, writing collapsed stacks for flame graphs to this
+# directory; see profiler.py.
+PROFILE_INTERVAL = float(environ.get('TILDEMUSH_PROFILE_INTERVAL', 0.01))
+PROFILE_MAX_SECONDS = float(environ.get('TILDEMUSH_PROFILE_MAX_SECONDS', 60))
+PROFILE_DIR = environ.get('TILDEMUSH_PROFILE_DIR', '.')
+
+# The most commands a client may send in one BATCH message.
+MAX_BATCH = int(environ.get('TILDEMUSH_MAX_BATCH', 32))
+
+# permessage-deflate for client websockets; see compression.py. Frames shorter
+# than the minimum size (in bytes) are sent uncompressed.
+WS_DEFLATE = environ.get('TILDEMUSH_WS_DEFLATE', '1') not in ('', '0')
+WS_DEFLATE_WINDOW_BITS = int(environ.get('TILDEMUSH_WS_DEFLATE_WINDOW_BITS', 15))
+WS_DEFLATE_MEM_LEVEL = int(environ.get('TILDEMUSH_WS_DEFLATE_MEM_LEVEL', 5))
+WS_DEFLATE_LEVEL = int(environ.get('TILDEMUSH_WS_DEFLATE_LEVEL', 6))
+WS_DEFLATE_MIN_SIZE = int(environ.get('TILDEMUSH_WS_DEFLATE_MIN_SIZE', 128))
+TRAFFIC_RECORD = environ.get('TILDEMUSH_TRAFFIC_RECORD')
+
+# How many worker processes run WITCH scripts. 0 runs them in the server
+# process itself.
+WITCH_WORKERS = int(environ.get('TILDEMUSH_WITCH_WORKERS', 0))
+
+# A directory only the server's user can get into, for the unix sockets its
+# processes talk over; see util.private_dir. It's under $XDG_RUNTIME_DIR where
+# there is one, never anywhere shared like /tmp where someone else could make
+# it first.
+RUNTIME_DIR = environ.get('TILDEMUSH_RUNTIME_DIR', os.path.join(
+    environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.cache'), 'tildemush'))
+
+# Where the game core listens for websocket front-end processes; see
+# frontend.py.
+FRONTEND_SOCKET = environ.get('TILDEMUSH_FRONTEND_SOCKET', os.path.join(RUNTIME_DIR, 'core.sock'))
+
+# Cluster mode; see cluster.py. Each node is started with its own
+# TILDEMUSH_CLUSTER_NODE (0 through TILDEMUSH_CLUSTER_NODES - 1) and port.
+# Regions is a JSON object mapping room shortnames or usernames to nodes, eg
+# {"god/foyer": 0, "vilmibm": 1}.
+CLUSTER_NODE = int(environ.get('TILDEMUSH_CLUSTER_NODE', 0))
+CLUSTER_NODES = int(environ.get('TILDEMUSH_CLUSTER_NODES', 1))
+CLUSTER_REGIONS = json.loads(environ.get('TILDEMUSH_CLUSTER_REGIONS', '{}'))
+CLUSTER_SOCKET_DIR = environ.get('TILDEMUSH_CLUSTER_SOCKET_DIR', os.path.join(RUNTIME_DIR, 'cluster'))
+
+# Which evaluator runs WITCH code: 'asteval' walks the AST in Python on every
+# call; 'bytecode' validates the AST and compiles it to a real code object once.
+WITCH_BACKEND = environ.get('TILDEMUSH_WITCH_BACKEND', 'asteval')
+
+# Per invocation budgets for WITCH handlers, as (max evaluated AST nodes, max
+# seconds). Scripts authored by gods get the god budget. Individual authors can
+# be given their own budget with a JSON object like {"vilmibm": [500000, 1.0]}.
+WITCH_BUDGET = (
+    int(environ.get('TILDEMUSH_WITCH_STEP_LIMIT', 100000)),
+    float(environ.get('TILDEMUSH_WITCH_TIME_LIMIT', 0.25)))
+WITCH_GOD_BUDGET = (
+    int(environ.get('TILDEMUSH_WITCH_GOD_STEP_LIMIT', 1000000)),
+    float(environ.get('TILDEMUSH_WITCH_GOD_TIME_LIMIT', 2.0)))
+WITCH_AUTHOR_BUDGETS = {
+    username: tuple(budget)
+    for username, budget
+    in json.loads(environ.get('TILDEMUSH_WITCH_AUTHOR_BUDGETS', '{}')).items()}
+# After this many budget violations a script revision is quarantined: its
+# handlers are dropped until the author saves a new revision. 0 disables it.
+WITCH_QUARANTINE_AFTER = int(environ.get('TILDEMUSH_WITCH_QUARANTINE_AFTER', 3))
+
+# Limits on cascades of actions caused by WITCH scripts reacting to each other.
+# Depth is how many reactions removed from the original command an action is;
+# per root is the total number of actions one command may cause; per tick is
+# how many queued actions run before other work gets a turn on the event loop.
+EVENT_MAX_DEPTH = int(environ.get('TILDEMUSH_EVENT_MAX_DEPTH', 8))
+EVENT_MAX_PER_ROOT = int(environ.get('TILDEMUSH_EVENT_MAX_PER_ROOT', 100))
+EVENTS_PER_TICK = int(environ.get('TILDEMUSH_EVENTS_PER_TICK', 50))
+
+# Every WITCH_SLICE_STEPS steps a running handler hands the event loop back so
+# other sessions' commands aren't stuck behind it (0 disables it). At most
+# WITCH_SLICE_THREADS actions can be suspended like this at once; beyond that
+# they run to completion on the loop as before.
+WITCH_SLICE_STEPS = int(environ.get('TILDEMUSH_WITCH_SLICE_STEPS', 5000))
+WITCH_SLICE_THREADS = int(environ.get('TILDEMUSH_WITCH_SLICE_THREADS', 8))
+
 def get_db():
     db = None
 
@@ -1,17 +1,36 @@
 import asyncio
+from collections import Counter
 import logging
 import json
 import re
+import threading
+import time
 
 import websockets as ws
 
+from .actors import RoomLocks
+from .compression import record_frame, serve_options
+from .config import (DB_THREAD, HIBERNATE_AFTER, HIBERNATE_INTERVAL, MAX_BATCH, RATE_LIMIT,
+                     STATS_BIND, STATS_PORT)
+from .dbthread import DBExecutor
 from .errors import ClientError, UserValidationError, RevisionError, ClientQuit, UserError
+from .frontend import CoreBridge
+from .metrics import METRICS
+from .overload import OVERLOAD
+from .ratelimit import RATE_LIMITER
+from .scheduler import INTERACTIVE, Scheduler, lent, priority_of
+from .tracing import TRACER
+from . import stats
+from .watchdog import WATCHDOG
+from .wire import subprotocols, wire_for
 from .models import UserAccount
+from .sandbox import trial_revision_async
 
 LOGIN_RE = re.compile(r'^LOGIN ([^:\n]+?):(.+)$')
 REGISTER_RE = re.compile(r'^REGISTER ([^:\n]+?):(.+)$')
 COMMAND_RE = re.compile(r'^COMMAND ([^ ]+) ?(.*)$')
 REVISION_RE = re.compile(r'^REVISION (.+)$')
+BATCH_RE = re.compile(r'^BATCH (.+)$', re.DOTALL)
 REVISION_KEYS = ('shortname', 'code', 'current_rev')
 
 LOOP = asyncio.get_event_loop()
@@ -25,8 +44,31 @@ class UserSession:
         self.logger = logger
         self.loop = loop
         self.websocket = websocket
+        # how messages to and from this client are encoded; see wire.py
+        self.wire = wire_for(getattr(websocket, 'subprotocol', None))
         self.game_world = game_world
         self.user_account = None
+        # whether the client logged in with a request id, asking for replies
+        # to carry them; see GameServer.handle_message.
+        self.framed = False
+        # sessions are made on the loop's thread; sends queued from any other
+        # (ie, the database thread) have to be handed over thread safely.
+        self.loop_thread = threading.get_ident()
+        # seconds the message being handled has spent waiting off the loop
+        self.waited = 0
+        # the message being handled, for the watchdog, what it's cost so far
+        # (see stats.py) and its trace span (see tracing.py)
+        self.handling = None
+        self.tally = None
+        self.span = None
+        # its scheduler slot, once it has one; see scheduler.py
+        self.slot = None
+        # while shedding load, the latest STATE waiting to go out; see
+        # handle_client_update.
+        self._queued_state = None
+        self._state_lock = threading.Lock()
+        # sends queued with _soon that haven't gone out yet; see flush
+        self._sending = set()
 
     @property
     def associated(self):
@@ -39,31 +81,75 @@ class UserSession:
     def handle_hears(self, sender_obj, message):
         # we will need to support basic abuse control like blocking other users, so having a
         # sender_obj here might be useful for interaction filtering. rn it's unused though.
-        asyncio.ensure_future(
-            self.client_send(message),
-            loop=self.loop)
+        self.send_soon(message, verb='TEXT')
 
     def handle_client_update(self, client_state):
-        asyncio.ensure_future(
-            self.client_send('STATE {}'.format(json.dumps(client_state))),
-            loop=self.loop)
+        if not OVERLOAD.shedding_pushes:
+            self.send_soon('STATE', payload=client_state)
+            return
+        # under load, a STATE that's queued but not yet sent is brought up to
+        # date instead of another following it.
+        with self._state_lock:
+            already_queued = self._queued_state is not None
+            self._queued_state = client_state
+        if already_queued:
+            OVERLOAD.shed('STATE')
+        else:
+            self._soon(self._send_queued_state())
+
+    async def _send_queued_state(self):
+        with self._state_lock:
+            client_state, self._queued_state = self._queued_state, None
+        await self.client_send('STATE', payload=client_state)
 
     def send_object_state(self, object_state):
-        asyncio.ensure_future(
-            self.client_send('OBJECT {}'.format(json.dumps(object_state))),
-            loop=self.loop)
+        self.send_soon('OBJECT', payload=object_state)
 
-    async def client_send(self, message):
-        self.logger.info("-> '{}' to {}".format(message[0:100], self))
-        await self.websocket.send(message)
+    def send_soon(self, message, **kwargs):
+        kwargs.setdefault('trace_parent', TRACER.current())
+        self._soon(self.client_send(message, **kwargs))
+
+    def _soon(self, coro):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self._soon, coro)
+            return
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def flush(self):
+        """Waits for everything queued to be sent to this client so far (and
+        anything sending it queues) to have gone out."""
+        while self._sending:
+            await asyncio.wait(list(self._sending))
+
+    async def client_send(self, message, payload=None, request_id=None, verb=None,
+                          trace_parent=None):
+        """Sends message, encoded however this client asked for; see
+        wire.py for what the arguments mean. If whatever caused it is being
+        traced, trace_parent is its span (by default, the span of the message
+        this client sent that's being handled)."""
+        frame = self.wire.encode(message, payload=payload, request_id=request_id, verb=verb)
+        if self.wire.binary:
+            self.logger.info("-> '{}' ({} bytes) to {}".format(message[0:100], len(frame), self))
+        else:
+            self.logger.info("-> '{}' to {}".format(frame[0:100], self))
+        record_frame(id(self), frame)
+        kind = stats.frame_kind(message, verb)
+        stats.sent(kind, len(frame), self.tally)
+        span = TRACER.open('frame', kind, trace_parent or self.span, to=str(self), bytes=len(frame))
+        try:
+            await self.websocket.send(frame)
+        finally:
+            TRACER.close(span)
 
     def dispatch_action(self, action, action_args):
-        self.game_world.dispatch_action(
+        return self.game_world.dispatch_action(
             self.user_account.player_obj,
             action,
             action_args)
 
-    def handle_revision(self, shortname, code, current_rev):
+    def handle_revision(self, shortname, code, current_rev, trial=None):
         return_payload = None
         revision_exception = None
         try:
@@ -71,7 +157,8 @@ class UserSession:
                 self.user_account.player_obj,
                 shortname,
                 code,
-                current_rev)
+                current_rev,
+                trial=trial)
         except RevisionError as e:
             return_payload = e.payload
             revision_exception = str(e)
@@ -111,8 +198,9 @@ class ConnectionMap:
 
 
 class GameServer:
-    def __init__(self, game_world, loop=LOOP, bind='127.0.0.1', port=10014, logger=None):
+    def __init__(self, game_world, loop=LOOP, bind='127.0.0.1', port=10014, logger=None, cluster=None):
         self.loop = loop
+        self.cluster = cluster
         self.game_world = game_world
         if logger is None:
             logger = logging.getLogger('tmserver')
@@ -120,71 +208,315 @@ class GameServer:
         self.bind = bind
         self.port = port
         self.connections = ConnectionMap()
+        self.room_locks = RoomLocks()
+        self.scheduler = Scheduler()
+        self.game_world.set_loop(loop)
+        self.game_world.set_room_locks(self.room_locks)
+        self.db_executor = None
+        if DB_THREAD:
+            self.db_executor = DBExecutor()
+            self.game_world.set_executor(self.db_executor)
+        self.rate_limiter = RATE_LIMITER if RATE_LIMIT else None
+
+    async def db(self, user_session, fn, *args):
+        """Runs fn(*args) on the database thread if there is one (see
+        dbthread.py), otherwise right here on the loop. Time spent waiting on
+        it is recorded against user_session so handle_message can tell how
+        long the loop itself was busy."""
+        started = time.monotonic()
+        WATCHDOG.note(str(user_session), user_session.handling)
+        span = TRACER.open('db', getattr(fn, '__name__', 'db'), user_session.span)
+        try:
+            return await self.game_world.run_off_loop(
+                TRACER.within(span, stats.tallied(user_session.tally, fn)), *args)
+        finally:
+            TRACER.close(span)
+            if self.db_executor is not None:
+                user_session.waited += time.monotonic() - started
+            WATCHDOG.note(str(user_session), user_session.handling)
 
     async def handle_connection(self, websocket, path):
         self.logger.info('Handling initial connection at path {}'.format(path))
+        await self.serve_messages(websocket, websocket)
+
+    async def serve_messages(self, websocket, messages):
+        """Handles each message from the async iterable messages in turn,
+        replying on websocket. For a direct connection they're one and the
+        same; see frontend.py for when they aren't."""
         user_session = UserSession(self.loop, self.game_world, websocket)
         self.logger.info('Registering user context {}'.format(user_session))
         self.connections.add(websocket, user_session)
         try:
-            async for message in websocket:
+            async for message in messages:
                 await self.handle_message(user_session, message)
         except (ws.exceptions.ConnectionClosed, ClientQuit):
             self.logger.info('Client disconnect {}'.format(user_session))
-            user_session.handle_disconnect()
+            await self.db(user_session, user_session.handle_disconnect)
             self.connections.remove(websocket)
+            if self.rate_limiter is not None and not user_session.associated:
+                self.rate_limiter.forget(self.throttle_key(user_session))
+            if self.cluster is not None and user_session.associated:
+                await self.cluster.session_closed(user_session.user_account.id)
 
     async def handle_message(self, user_session, message):
+        """Handles message, recording how long it kept the event loop busy:
+        its total time less whatever it spent throttled or awaiting a
+        scheduler slot (see scheduler.py), the database thread or room
+        locks."""
+        started = time.monotonic()
+        user_session.waited = 0
+        try:
+            request_id, message = user_session.wire.decode(message)
+        except ClientError as e:
+            await user_session.client_send('ERROR: {}'.format(e))
+            return
+        priority = priority_of(message)
+        tally = user_session.tally = Counter()
+        span = user_session.span = TRACER.trace(
+            'message', stats.verb_label(message), who=str(user_session), request_id=request_id)
+        try:
+            user_session.handling = message
+            WATCHDOG.note(str(user_session), message)
+            await self._handle_message(user_session, message, request_id, priority)
+        finally:
+            if user_session.slot is not None:
+                user_session.slot.release()
+                user_session.slot = None
+            elapsed = time.monotonic() - started
+            METRICS.observe('message_seconds.{}'.format(priority), elapsed)
+            stats.record('verb', stats.verb_label(message), elapsed, tally)
+            TRACER.close(span)
+            user_session.tally = user_session.handling = user_session.span = None
+            WATCHDOG.note(str(user_session), None)
+            blocked = elapsed - user_session.waited
+            verb = stats.verb_label(message)
+            METRICS.incr('loop_blocked_seconds.{}'.format(verb), blocked)
+            METRICS.incr('loop_blocked_messages.{}'.format(verb))
+
+    async def _handle_message(self, user_session, message, request_id=None,
+                              priority=INTERACTIVE):
         self.logger.info("<- '{}' from {}".format(
             message, user_session))
+        reply = self.replier(user_session, request_id)
         try:
+            retry_after = OVERLOAD.refuse(message)
+            if retry_after is not None:
+                await reply('BUSY {}'.format(retry_after))
+                return
+            await self.throttle(user_session, message)
+            # only now, past its rate limit, does it compete with everyone
+            # else's messages for the loop
+            await self.take_slot(user_session, priority)
             if message.startswith('LOGIN'):
-                self.handle_login(user_session, message)
+                await self.db(user_session, self.handle_login, user_session, message)
+                user_session.framed = request_id is not None
+                if self.cluster is not None:
+                    await self.cluster.session_opened(user_session)
                 self.logger.info('telling {} about having logged them in'.format(
                     user_session.user_account.username))
-                await user_session.client_send('LOGIN OK')
+                await reply('LOGIN OK')
             elif message.startswith('REGISTER'):
                 try:
-                    self.handle_registration(user_session, message)
-                    await user_session.client_send('REGISTER OK')
+                    await self.db(user_session, self.handle_registration, user_session, message)
+                    await reply('REGISTER OK')
                 except UserValidationError as e:
-                    await user_session.client_send('ERROR: {}'.format(e))
+                    await reply('ERROR: {}'.format(e))
             elif message.startswith('COMMAND'):
-                try:
-                    self.handle_command(user_session, message)
-                except UserError as e:
-                    await user_session.client_send('{{red}}{}{{/}}'.format(e))
-                else:
-                    await user_session.client_send('COMMAND OK')
+                await self.run_command_message(user_session, message, reply)
+            elif message.startswith('BATCH'):
+                await self.handle_batch(user_session, message, request_id, reply)
             elif message.startswith('REFRESH'):
-                self.handle_refresh(user_session)
+                await self.db(user_session, self.handle_refresh, user_session)
             elif message.startswith('REVISION'):
-                revision_result, revision_exception = self.handle_revision(user_session, message)
+                # compiling happens in a child process so other sessions keep
+                # moving while we wait on it.
+                waiting = time.monotonic()
+                trial = await self.trial_revision(user_session, message)
+                user_session.waited += time.monotonic() - waiting
+                revision_result, revision_exception = await self.db(
+                    user_session, self.handle_revision, user_session, message, trial)
                 if revision_exception:
-                    await user_session.client_send('ERROR: {}'.format(revision_exception))
-                user_session.send_object_state(revision_result)
+                    await reply('ERROR: {}'.format(revision_exception))
+                # queued rather than awaited so it goes out after the STATE
+                # updates the revision caused, as send_object_state would.
+                asyncio.ensure_future(user_session.client_send(
+                    'OBJECT', payload=revision_result, request_id=request_id), loop=self.loop)
             elif message.startswith('MAP'):
                 # For now, we return a map of the room a user is currently in +
                 # what they can reach in 2 hops. In the future this message
                 # could include a room to arbitrarily map from (ie as a user
                 # scrolls the map client side).
-                rendered_map = self.handle_map(user_session)
-                await user_session.client_send('MAP\n{}'.format(rendered_map))
+                rendered_map = await self.db(user_session, self.handle_map, user_session)
+                await reply('MAP\n{}'.format(rendered_map))
             elif message.startswith('QUIT'):
                 self.logger.info('Client quit {}'.format(user_session))
                 raise ClientQuit()
             elif message.startswith('PING'):
-                await user_session.client_send('PONG')
+                await reply('PONG')
             else:
                 raise ClientError('message not understood')
         except ClientError as e:
-            await user_session.client_send('ERROR: {}'.format(e))
+            await reply('ERROR: {}'.format(e))
+
+    def replier(self, user_session, request_id, flush=False):
+        """Returns a coroutine function sending replies to the request
+        request_id, tagged with its id. Anything sent otherwise (what a player
+        hears, STATE updates) is untagged, so clients can tell a reply from
+        everything else. With flush, whatever was queued for the client goes
+        out before each reply."""
+        async def reply(message):
+            if flush:
+                await user_session.flush()
+            await user_session.client_send(message, request_id=request_id)
+        return reply
+
+    async def take_slot(self, user_session, priority):
+        """Waits for the scheduler to give user_session a slot to handle its
+        message in; handle_message gives it back."""
+        waiting = time.monotonic()
+        slot = self.scheduler.slot(priority)
+        await slot.acquire()
+        user_session.slot = slot
+        waited = time.monotonic() - waiting
+        user_session.waited += waited
+        METRICS.observe('scheduler_wait_seconds.{}'.format(priority), waited)
+
+    def throttle_key(self, user_session):
+        if user_session.associated:
+            return user_session.user_account.username
+        return 'session-{}'.format(id(user_session))
+
+    async def throttle(self, user_session, message):
+        """Holds message until it's within its sender's rate limits or raises
+        ClientError if it won't be soon enough; see ratelimit.py."""
+        if self.rate_limiter is None:
+            return
+        client = self.throttle_key(user_session)
+        wait = self.rate_limiter.check(client, message)
+        if wait == 0:
+            return
+        if self.rate_limiter.mode == 'delay' and wait <= self.rate_limiter.max_delay:
+            self.rate_limiter.record(client, message, 'delayed')
+            waiting = time.monotonic()
+            # others may use up the allowance while we sleep, so the wait can
+            # stretch; it's still only ever held up to max_delay in all
+            deadline = waiting + self.rate_limiter.max_delay
+            while wait and time.monotonic() + wait <= deadline:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.check(client, message)
+            user_session.waited += time.monotonic() - waiting
+            if not wait:
+                return
+        self.rate_limiter.record(client, message, 'rejected')
+        raise ClientError('throttled; try again in {:.1f}s'.format(wait))
+
+    async def run_command_message(self, user_session, message, reply):
+        """Handles a COMMAND message, replying COMMAND OK once it's run or
+        with what went wrong. Returns whether it went OK."""
+        try:
+            room_ids, exclusive = await self.db(
+                user_session, self.command_rooms, user_session, message)
+            while True:
+                waiting = time.monotonic()
+                hold = self.room_locks.hold(room_ids, exclusive)
+                # waiting on the rooms isn't work, so someone else may as
+                # well have the slot meanwhile
+                async with lent(user_session.slot):
+                    await hold.acquire()
+                try:
+                    user_session.waited += time.monotonic() - waiting
+                    # the sender, or where they're headed, may have changed
+                    # while we waited for the rooms
+                    room_ids, exclusive = await self.db(
+                        user_session, self.command_rooms, user_session, message)
+                    if hold.covers(room_ids, exclusive):
+                        if self.cluster is None:
+                            root = await self.db(
+                                user_session, self.handle_command, user_session, message)
+                        else:
+                            root = await self.handle_cluster_command(user_session, message)
+                        break
+                finally:
+                    await hold.release()
+            # a command queued behind (or itself) an action suspended partway
+            # through finishes later, without holding the rooms
+            waiting = time.monotonic()
+            await self.game_world.finished(root)
+            user_session.waited += time.monotonic() - waiting
+        except UserError as e:
+            await reply('{{red}}{}{{/}}'.format(e))
+            return False
+        await reply('COMMAND OK')
+        return True
+
+    async def handle_batch(self, user_session, message, request_id, reply):
+        """Runs each COMMAND in a BATCH message in order, as though they'd
+        been sent one by one. The reply to the nth (from 0) is tagged with the
+        batch's request id plus `.n`. The first command to fail stops the
+        batch; the batch itself gets BATCH OK or BATCH STOPPED n.
+
+        Only sessions that logged in with a request id may send batches."""
+        if not user_session.framed or request_id is None:
+            raise ClientError('BATCH needs request ids; log in with one to use it')
+        commands = self.parse_batch(message)
+        # each command's reply, and the batch's, come after what it caused,
+        # so a client reading up to BATCH OK has seen everything
+        for i, command in enumerate(commands):
+            command_reply = self.replier(user_session, '{}.{}'.format(request_id, i), flush=True)
+            try:
+                async with lent(user_session.slot):
+                    await self.throttle(user_session, command)
+                ok = await self.run_command_message(user_session, command, command_reply)
+            except ClientError as e:
+                await command_reply('ERROR: {}'.format(e))
+                ok = False
+            if not ok:
+                await user_session.flush()
+                await reply('BATCH STOPPED {}'.format(i))
+                return
+        await user_session.flush()
+        await reply('BATCH OK')
+
+    def parse_batch(self, message):
+        """Given a batch message like BATCH ["COMMAND go north", "COMMAND go
+        east"], parse and return its commands."""
+        match = BATCH_RE.fullmatch(message)
+        if match is None:
+            raise ClientError('malformed batch message: {}'.format(message))
+        try:
+            commands = json.loads(match.groups()[0])
+        except json.decoder.JSONDecodeError:
+            raise ClientError('batch payload must be JSON')
+        if not isinstance(commands, list) \
+           or not all(isinstance(c, str) and c.startswith('COMMAND') for c in commands):
+            raise ClientError('a batch is a list of COMMAND messages')
+        if len(commands) > MAX_BATCH:
+            raise ClientError('at most {} commands per batch'.format(MAX_BATCH))
+        return commands
 
     def handle_command(self, user_session, message):
         if not user_session.associated:
             raise ClientError('not logged in')
         action, action_args = self.parse_command(message)
-        user_session.dispatch_action(action, action_args)
+        return user_session.dispatch_action(action, action_args)
+
+    async def handle_cluster_command(self, user_session, message):
+        """Like handle_command, but runs the command on whichever node of the
+        cluster owns the sender's room."""
+        if not user_session.associated:
+            raise ClientError('not logged in')
+        action, action_args = self.parse_command(message)
+        return await self.cluster.run_command(user_session, action, action_args)
+
+    def command_rooms(self, user_session, message):
+        """Which rooms a COMMAND message needs to hold; see actors.py. Messages
+        handle_command would reject hold nothing."""
+        if not user_session.associated:
+            return (), False
+        match = COMMAND_RE.fullmatch(message)
+        if match is None:
+            return (), False
+        return self.game_world.rooms_for(user_session.user_account.player_obj, *match.groups())
 
     def parse_command(self, message):
         match = COMMAND_RE.fullmatch(message)
@@ -233,11 +565,17 @@ class GameServer:
             raise ClientError('malformed registration message: {}'.format(message))
         return match.groups()
 
-    def handle_revision(self, user_session, message):
+    async def trial_revision(self, user_session, message):
+        if not user_session.associated:
+            raise ClientError('not logged in')
+        payload = self.parse_revision(message)
+        return await trial_revision_async(self.loop, payload['code'])
+
+    def handle_revision(self, user_session, message, trial=None):
         if not user_session.associated:
             raise ClientError('not logged in')
         payload = self.parse_revision(message)
-        return user_session.handle_revision(**payload)
+        return user_session.handle_revision(trial=trial, **payload)
 
     def parse_revision(self, message):
         match = REVISION_RE.fullmatch(message)
@@ -262,13 +600,54 @@ class GameServer:
         return user_session.handle_map()
 
 
-    def start(self):
+    def start(self, boot_started=None, frontends=0):
+        """Starts accepting connections and runs the event loop forever. If
+        boot_started (a time.monotonic() timestamp) is passed, logs how long it
+        took from then until we could accept a connection. With frontends,
+        that many front-end processes (already started with
+        frontend.start_frontends) accept connections instead."""
         self.logger.info('Starting up asyncio loop')
-        # I'm cargo culting these asyncio calls from the websockets
-        # documentation
-        self.loop.run_until_complete(
-            ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop))
+        if frontends:
+            self.loop.run_until_complete(CoreBridge(self, logger=self.logger).start())
+            self.logger.info('relaying for {} front-ends'.format(frontends))
+        else:
+            # I'm cargo culting these asyncio calls from the websockets
+            # documentation
+            self.loop.run_until_complete(
+                ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop,
+                         subprotocols=subprotocols(), **serve_options()))
+        if self.cluster is not None:
+            self.loop.run_until_complete(self.cluster.start())
+            self.logger.info('node {} of {} in the cluster'.format(
+                self.cluster.node, self.cluster.nodes))
+        if boot_started is not None:
+            self.logger.info('accepting connections on {}:{} {:.3f}s after boot'.format(
+                self.bind, self.port, time.monotonic() - boot_started))
+        if HIBERNATE_AFTER:
+            self.loop.call_later(HIBERNATE_INTERVAL, self.hibernate)
+        OVERLOAD.start(self.loop)
+        WATCHDOG.start(self.loop)
+        if STATS_PORT:
+            self.loop.run_until_complete(stats.serve(self.loop, STATS_BIND, STATS_PORT))
+            self.logger.info('serving metrics on {}:{}'.format(STATS_BIND, STATS_PORT))
         self.loop.run_forever()
 
+    def hibernate(self):
+        """Periodically drops the script engines of objects in rooms nobody's
+        been in for a while."""
+        asyncio.ensure_future(self._hibernate(), loop=self.loop)
+
+    async def _hibernate(self):
+        try:
+            dropped = await self.game_world.run_off_loop(self.game_world.hibernate_idle_rooms)
+            if dropped:
+                self.logger.info('hibernated {} engines; {} still live'.format(
+                    dropped, METRICS.get('engine_cache_size')))
+        except Exception as e:
+            self.logger.error('failed to hibernate idle rooms: {}'.format(e))
+        finally:
+            self.loop.call_later(HIBERNATE_INTERVAL, self.hibernate)
+
     def _get_ws_server(self):
-        return ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop)
+        return ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop,
+                        subprotocols=subprotocols(), **serve_options())
@@ -0,0 +1,57 @@
+"""Running database work off of the event loop.
+
+peewee is synchronous, and so is everything in the world built on it, so any
+command that touches the database blocks the loop (and every other client's
+I/O) while it runs. With TILDEMUSH_DB_THREAD set, GameServer instead hands
+each message's database and world work to a single dedicated thread and
+awaits the result.
+
+There is only one such thread on purpose: it keeps the world as single
+threaded as it's always been, just on a different thread than the loop, and
+since each piece of work runs start to finish on it, atomic() blocks keep
+their usual transactional behavior on that thread's connection. At most
+queue_size pieces of work wait for it at once; beyond that, callers wait
+their turn to queue."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .config import DB_QUEUE_SIZE
+
+
+class DBExecutor:
+    def __init__(self, queue_size=DB_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tildemush-db')
+        self._slots = None
+
+    @property
+    def slots(self):
+        # made on first use for the same reason as RoomLocks.cond
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+        return self._slots
+
+    async def run(self, fn, *args):
+        """Runs fn(*args) on the database thread and returns its result,
+        raising whatever it raised."""
+        async with self.slots:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+
+    def submit(self, fn, *args):
+        """Queues fn(*args) without waiting on it or on the queue bound; for
+        work the world schedules for itself, which may be called on the
+        database thread. Nobody's waiting on the result, so errors are
+        logged."""
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.getLogger('tmserver').error(
+            'database thread work failed: {}'.format(future.exception()))
@@ -20,5 +20,8 @@ class UserError(Exception):
 
 class ClientQuit(Exception): pass
 class WitchError(Exception): pass
+class WitchBudgetExceeded(WitchError):
+    """Raised from inside the WITCH evaluator when a handler evaluates too many
+    AST nodes or runs past its deadline."""
 class UserValidationError(Exception):
     code = 8
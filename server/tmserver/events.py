@@ -0,0 +1,122 @@
+"""The queue of actions waiting to be dispatched in the game world.
+
+When a WITCH handler says or does something, or tells its sender to do
+something, that's a new action that every nearby object gets to react to,
+which can cause more actions and so on. Rather than running these cascades
+recursively on the Python stack, GameWorld queues them here as events. Each
+event remembers the command that caused it (its root) and how many steps
+removed from that command it is (its depth) so we can cut off runaway
+cascades."""
+from collections import deque
+import itertools
+import logging
+import threading
+
+from .config import EVENT_MAX_DEPTH, EVENT_MAX_PER_ROOT
+
+_root_ids = itertools.count(1)
+
+
+class CascadeRoot:
+    """Represents the command at the root of a cascade of events. Whoever
+    sent the command can wait for it to have run with when_finished, since it
+    may be queued or suspended for a while first.
+
+    The STATE pushes its events call for are held in updates until none of
+    them is left running, so they still go out after what the cascade said,
+    as they did when it ran recursively."""
+    def __init__(self, sender_obj, action):
+        self.id = next(_root_ids)
+        self.sender_obj = sender_obj
+        self.action = action
+        self.events = 0
+        self.dropped = 0
+        # events queued or started and not yet finished
+        self.running = 0
+        self.updates = []
+        self.finished = False
+        self.error = None
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def finish(self, error=None):
+        """Records that the command itself (not necessarily everything it
+        caused) has run, failing with error if it raised one."""
+        with self._lock:
+            self.finished = True
+            self.error = error
+            waiters, self._waiters = self._waiters, []
+        for fn in waiters:
+            fn(error)
+
+    def when_finished(self, fn):
+        """Calls fn(error) once the command has run, or right away if it
+        already has."""
+        with self._lock:
+            if not self.finished:
+                self._waiters.append(fn)
+                return
+        fn(self.error)
+
+    def __str__(self):
+        return 'CascadeRoot<{} {} {}>'.format(self.id, self.sender_obj, self.action)
+
+
+class Event:
+    def __init__(self, sender_obj, action, action_args, depth, root, cause=None):
+        self.sender_obj = sender_obj
+        self.action = action
+        self.action_args = action_args
+        self.depth = depth
+        self.root = root
+        # the id of the place it happens in; see GameWorld.place_of_event
+        self.place = None
+        # the trace span that dispatched this event, if it's being traced;
+        # see tracing.py
+        self.cause = cause
+
+    def __str__(self):
+        return 'Event<{} {} depth={} root={}>'.format(
+            self.sender_obj, self.action, self.depth, self.root.id)
+
+
+class EventQueue:
+    def __init__(self, max_depth=EVENT_MAX_DEPTH, max_per_root=EVENT_MAX_PER_ROOT, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.max_depth = max_depth
+        self.max_per_root = max_per_root
+        self._queue = deque()
+
+    def push(self, event):
+        """Queues event unless it would exceed its cascade's depth or size
+        limits, in which case it's dropped. Returns whether it was queued."""
+        root = event.root
+        if event.depth > self.max_depth or root.events >= self.max_per_root:
+            root.dropped += 1
+            if root.dropped == 1:
+                self.logger.info('cascade limit hit for {}; dropping {}'.format(root, event))
+            return False
+        root.events += 1
+        root.running += 1
+        self._queue.append(event)
+        return True
+
+    def pop(self):
+        return self._queue.popleft()
+
+    def pop_first(self, runnable):
+        """Removes and returns the first event for which runnable(event) is
+        true, or None if there isn't one."""
+        for i, event in enumerate(self._queue):
+            if runnable(event):
+                del self._queue[i]
+                return event
+        return None
+
+    def clear(self):
+        self._queue.clear()
+
+    def __len__(self):
+        return len(self._queue)
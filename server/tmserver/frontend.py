@@ -0,0 +1,254 @@
+"""Websocket front-end processes.
+
+Normally the server process terminates every websocket itself, so socket I/O,
+compression and framing for every client competes with game logic for one
+core. With --frontends N the server instead starts N front-end processes that
+all listen on the server's port (the kernel spreads connections across them
+with SO_REUSEPORT). A front-end owns its clients' websockets and relays their
+frames to the game core over a unix socket; the core relays back whatever
+should be sent to which client.
+
+The core keeps one UserSession per client, same as ever, with a
+RelayedSocket standing in for the websocket. So every session lives in the
+core's GameWorld and a user can only be logged in once no matter which
+front-end they came in through.
+
+Messages on the unix socket are newline separated JSON:
+
+  front-end -> core: {"type": "open" | "message" | "close", "conn": id, "text": ...}
+  core -> front-end: {"type": "send" | "close", "conn": id, "text": ...}
+
+where conn ids are unique per front-end connection to the core. Binary frames
+(see wire.py) travel base64 encoded under "data" instead of "text", and "open"
+carries the websocket subprotocol the client and front-end agreed on.
+
+Front-ends are forked first thing at boot, before the core has a database
+connection, threads or log handlers they'd otherwise share, and wait for the
+core to start listening. Whoever can connect to the core's socket can speak for
+any client, so it lives in a directory private to the server's user (see
+util.private_dir)."""
+import asyncio
+import base64
+import itertools
+import json
+import logging
+from multiprocessing import Process
+import os
+
+import websockets as ws
+
+from .compression import serve_options
+from .config import FRONTEND_SOCKET
+from .errors import ClientQuit
+from .util import private_dir
+from .wire import subprotocols
+
+# seconds between a waiting front-end's tries at the core's socket
+CONNECT_INTERVAL = 0.1
+
+
+def _encode(msg):
+    return (json.dumps(msg) + '\n').encode('utf-8')
+
+
+def _frame_msg(msg_type, conn, frame):
+    if isinstance(frame, bytes):
+        return {'type': msg_type, 'conn': conn, 'data': base64.b64encode(frame).decode('ascii')}
+    return {'type': msg_type, 'conn': conn, 'text': frame}
+
+
+def _frame(msg):
+    if 'data' in msg:
+        return base64.b64decode(msg['data'])
+    return msg['text']
+
+
+class RelayedSocket:
+    """Quacks like the websocket a UserSession sends to, but sends by way of
+    the front-end that holds the real one."""
+    def __init__(self, link, conn, subprotocol=None):
+        self.link = link
+        self.conn = conn
+        self.subprotocol = subprotocol
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
+            raise ws.exceptions.ConnectionClosed(1006, 'client went away')
+        await self.link.write(_frame_msg('send', self.conn, message))
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            await self.link.write({'type': 'close', 'conn': self.conn})
+
+    def __str__(self):
+        return 'RelayedSocket<{}>'.format(self.conn)
+
+
+class FrontendLink:
+    """The core's end of one front-end's unix socket connection."""
+    def __init__(self, bridge, reader, writer):
+        self.bridge = bridge
+        self.reader = reader
+        self.writer = writer
+        # conn -> (RelayedSocket, queue of frames waiting to be handled)
+        self.conns = {}
+
+    async def write(self, msg):
+        self.writer.write(_encode(msg))
+        await self.writer.drain()
+
+    async def run(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode('utf-8'))
+                conn = msg['conn']
+                if msg['type'] == 'open':
+                    queue = asyncio.Queue()
+                    self.conns[conn] = (RelayedSocket(self, conn, msg.get('subprotocol')), queue)
+                    asyncio.ensure_future(self.bridge.serve_relayed(self.conns[conn][0], queue))
+                elif msg['type'] == 'message' and conn in self.conns:
+                    self.conns[conn][1].put_nowait(_frame(msg))
+                elif msg['type'] == 'close' and conn in self.conns:
+                    self.conns.pop(conn)[1].put_nowait(None)
+        finally:
+            # the front-end went away, and its clients with it
+            for _, queue in self.conns.values():
+                queue.put_nowait(None)
+            self.conns = {}
+            self.writer.close()
+
+
+class CoreBridge:
+    """Accepts front-ends on a unix socket and feeds their clients' frames to
+    game_server one client at a time, in order."""
+    def __init__(self, game_server, path=FRONTEND_SOCKET, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.game_server = game_server
+        self.path = path
+        self.server = None
+
+    async def start(self):
+        private_dir(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._accept, path=self.path)
+
+    async def _accept(self, reader, writer):
+        self.logger.info('front-end connected')
+        await FrontendLink(self, reader, writer).run()
+        self.logger.info('front-end disconnected')
+
+    async def serve_relayed(self, socket, queue):
+        await self.game_server.serve_messages(socket, self._frames(queue))
+        # the session's over; if the client is still connected (ie, it sent
+        # QUIT) the front-end should hang up on it.
+        await socket.close()
+
+    async def _frames(self, queue):
+        while True:
+            text = await queue.get()
+            if text is None:
+                raise ClientQuit()
+            yield text
+
+
+class Frontend:
+    """One front-end process: terminates websockets and relays frames to and
+    from the core."""
+    def __init__(self, loop, bind, port, core_path=FRONTEND_SOCKET, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.loop = loop
+        self.bind = bind
+        self.port = port
+        self.core_path = core_path
+        self.writer = None
+        self.websockets = {}
+        self._ids = itertools.count(1)
+
+    async def connect(self):
+        """Connects to the core, waiting for it to finish booting if need be;
+        gives up if the core process is gone."""
+        private_dir(os.path.dirname(self.core_path))
+        core = os.getppid()
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.core_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if os.getppid() != core:
+                    raise
+                await asyncio.sleep(CONNECT_INTERVAL)
+        asyncio.ensure_future(self.relay_from_core(reader))
+
+    async def write(self, msg):
+        self.writer.write(_encode(msg))
+        await self.writer.drain()
+
+    async def relay_from_core(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                self.logger.error('lost the game core; shutting down')
+                self.loop.stop()
+                return
+            msg = json.loads(line.decode('utf-8'))
+            websocket = self.websockets.get(msg['conn'])
+            if websocket is None:
+                continue
+            try:
+                if msg['type'] == 'send':
+                    await websocket.send(_frame(msg))
+                elif msg['type'] == 'close':
+                    await websocket.close()
+            except ws.exceptions.ConnectionClosed:
+                pass
+
+    async def handle_connection(self, websocket, path):
+        conn = '{}-{}'.format(os.getpid(), next(self._ids))
+        self.websockets[conn] = websocket
+        await self.write({'type': 'open', 'conn': conn, 'subprotocol': websocket.subprotocol})
+        try:
+            async for message in websocket:
+                await self.write(_frame_msg('message', conn, message))
+        except ws.exceptions.ConnectionClosed:
+            pass
+        finally:
+            del self.websockets[conn]
+            await self.write({'type': 'close', 'conn': conn})
+
+    def start(self):
+        self.loop.run_until_complete(self.connect())
+        self.loop.run_until_complete(ws.serve(
+            self.handle_connection, self.bind, self.port, loop=self.loop, reuse_port=True,
+            subprotocols=subprotocols(), **serve_options()))
+        self.logger.info('front-end {} listening on {}:{}'.format(os.getpid(), self.bind, self.port))
+        self.loop.run_forever()
+
+
+def start_frontends(bind, port, count, debug=False):
+    """Forks count front-end processes. Call it before the core connects to
+    the database, starts threads or adds log handlers."""
+    for _ in range(count):
+        Process(target=run_frontend, args=(bind, port), kwargs=dict(debug=debug),
+                name='tildemush-frontend', daemon=True).start()
+
+
+def run_frontend(bind, port, core_path=FRONTEND_SOCKET, debug=False):
+    """Entry point of a front-end process."""
+    # front-ends have no database; a handler inherited from the core (ie,
+    # logs.PGHandler) would log over the core's connection
+    logging.getLogger('tmserver').handlers = []
+    if debug:
+        logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    Frontend(loop, bind, port, core_path=core_path).start()
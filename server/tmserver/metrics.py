@@ -0,0 +1,74 @@
+"""In process counters, gauges and histograms describing what the server is up
+to.
+
+Anything worth keeping an eye on in production increments a counter, sets a
+gauge or observes a value into a histogram on METRICS. Nothing here does any
+I/O; exporting is someone else's job."""
+from bisect import bisect_left
+from collections import defaultdict
+
+# upper bounds, in seconds, of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, the last of which is
+    everything bigger than the biggest bound."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates the qth quantile (0 <= q <= 1) as the upper bound of the
+        bucket it falls in. Values past the last bound count as that bound."""
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1):
+        self.counters[name] += amount
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def histogram(self, name):
+        return self.histograms.get(name)
+
+    def get(self, name):
+        if name in self.gauges:
+            return self.gauges[name]
+        return self.counters.get(name, 0)
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+
+METRICS = Metrics()
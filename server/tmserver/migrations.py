@@ -1,9 +1,12 @@
+from contextlib import contextmanager
+import logging
+import time
+
 import peewee as pw
 import playhouse.migrate as m
 
 from .config import get_db
 from .models import MODELS, GameObject, UserAccount, Contains
-import logging
 
 def logging_env_column(db, migrator):
     m.migrate(
@@ -14,12 +17,17 @@ def logging_remove_actor_column(db, migrator):
     m.migrate(
         migrator.drop_column('log', 'actor_id'))
 
+def logging_raw_text(db, migrator):
+    # slow command records (see slowlog.py) don't fit in a varchar(255)
+    db.execute_sql('ALTER TABLE log ALTER COLUMN raw TYPE text')
+
 # These are largely historical, but may be of use once there exists a
 # long-running tildemush instance. in test and dev, i'm repeatedly trashing the
 # db with reset_db.
 MIGRATIONS = [
     logging_env_column,
-    logging_remove_actor_column
+    logging_remove_actor_column,
+    logging_raw_text
 ]
 
 def initialize():
@@ -37,38 +45,72 @@ def bust_ghosts():
     orphaned player objects left behind by a crash."""
     logger = logging.getLogger('tmserver')
     # In case of crash, we want to clear any player object ghosts so players
-    # can reconnect.
+    # can reconnect. This is a single DELETE ... WHERE inner_obj_id IN
+    # (SELECT ...) so that we never walk Contains row by row.
     logger.info('looking for ghosts')
-    to_clear = []
-    for contains in Contains.select():
-        if contains.inner_obj.is_player_obj:
-            to_clear.append(contains.id)
+    player_objs = GameObject.select(GameObject.id).where(GameObject.is_player_obj==True)
+    busted = Contains.delete().where(Contains.inner_obj.in_(player_objs)).execute()
 
-    if to_clear:
-        logger.info('going to clear ghosts: {}'.format(to_clear))
-        Contains.delete().where(Contains.id.in_(to_clear)).execute()
+    if busted:
+        logger.info('cleared {} ghosts'.format(busted))
 
-def init_db():
+@contextmanager
+def boot_phase(timings, phase):
+    """Times the body of the with block, records the elapsed seconds in the
+    timings dict under phase and logs it."""
     logger = logging.getLogger('tmserver')
-    get_db().create_tables(MODELS, safe=True)
-    logger.info("db tables: {}".format(get_db().get_tables()))
-
-    if 0 == UserAccount.select().where(UserAccount.username=='god').count():
-        logger.info('creating god user accout')
-        UserAccount.create(
-           username='god',
-           password='TODO',  # TODO set from config
-           is_god=True)
-
-    if 0 == GameObject.select().where(GameObject.shortname=='god/foyer').count():
-        logger.info('creating foyer')
-        god_ua = UserAccount.get(UserAccount.username=='god')
-        GameObject.create_scripted_object(
-            god_ua, 'god/foyer', 'room',
-            {'name': 'Foyer',
-             'description': "A waiting room. Magazines in every language from every decade litter dusty end tables sitting between overstuffed armchairs." })
-
-    bust_ghosts()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        timings[phase] = elapsed
+        logger.info('boot phase {} took {:.3f}s'.format(phase, elapsed))
+
+def init_db(warmup_budget=None, bust=True):
+    """Creates any missing tables, ensures god and the foyer exist and busts
+    ghosts (unless bust is False, as for all but the first node of a cluster,
+    whose players may be other nodes' live sessions). If warmup_budget is
+    given, spends up to that many seconds precompiling the scripts of active
+    objects. Returns a dict mapping each boot phase to how many seconds it
+    took."""
+    logger = logging.getLogger('tmserver')
+    timings = {}
+
+    with boot_phase(timings, 'tables'):
+        get_db().create_tables(MODELS, safe=True)
+        logger.info("db tables: {}".format(get_db().get_tables()))
+
+    with boot_phase(timings, 'god'):
+        if 0 == UserAccount.select().where(UserAccount.username=='god').count():
+            logger.info('creating god user accout')
+            UserAccount.create(
+               username='god',
+               password='TODO',  # TODO set from config
+               is_god=True)
+
+    with boot_phase(timings, 'foyer'):
+        if 0 == GameObject.select().where(GameObject.shortname=='god/foyer').count():
+            logger.info('creating foyer')
+            god_ua = UserAccount.get(UserAccount.username=='god')
+            GameObject.create_scripted_object(
+                god_ua, 'god/foyer', 'room',
+                {'name': 'Foyer',
+                 'description': "A waiting room. Magazines in every language from every decade litter dusty end tables sitting between overstuffed armchairs." })
+
+    if bust:
+        with boot_phase(timings, 'ghosts'):
+            bust_ghosts()
+
+    if warmup_budget:
+        # imported here since the world module is heavy and only needed at boot.
+        from .warmup import warm_up
+        with boot_phase(timings, 'warmup'):
+            warm_up(budget=warmup_budget)
+
+    logger.info('init_db finished in {:.3f}s'.format(sum(timings.values())))
+
+    return timings
 
 
 def reset_db():
@@ -9,8 +9,10 @@ from playhouse.signals import Model, pre_save, post_save
 from playhouse.postgres_ext import JSONField
 
 from . import config
+from .config import WITCH_QUARANTINE_AFTER
 from .errors import UserValidationError, ClientError
 from .scripting import ScriptedObjectMixin
+from .stats import counted
 from .util import strip_color_codes, collapse_whitespace
 
 
@@ -21,7 +23,7 @@ MIN_PASSWORD_LEN = 12
 class BaseModel(Model):
     created_at = pw.DateTimeField(default=datetime.utcnow)
     class Meta:
-        database = config.get_db()
+        database = counted(config.get_db())
 
 class UserAccount(BaseModel):
     """This model represents the bridge between the game world (a big tree of
@@ -257,14 +259,32 @@ class GameObject(BaseModel, ScriptedObjectMixin):
             .order_by(ScriptRevision.created_at.desc())\
             .limit(1)[0]
 
-    def get_code(self, use_db_data=True):
-        code = None
+    @property
+    def is_quarantined(self):
+        """An object is quarantined once its current script revision has blown
+        through its handler budget WITCH_QUARANTINE_AFTER times. Saving a new
+        revision lifts the quarantine."""
+        if not WITCH_QUARANTINE_AFTER or self.script_revision is None:
+            return False
+        return WITCH_QUARANTINE_AFTER <= BudgetViolation.select().where(
+            BudgetViolation.game_obj==self,
+            BudgetViolation.script_revision==self.script_revision).count()
+
+    def record_budget_violation(self, reason):
+        BudgetViolation.create(
+            game_obj=self,
+            script_revision=self.script_revision,
+            reason=reason)
+
+    def get_code(self, use_db_data=True, revision=None):
+        """revision saves looking up latest_script_rev for callers that
+        already have it."""
+        if revision is None:
+            revision = self.latest_script_rev
+        code = revision.code
         if use_db_data:
-            code = self.latest_script_rev.code
             as_hy = '(has {})'.format(hy_repr(self.data))
             code = HAS_RE.sub(as_hy, code)
-        else:
-            code = self.latest_script_rev.code
 
         return code
 
@@ -367,6 +387,14 @@ class Contains(BaseModel):
     inner_obj = pw.ForeignKeyField(GameObject)
 
 
+class BudgetViolation(BaseModel):
+    """A record of a WITCH handler being aborted for using too much of its
+    budget."""
+    game_obj = pw.ForeignKeyField(GameObject)
+    script_revision = pw.ForeignKeyField(ScriptRevision)
+    reason = pw.CharField()
+
+
 class LastSeen(BaseModel):
     user_account = pw.ForeignKeyField(UserAccount)
     room = pw.ForeignKeyField(GameObject)
@@ -374,7 +402,7 @@ class LastSeen(BaseModel):
 class Log(BaseModel):
     env = pw.CharField()
     level = pw.CharField()
-    raw = pw.CharField()
+    raw = pw.TextField()
 
 
-MODELS = [UserAccount, Log, GameObject, Contains, Script, ScriptRevision, Permission, Editing, LastSeen]
+MODELS = [UserAccount, Log, GameObject, Contains, Script, ScriptRevision, Permission, Editing, LastSeen, BudgetViolation]
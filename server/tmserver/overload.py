@@ -0,0 +1,83 @@
+"""Shedding load when the event loop falls behind.
+
+The OverloadMonitor asks the loop to call it back every
+TILDEMUSH_OVERLOAD_INTERVAL seconds and measures how late the call comes:
+that's the loop's lag, how long anything that becomes ready has to wait to
+run. Lag is smoothed so a lone slow message doesn't trip anything, then
+compared against three thresholds, each of which sheds more:
+
+- PUSH_LAG: STATE updates to a client that already has one on its way are
+  folded into that one rather than sent separately;
+- BULK_LAG: MAP and REVISION are refused with a BUSY reply;
+- LOGIN_LAG: so are LOGIN and REGISTER, so no new players pile on.
+
+BUSY replies look like `BUSY 5`: try again in 5 seconds. A threshold of 0
+turns its shedding off. The lag is exported as the loop_lag_seconds gauge
+and histogram, and every message or push shed counts towards an
+overload_shed.<what> counter."""
+from .config import (OVERLOAD_INTERVAL, OVERLOAD_PUSH_LAG, OVERLOAD_BULK_LAG,
+                     OVERLOAD_LOGIN_LAG, OVERLOAD_RETRY_AFTER)
+from .metrics import METRICS
+
+# how much each new measurement counts for in the smoothed lag
+SMOOTHING = 0.3
+
+SHED_BULK = ('MAP', 'REVISION')
+SHED_LOGIN = ('LOGIN', 'REGISTER')
+
+
+class OverloadMonitor:
+    def __init__(self, interval=OVERLOAD_INTERVAL, push_lag=OVERLOAD_PUSH_LAG,
+                 bulk_lag=OVERLOAD_BULK_LAG, login_lag=OVERLOAD_LOGIN_LAG,
+                 retry_after=OVERLOAD_RETRY_AFTER):
+        self.interval = interval
+        self.push_lag = push_lag
+        self.bulk_lag = bulk_lag
+        self.login_lag = login_lag
+        self.retry_after = retry_after
+        self.lag = 0
+        self.loop = None
+        self._expected = None
+
+    def start(self, loop):
+        self.loop = loop
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = self.loop.time() + self.interval
+        self.loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        self.measured(max(0, self.loop.time() - self._expected))
+        self._schedule()
+
+    def measured(self, lag):
+        self.lag = SMOOTHING * lag + (1 - SMOOTHING) * self.lag
+        METRICS.set('loop_lag_seconds', self.lag)
+        METRICS.observe('loop_lag_seconds', lag)
+
+    def _over(self, threshold):
+        return threshold > 0 and self.lag >= threshold
+
+    @property
+    def shedding_pushes(self):
+        return self._over(self.push_lag)
+
+    def refuse(self, message):
+        """Returns how many seconds the client should wait before trying
+        message again if it should be refused for now, or None."""
+        verb = message.split(' ', 1)[0].split('\n', 1)[0]
+        if (verb in SHED_BULK and self._over(self.bulk_lag)) \
+           or (verb in SHED_LOGIN and self._over(self.login_lag)):
+            self.shed(verb)
+            return self.retry_after
+        return None
+
+    def shed(self, what):
+        METRICS.incr('overload_shed.{}'.format(what))
+
+    def reset(self):
+        self.lag = 0
+
+
+OVERLOAD = OverloadMonitor()
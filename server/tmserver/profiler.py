@@ -0,0 +1,158 @@
+"""Sampling what the live server is doing, for flame graphs.
+
+A god's /profile N starts a thread that, every TILDEMUSH_PROFILE_INTERVAL
+seconds for N seconds, looks at the stack of every other thread in the
+process (with sys._current_frames) and counts it. Nothing is hooked into the
+code being profiled, so it costs the server only what the sampling thread
+itself takes, and only while a profile is running; only one runs at a time,
+for at most TILDEMUSH_PROFILE_MAX_SECONDS.
+
+Frames running a WITCH handler are followed by a witch:<shortname> frame
+naming the object whose script it is, so time spent in a script shows up
+under that object. Threads waiting in select or on a lock or queue are
+counted as idle rather than sampled.
+
+Stacks are written to TILDEMUSH_PROFILE_DIR in the collapsed format
+flamegraph.pl and speedscope read: one line per distinct stack, the thread's
+name then each frame outermost first, separated by semicolons, then the
+number of times it was seen."""
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+from .config import PROFILE_INTERVAL, PROFILE_MAX_SECONDS, PROFILE_DIR
+from .scripting import ScriptedObjectMixin
+
+# frames of these are waiting for something to do
+IDLE_MODULES = ('selectors.py', 'threading.py', 'queue.py')
+
+
+def _witch_frame(frame):
+    obj = frame.f_locals.get('self')
+    return 'witch:{}'.format(getattr(obj, 'shortname', '?'))
+
+
+# code object -> function giving the frame that follows one of its frames
+ANNOTATED = {ScriptedObjectMixin.handle_action.__code__: _witch_frame}
+
+
+def _frame_name(code):
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame):
+    """Returns frame's stack, outermost first, as a list of frame names."""
+    stack = []
+    while frame is not None:
+        annotate = ANNOTATED.get(frame.f_code)
+        if annotate is not None:
+            stack.append(annotate(frame))
+        stack.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def is_idle(frame):
+    return frame.f_code.co_filename.endswith(IDLE_MODULES)
+
+
+class Profile:
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+
+    def sample(self, frames, names, skip):
+        self.samples += 1
+        for thread_id, frame in frames.items():
+            if thread_id == skip:
+                continue
+            if is_idle(frame):
+                self.idle += 1
+                continue
+            name = names.get(thread_id, str(thread_id)).replace(';', ':').replace(' ', '_')
+            self.stacks[';'.join([name] + collapse(frame))] += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+    def hottest(self, n=5):
+        """The n frames most often at the top of a stack, with the fraction
+        of busy samples each was seen in."""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        busy = sum(leaves.values())
+        return [(frame, count / busy) for frame, count in leaves.most_common(n)]
+
+    def summary(self, path):
+        lines = ['{} samples over {:g}s ({} idle) written to {}'.format(
+            self.samples, self.seconds, self.idle, path)]
+        lines.extend('{:5.1f}% {}'.format(100 * share, frame) for frame, share in self.hottest())
+        return '\n'.join(lines)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, max_seconds=PROFILE_MAX_SECONDS,
+                 directory=PROFILE_DIR):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self, seconds, done):
+        """Profiles for seconds (up to the maximum) on a thread of its own,
+        then calls done(path, profile) from that thread, or done(None, None,
+        error) if profiling or writing it out failed. Returns how many
+        seconds it'll profile for, or None if a profile's already running."""
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+        seconds = max(self.interval, min(seconds, self.max_seconds))
+        threading.Thread(target=self._run, args=(seconds, done),
+                         name='tildemush-profiler', daemon=True).start()
+        return seconds
+
+    def _run(self, seconds, done):
+        try:
+            profile = self.profile(seconds)
+            path = self.write(profile)
+        except Exception as e:
+            error = e
+        else:
+            error = None
+        finally:
+            with self._lock:
+                self._running = False
+        if error is not None:
+            done(None, None, error)
+        else:
+            done(path, profile)
+
+    def profile(self, seconds):
+        profile = Profile(seconds, self.interval)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            profile.sample(sys._current_frames(), names, me)
+            time.sleep(self.interval)
+        return profile
+
+    def write(self, profile):
+        path = os.path.join(self.directory, 'profile-{}.collapsed'.format(
+            time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as f:
+            f.write(profile.collapsed())
+        return path
+
+
+PROFILER = SamplingProfiler()
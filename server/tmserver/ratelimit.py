@@ -0,0 +1,165 @@
+"""Token bucket rate limits on what clients send.
+
+Every client gets a bucket for everything it sends ('*') plus one per kind of
+message, keyed either by the message's verb (MAP, REVISION) or, for
+commands, by COMMAND and the action (COMMAND say); commands without a limit of
+their own share the COMMAND bucket. A message goes through only if every
+bucket it draws on has a token to spare.
+
+Buckets belong to the logged in user (so they follow a user across
+reconnects) or, before login, to the session. What happens to a message over
+its limit depends on TILDEMUSH_RATE_LIMIT_MODE: 'reject' answers it with a
+throttled error straight away; 'delay' holds it until it's allowed, as long as
+that's no more than TILDEMUSH_RATE_LIMIT_MAX_DELAY seconds, and rejects it
+otherwise.
+
+Limits are (tokens per second, burst size). TILDEMUSH_RATE_LIMITS, a JSON
+object of the same shape as DEFAULT_LIMITS, overrides the defaults key by key;
+a limit of null removes one. Rates have to be positive and bursts at least 1.
+
+Throttled messages are counted (in the throttled counters and the
+rate_limit_* metrics) under the limit they draw on besides '*', or their verb
+if there isn't one, never under whatever action a client made up."""
+from collections import Counter
+import time
+
+from .config import RATE_LIMITS, RATE_LIMIT_MODE, RATE_LIMIT_MAX_DELAY
+from .metrics import METRICS
+from . import stats
+
+DEFAULT_LIMITS = {
+    '*': (20, 40),
+    'COMMAND': (4, 10),
+    'COMMAND say': (8, 16),
+    'COMMAND create': (0.2, 3),
+    'COMMAND edit': (0.5, 5),
+    'MAP': (0.5, 3),
+    'REVISION': (0.5, 3),
+}
+
+# never limited: a client should always be able to leave
+EXEMPT = ('QUIT',)
+
+
+def limit_key(message):
+    """Returns which limit message draws on besides '*'."""
+    verb, _, rest = message.partition(' ')
+    if verb == 'COMMAND':
+        action = rest.split(' ', 1)[0]
+        return 'COMMAND {}'.format(action)
+    return verb.split('\n', 1)[0]
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """Seconds until a token is available; 0 if one is now."""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits=None, mode=RATE_LIMIT_MODE, max_delay=RATE_LIMIT_MAX_DELAY,
+                 clock=time.monotonic):
+        self.limits = dict(DEFAULT_LIMITS)
+        for key, limit in (RATE_LIMITS if limits is None else limits).items():
+            if limit is None:
+                self.limits.pop(key, None)
+                continue
+            rate, burst = limit
+            if not rate > 0 or not burst >= 1:
+                raise ValueError('rate limit {} needs a rate above 0 and a burst of at least 1; '
+                                 'got {}'.format(key, list(limit)))
+            self.limits[key] = (rate, burst)
+        self.mode = mode
+        self.max_delay = max_delay
+        self.clock = clock
+        # client key -> {limit key -> TokenBucket}
+        self._buckets = {}
+        # client key -> Counter of (limit key, 'delayed' | 'rejected')
+        self.throttled = {}
+
+    def _limit_for(self, key):
+        if key in self.limits:
+            return key, self.limits[key]
+        if key.startswith('COMMAND ') and 'COMMAND' in self.limits:
+            return 'COMMAND', self.limits['COMMAND']
+        return None, None
+
+    def _buckets_for(self, client, message, now):
+        buckets = self._buckets.setdefault(client, {})
+        keys = ['*', limit_key(message)]
+        drawn = []
+        for key in keys:
+            bucket_key, limit = self._limit_for(key)
+            if limit is None:
+                continue
+            if bucket_key not in buckets:
+                buckets[bucket_key] = TokenBucket(limit[0], limit[1], now)
+            drawn.append(buckets[bucket_key])
+        return drawn
+
+    def check(self, client, message):
+        """Returns 0 and takes a token from each of the buckets message draws
+        on if they all have one, or else how many seconds until they will
+        (taking nothing)."""
+        if message.startswith(EXEMPT):
+            return 0
+        now = self.clock()
+        buckets = self._buckets_for(client, message, now)
+        for bucket in buckets:
+            bucket.refill(now)
+        wait = max([b.wait() for b in buckets], default=0)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return wait
+
+    def label(self, message):
+        """What a throttled message is counted under; see the module
+        docstring."""
+        key, _ = self._limit_for(limit_key(message))
+        return key if key is not None else stats.verb_label(message)
+
+    def record(self, client, message, outcome):
+        """Counts message from client as having been outcome, 'delayed' or
+        'rejected'."""
+        key = self.label(message)
+        self.throttled.setdefault(client, Counter())[(key, outcome)] += 1
+        METRICS.incr('rate_limit_{}.{}'.format(outcome, key))
+
+    def forget(self, client):
+        """Drops client's buckets (but not its counters)."""
+        self._buckets.pop(client, None)
+
+    def summary(self, client=None):
+        """Lines describing who's been throttled for what, worst first; or
+        just client."""
+        clients = [client] if client is not None else sorted(
+            self.throttled, key=lambda c: -sum(self.throttled[c].values()))
+        lines = []
+        for c in clients:
+            counts = self.throttled.get(c)
+            if not counts:
+                continue
+            parts = ['{} {} {}'.format(key, n, outcome)
+                     for (key, outcome), n in counts.most_common()]
+            lines.append('{}: {}'.format(c, ', '.join(parts)))
+        return lines
+
+    def reset(self):
+        self._buckets.clear()
+        self.throttled.clear()
+
+
+RATE_LIMITER = RateLimiter()
@@ -0,0 +1,101 @@
+"""Trial compilation of WITCH revisions.
+
+When someone saves a script we want to know if it works before we swap it into
+the live world, but compiling and running arbitrary Hy on the event loop means
+one pathological script (deep macro expansion, a huge top level loop) freezes
+every session. Instead we compile and evaluate the top level of a revision in a
+short lived child process with a wall clock and memory limit. Only if that
+succeeds does the world build the real engine, reusing the compiled ASTs."""
+from multiprocessing import Pipe, Process
+import resource
+
+from .config import REVISION_TIMEOUT, REVISION_MEMORY_LIMIT
+from .scripting import WitchInterpreter, compile_witch
+
+WITCH_PROBLEM = ';_; There is a problem with your witch script: {}'
+
+
+class TrialResult:
+    def __init__(self, errors=None, asts=None):
+        self.errors = errors or []
+        self.asts = asts
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+class TrialReceiver:
+    """Stands in for a GameObject while trial evaluating a script. It keeps
+    data in memory and ignores anything that would affect other objects."""
+    def __init__(self):
+        self.id = None
+        self.data = {}
+        self.editing_set = []
+
+    def _ensure_data(self, data):
+        self.data = data
+
+    def set_data(self, key, value):
+        self.data[key] = value
+
+    def get_data(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set_perms(self, **kwargs):
+        pass
+
+    def say(self, message):
+        pass
+
+    def emote(self, message):
+        pass
+
+
+def _trial(conn, code, memory_limit):
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    try:
+        asts = compile_witch(code)
+        wi = WitchInterpreter(TrialReceiver())
+        for witch_ast in asts:
+            wi.evaluate_ast(witch_ast)
+    except MemoryError:
+        conn.send(TrialResult(errors=[WITCH_PROBLEM.format('it used too much memory')]))
+    except Exception as e:
+        conn.send(TrialResult(errors=[WITCH_PROBLEM.format(e)]))
+    else:
+        conn.send(TrialResult(asts=asts))
+    finally:
+        conn.close()
+
+
+def trial_revision(code, timeout=REVISION_TIMEOUT, memory_limit=REVISION_MEMORY_LIMIT):
+    """Compiles and evaluates the top level of code in a child process. Blocks
+    for at most timeout seconds; call it via run_in_executor from the event
+    loop. Returns a TrialResult."""
+    recv_conn, send_conn = Pipe(duplex=False)
+    proc = Process(target=_trial, args=(send_conn, code.strip(), memory_limit), daemon=True)
+    proc.start()
+    send_conn.close()
+    try:
+        if recv_conn.poll(timeout):
+            result = recv_conn.recv()
+        else:
+            result = TrialResult(errors=[WITCH_PROBLEM.format(
+                'it took longer than {}s to compile and run'.format(timeout))])
+    except EOFError:
+        # the child died without telling us anything; most likely it was
+        # killed for blowing past its memory limit.
+        result = TrialResult(errors=[WITCH_PROBLEM.format('it crashed while compiling')])
+    finally:
+        recv_conn.close()
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+    return result
+
+
+async def trial_revision_async(loop, code):
+    return await loop.run_in_executor(None, trial_revision, code)
@@ -0,0 +1,152 @@
+"""Priority scheduling of client messages.
+
+Messages are either interactive (PING, QUIT and most commands: cheap, and
+someone's waiting to see what happened) or bulk (MAP rendering, REVISION
+compiling, REFRESH, LOGIN and REGISTER with their password hashing, and the
+world wide announce). Every message takes a slot from the Scheduler before
+it's handled and gives it back when it's done:
+
+- at most TILDEMUSH_SCHEDULER_CONCURRENCY messages are handled at once, and
+  each class has its own cap within that (TILDEMUSH_SCHEDULER_LIMITS), so a
+  burst of bulk work can't take every slot;
+- when a slot frees up, a waiting interactive message gets it ahead of a
+  waiting bulk one...
+- ...unless that bulk message has waited TILDEMUSH_SCHEDULER_MAX_WAIT seconds
+  or more, so bulk work is delayed, never starved.
+
+Handling interleaves wherever it awaits (the database thread, room locks,
+revision trials), so this matters most with TILDEMUSH_DB_THREAD set, where the
+bounded number of bulk messages in flight bounds how much bulk work an
+interactive message can find queued ahead of it on the database thread. A
+message only takes its slot once it's past its rate limit, and gives it back
+while it waits for room locks, since neither wait is work.
+
+How long messages wait for a slot and how long they take overall go into
+the scheduler_wait_seconds.<class> and message_seconds.<class> histograms."""
+import asyncio
+from collections import deque
+import time
+
+from .config import SCHEDULER_CONCURRENCY, SCHEDULER_LIMITS, SCHEDULER_MAX_WAIT
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# in order of precedence
+PRIORITIES = (INTERACTIVE, BULK)
+
+BULK_VERBS = ('MAP', 'REVISION', 'REFRESH', 'LOGIN', 'REGISTER')
+BULK_COMMANDS = ('announce',)
+
+
+def priority_of(message):
+    verb, _, rest = message.partition(' ')
+    verb = verb.split('\n', 1)[0]
+    if verb in BULK_VERBS:
+        return BULK
+    if verb == 'COMMAND' and rest.split(' ', 1)[0] in BULK_COMMANDS:
+        return BULK
+    return INTERACTIVE
+
+
+class Scheduler:
+    def __init__(self, concurrency=SCHEDULER_CONCURRENCY, limits=SCHEDULER_LIMITS,
+                 max_wait=SCHEDULER_MAX_WAIT, clock=time.monotonic):
+        self.concurrency = concurrency
+        self.limits = {p: limits.get(p, concurrency) for p in PRIORITIES}
+        self.max_wait = max_wait
+        self.clock = clock
+        self.running = {p: 0 for p in PRIORITIES}
+        # priority -> deque of (time queued, future resolved on being granted a slot)
+        self.waiting = {p: deque() for p in PRIORITIES}
+
+    def slot(self, priority):
+        """Returns an async context manager holding a slot of priority for the
+        duration of its block."""
+        return Slot(self, priority)
+
+    async def acquire(self, priority):
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[priority].append((self.clock(), future))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # granted just as we were cancelled
+                self.release(priority)
+            raise
+
+    def release(self, priority):
+        self.running[priority] -= 1
+        self._grant()
+
+    def _next(self):
+        if sum(self.running.values()) >= self.concurrency:
+            return None
+        ready = [p for p in PRIORITIES if self.waiting[p] and self.running[p] < self.limits[p]]
+        if not ready:
+            return None
+        now = self.clock()
+        starving = [p for p in ready if now - self.waiting[p][0][0] >= self.max_wait]
+        if starving:
+            return min(starving, key=lambda p: self.waiting[p][0][0])
+        return ready[0]
+
+    def _grant(self):
+        while True:
+            priority = self._next()
+            if priority is None:
+                return
+            _, future = self.waiting[priority].popleft()
+            if future.cancelled():
+                continue
+            self.running[priority] += 1
+            future.set_result(None)
+
+    def __len__(self):
+        return sum(len(w) for w in self.waiting.values())
+
+
+class Slot:
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.held = False
+
+    async def acquire(self):
+        await self.scheduler.acquire(self.priority)
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.scheduler.release(self.priority)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def lent(slot):
+    """Returns an async context manager giving slot (if there is one) back
+    for the duration of its block and waiting to take it again after."""
+    return Lent(slot)
+
+
+class Lent:
+    def __init__(self, slot):
+        self.slot = slot
+        self.given = False
+
+    async def __aenter__(self):
+        if self.slot is not None and self.slot.held:
+            self.slot.release()
+            self.given = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.given:
+            await self.slot.acquire()
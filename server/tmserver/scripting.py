@@ -1,14 +1,23 @@
+from collections import ChainMap, OrderedDict
+from contextlib import contextmanager
 from fnmatch import fnmatch
 import io
+import logging
 import random
 import re
+import time
 
 import asteval
 import hy
 from hy.compiler import hy_compile
 
-from .config import get_db
-from .errors import ClientError, WitchError
+from .bytecode import BytecodeInterpreter, safe_symbol_table
+from .config import get_db, ENGINE_CACHE_SIZE, WITCH_AST_CACHE_SIZE, WITCH_BACKEND, WITCH_BUDGET, WITCH_GOD_BUDGET, WITCH_AUTHOR_BUDGETS, WITCH_SLICE_STEPS, WITCH_WORKERS
+from .errors import ClientError, WitchError, WitchBudgetExceeded
+from .metrics import METRICS
+from . import stats
+from .tracing import TRACER
+from .timeslice import checkpoint
 from .util import split_args, ARG_RE_RAW, clean_str
 
 WITCH_HEADER = '(require [tmserver.witch_header [*]])'
@@ -71,6 +80,269 @@ def random_number(a=None, b=None):
 
     return random.randint(a, b)
 
+class ASTCache:
+    """A small LRU mapping of WITCH source code to the list of Python ASTs Hy
+    compiles it into. Reading and compiling Hy is by far the slowest part of
+    getting a script engine up, so we do it once per distinct piece of code."""
+    def __init__(self, max_size=WITCH_AST_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, witch_code):
+        asts = self._entries.get(witch_code)
+        if asts is not None:
+            self._entries.move_to_end(witch_code)
+        return asts
+
+    def put(self, witch_code, asts):
+        self._entries[witch_code] = asts
+        self._entries.move_to_end(witch_code)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, witch_code):
+        return witch_code in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+AST_CACHE = ASTCache()
+
+def compile_witch(witch_code):
+    """Given a pile of script revision code, prepends the WITCH header and
+    reads and compiles every form in it. Returns a list of Python ASTs ready
+    for a WitchInterpreter. This function touches no database or game state so
+    it's safe to call from another process."""
+    with_header = '{}\n{}'.format(WITCH_HEADER, witch_code)
+    buff = io.StringIO(with_header)
+    asts = []
+    while True:
+        start = buff.tell()
+        try:
+            tree = hy.read(buff)
+        except EOFError:
+            # hy.read gives up the same way at the end of the code and partway
+            # through an unfinished form, whose text is then left over
+            if with_header[start:].strip():
+                raise WitchError('the script ends partway through a form; is a ) or " missing?')
+            break
+        asts.append(hy_compile(tree, '__main__'))
+    stats.count('compiles')
+    return asts
+
+def cached_compile_witch(witch_code):
+    asts = AST_CACHE.get(witch_code)
+    if asts is None:
+        asts = compile_witch(witch_code)
+        AST_CACHE.put(witch_code, asts)
+    return asts
+
+class EngineCache:
+    """Keeps the script engines of recently active objects alive so that
+    every freshly fetched GameObject doesn't have to rebuild its engine.
+
+    Entries are keyed by object id and remember which script revision they
+    were built from. They're ordered by when the object last handled an
+    event; once there are more than max_size entries, the least recently
+    active are evicted. An evicted or hibernated object just gets a new engine
+    the next time it's needed. The ids of the last max_size objects dropped
+    are remembered so rebuilding their engines counts as a rehydration."""
+    def __init__(self, max_size=ENGINE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._dropped = OrderedDict()
+
+    def get(self, obj_id, revision_id):
+        entry = self._entries.get(obj_id)
+        if entry is None or entry[0] != revision_id:
+            return None
+        return entry[1]
+
+    def put(self, obj_id, revision_id, engine):
+        self.discard(obj_id)
+        if self._dropped.pop(obj_id, None) is not None:
+            METRICS.incr('engine_cache_rehydrations')
+        self._entries[obj_id] = (revision_id, engine)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            METRICS.incr('engine_cache_evictions')
+        METRICS.set('engine_cache_size', len(self._entries))
+
+    def touch(self, obj_id):
+        """Marks obj_id as having just handled an event."""
+        if obj_id in self._entries:
+            self._entries.move_to_end(obj_id)
+
+    def hibernate(self, obj_ids):
+        for obj_id in obj_ids:
+            if obj_id in self._entries:
+                self._drop(obj_id)
+                METRICS.incr('engine_cache_hibernations')
+        METRICS.set('engine_cache_size', len(self._entries))
+
+    def discard(self, obj_id):
+        entry = self._entries.pop(obj_id, None)
+        if entry is not None:
+            entry[1].release()
+
+    def _drop(self, obj_id):
+        self.discard(obj_id)
+        self._dropped[obj_id] = True
+        self._dropped.move_to_end(obj_id)
+        while len(self._dropped) > self.max_size:
+            self._dropped.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self._dropped.clear()
+
+    def ids(self):
+        return list(self._entries.keys())
+
+    def __contains__(self, obj_id):
+        return obj_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+ENGINES = EngineCache()
+
+def witch_budget(author):
+    """Returns the (max steps, max seconds) budget for handlers in scripts
+    written by the given UserAccount."""
+    budget = WITCH_AUTHOR_BUDGETS.get(author.username)
+    if budget is not None:
+        return budget
+    if author.is_god:
+        return WITCH_GOD_BUDGET
+    return WITCH_BUDGET
+
+# The math and builtins asteval offers WITCH code are the same for every object,
+# so there's one copy of them that every interpreter layers its own symbols on
+# top of.
+BASE_SYMTABLE = safe_symbol_table()
+BASE_NO_DEEPCOPY = [k for k, v in BASE_SYMTABLE.items() if callable(v)]
+NODE_HANDLER_ALIASES = {'tryexcept': 'try', 'tryfinally': 'try'}
+
+class NodeHandlers:
+    """Stands in for the dict of bound on_* methods asteval builds for every
+    interpreter, binding them on lookup instead."""
+    __slots__ = ('interpreter',)
+    NODES = frozenset(asteval.asteval.ALL_NODES) | frozenset(NODE_HANDLER_ALIASES)
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+
+    def __getitem__(self, node_name):
+        if node_name not in self.NODES:
+            raise KeyError(node_name)
+        return getattr(self.interpreter, 'on_' + NODE_HANDLER_ALIASES.get(node_name, node_name))
+
+class SymbolTable(ChainMap):
+    """A ChainMap of an interpreter's own symbols over BASE_SYMTABLE that,
+    like the plain dict asteval expects, forgets a deleted name outright
+    instead of letting the base layer's show through."""
+    def __init__(self, symbols, base, deleted=()):
+        super().__init__(symbols, base)
+        self.deleted = set(deleted)
+
+    def __getitem__(self, key):
+        if key in self.deleted:
+            raise KeyError(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        return key not in self.deleted and super().__contains__(key)
+
+    def __iter__(self):
+        return (key for key in super().__iter__() if key not in self.deleted)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __setitem__(self, key, value):
+        self.deleted.discard(key)
+        self.maps[0][key] = value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        self.maps[0].pop(key, None)
+        self.deleted.add(key)
+        return value
+
+    def copy(self):
+        return self.__class__(self.maps[0].copy(), *self.maps[1:], deleted=self.deleted)
+
+    __copy__ = copy
+
+class MeteredInterpreter(asteval.Interpreter):
+    """An asteval Interpreter that counts every AST node it evaluates. While
+    metering, it raises WitchBudgetExceeded once either the step limit or the
+    wall clock deadline is passed.
+
+    asteval's own max_time is measured from the last top level eval() call,
+    which for handlers defined at script load time is long in the past, so it
+    can't be used for this; we set it arbitrarily high and do our own
+    accounting instead.
+
+    Its symbol table is a SymbolTable of this interpreter's own symbols (the
+    WITCH API closures and whatever the script defines) over the shared
+    BASE_SYMTABLE. Writes only ever land in the first layer, and the
+    copy-and-restore asteval does around every procedure call only copies
+    that small layer."""
+    def __init__(self, usersyms, **kwargs):
+        super().__init__(symtable=SymbolTable(dict(usersyms), BASE_SYMTABLE), **kwargs)
+        # asteval removes names from it as scripts assign them
+        self.no_deepcopy = list(BASE_NO_DEEPCOPY)
+        self.node_handlers = NodeHandlers(self)
+        self.metering = False
+        self.steps = 0
+        self.step_limit = None
+        self.deadline = None
+        self.exceeded = None
+
+    def start_metering(self, step_limit, time_limit):
+        self.metering = True
+        self.exceeded = None
+        self.steps = 0
+        self.step_limit = step_limit
+        self.deadline = time.monotonic() + time_limit
+        # a previous handler blowing up leaves its errors behind, which would
+        # make run() silently do nothing from here on out.
+        self.error = []
+        self.error_msg = None
+
+    def stop_metering(self):
+        self.metering = False
+        self.exceeded = None
+
+    def run(self, node, *args, **kwargs):
+        if self.metering:
+            self.steps += 1
+            if WITCH_SLICE_STEPS and self.steps % WITCH_SLICE_STEPS == 0:
+                # time spent suspended isn't this handler's fault.
+                self.deadline += checkpoint()
+            if self.steps > self.step_limit:
+                self.exceeded = 'evaluated more than {} steps'.format(self.step_limit)
+            elif time.monotonic() > self.deadline:
+                self.exceeded = 'ran for more than its time limit'
+            if self.exceeded:
+                # asteval re-raises this as it unwinds with its own message, so
+                # the reason is kept in self.exceeded.
+                raise WitchBudgetExceeded(self.exceeded)
+        return super().run(node, *args, **kwargs)
+
 class ProxyGameObject:
     def __init__(self, game_object):
         self.id = game_object.id
@@ -156,29 +428,53 @@ class WitchInterpreter:
         # the user to be used as a callback, you're going to want to wrap it in a macro. If it's a
         # simple function like (random-number), just define it as a function here.
         self.script_engine = script_engine
-        self.interpreter = asteval.Interpreter(
-            use_numpy=False,
-            max_time=100000.0,  # there's a bug with this and setting it arbitrarily high avoids it
-            usersyms=dict(
-                open=witch_open,
-                split_args=split_args,
-                random_number=random_number,
-                add_provides_handler=add_provides_handler,
-                add_hears_handler=add_hears_handler,
-                add_sees_handler=add_sees_handler,
-                set_data=set_data,
-                get_data=get_data,
-                says=says,
-                does=does,
-                set_permissions=set_permissions,
-                add_docstring=add_docstring,
-                witch_tell_sender=tell_sender,
-                witch_move_sender=move_sender,
-                witch_teleport_sender=teleport_sender,
-                ensure_obj_data=ensure_obj_data))
+        script_engine.interpreter = self
+        usersyms = dict(
+            open=witch_open,
+            split_args=split_args,
+            random_number=random_number,
+            add_provides_handler=add_provides_handler,
+            add_hears_handler=add_hears_handler,
+            add_sees_handler=add_sees_handler,
+            set_data=set_data,
+            get_data=get_data,
+            says=says,
+            does=does,
+            set_permissions=set_permissions,
+            add_docstring=add_docstring,
+            witch_tell_sender=tell_sender,
+            witch_move_sender=move_sender,
+            witch_teleport_sender=teleport_sender,
+            ensure_obj_data=ensure_obj_data)
+
+        if WITCH_BACKEND == 'bytecode':
+            self.interpreter = BytecodeInterpreter(usersyms)
+        else:
+            self.interpreter = MeteredInterpreter(
+                usersyms,
+                use_numpy=False,
+                max_time=100000.0)  # see MeteredInterpreter for why this is arbitrarily high
+
+    @contextmanager
+    def budget(self, step_limit, time_limit):
+        """Meters everything evaluated in the with block. Nested uses (a
+        handler whose effects come back around to this same interpreter) share
+        the outermost budget."""
+        if self.interpreter.metering:
+            yield
+            return
+        self.interpreter.start_metering(step_limit, time_limit)
+        try:
+            yield
+        except WitchBudgetExceeded:
+            raise WitchBudgetExceeded(self.interpreter.exceeded)
+        finally:
+            self.interpreter.stop_metering()
 
     def evaluate_ast(self, witch_ast):
         self.interpreter(witch_ast)
+        if self.interpreter.exceeded:
+            raise WitchBudgetExceeded(self.interpreter.exceeded)
         if self.interpreter.error_msg:
             error_msg = self.interpreter.error_msg
             if 'in expr' in error_msg:
@@ -190,19 +486,20 @@ class ScriptEngine:
     CONTAIN_TYPES = {'acquired', 'entered', 'lost', 'freed'}
     def __init__(self, receiver_model):
         self.receiver_model = receiver_model
+        self.interpreter = None
         self.hears = {}
         self.sees = {}
-        self.provides = {'debug': self._debug_handler,
-                         'contain': self._contain_handler,
-                         'say': self._say_handler,
-                         'emote': self._emote_handler,
-                         'announce': self._announce_handler,
-                         'whisper': self._whisper_handler}
+        # only handlers added by the script live here; see BUILTIN_PROVIDES.
+        self.provides = {}
 
     @staticmethod
     def noop(*args, **kwargs):
         pass
 
+    def release(self):
+        """Called when the engine is dropped from ENGINES."""
+        pass
+
     def _ensure_game_world(self, game_world):
         if not hasattr(self, 'game_world'):
             self.game_world = game_world
@@ -288,6 +585,16 @@ class ScriptEngine:
     def add_provides_handler(self, action, fn):
         self.provides[action] = fn
 
+    @contextmanager
+    def budget(self, author):
+        """Meters handlers run in the with block against author's budget. An
+        engine with no script attached has nothing to meter."""
+        if self.interpreter is None:
+            yield
+            return
+        with self.interpreter.budget(*witch_budget(author)):
+            yield
+
     def handler(self, game_world, receiver, action, action_args):
         """
         This method is confusing. Its purpose is to map from a given action and arguments to a
@@ -322,7 +629,26 @@ class ScriptEngine:
                     return transitively_handled, self.provides[found]
 
         # fall back on intransitive handling
-        return transitively_handled, self.provides.get(action, self.noop)
+        return transitively_handled, self.intransitive_handler(action)
+
+    def intransitive_handler(self, action):
+        handler = self.provides.get(action)
+        if handler is not None:
+            return handler
+        builtin = self.BUILTIN_PROVIDES.get(action)
+        if builtin is not None:
+            return builtin.__get__(self, ScriptEngine)
+        return self.noop
+
+    # Every engine handles these actions unless its script provides its own
+    # handler. They're kept on the class rather than copied into every
+    # engine's provides dict.
+    BUILTIN_PROVIDES = {'debug': _debug_handler,
+                        'contain': _contain_handler,
+                        'say': _say_handler,
+                        'emote': _emote_handler,
+                        'announce': _announce_handler,
+                        'whisper': _whisper_handler}
 
 class ScriptedObjectMixin:
     """This database-less class implements the runtime behavior of a tildemush
@@ -348,7 +674,11 @@ class ScriptedObjectMixin:
         # smaller files; until then i'm going to be disgusting and add a
         # .latest_script_rev method to GameObject
         if not hasattr(self, '_engine'):
-            self.init_scripting()
+            cached = ENGINES.get(self.id, self.script_revision_id)
+            if cached is not None:
+                self._engine = cached
+            else:
+                self.init_scripting()
         else:
             with get_db().atomic():
                 current_rev = self.script_revision
@@ -365,7 +695,7 @@ class ScriptedObjectMixin:
         return self._engine
 
     def init_scripting(self, use_db_data=True):
-        if self.script_revision is None:
+        if self.script_revision is None or self.is_quarantined:
             self._engine = ScriptEngine(self)
         else:
             try:
@@ -373,15 +703,41 @@ class ScriptedObjectMixin:
             except Exception as e:
                 raise WitchError(
                     ';_; There is a problem with your witch script: {}'.format(e))
+        ENGINES.put(self.id, self.script_revision_id, self._engine)
 
     def handle_action(self, game_world, sender_obj, action, action_args):
         self._ensure_world(game_world)
-        is_transitive, handler = self.engine.handler(game_world, self, action, action_args)
-
-        return is_transitive, handler(ProxyGameObject(self),
-                                      ProxyGameObject(sender_obj),
-                                      action,
-                                      action_args)
+        engine = self.engine
+        # the engine may have been built by (and closes over) another instance
+        # of this object, which also needs to know about the world.
+        engine.receiver_model._ensure_world(game_world)
+        ENGINES.touch(self.id)
+        is_transitive, handler = engine.handler(game_world, self, action, action_args)
+        if handler is ScriptEngine.noop:
+            # nothing to time or meter; only handlers a script ran count
+            return is_transitive, handler(ProxyGameObject(self),
+                                          ProxyGameObject(sender_obj),
+                                          action,
+                                          action_args)
+
+        try:
+            with engine.budget(self.author), stats.handling(self.shortname, action), \
+                 TRACER.span('handler', self.shortname, action=action):
+                return is_transitive, handler(ProxyGameObject(self),
+                                              ProxyGameObject(sender_obj),
+                                              action,
+                                              action_args)
+        except WitchBudgetExceeded as e:
+            self.budget_exceeded(action, str(e))
+            return is_transitive, None
+
+    def budget_exceeded(self, action, reason):
+        logging.getLogger('tmserver').info('{} aborted {} handler: {}'.format(
+            self.shortname, action, reason))
+        self.record_budget_violation(reason)
+        if self.is_quarantined:
+            self._engine = ScriptEngine(self)
+            ENGINES.put(self.id, self.script_revision_id, self._engine)
 
     # say, set_data, get_data, and tell_sender are part of the WITCH scripting
     # API. that should probably be explicit somehow?
@@ -415,20 +771,19 @@ class ScriptedObjectMixin:
         self.game_world.move_obj(sender_obj, target_room_name)
 
     def _execute_script(self, witch_code):
-        """Given a pile of script revision code, this function prepends the
-        (witch) macro definition and then reads and evals the combined code."""
-        with_header = '{}\n{}'.format(WITCH_HEADER, witch_code)
-        buff = io.StringIO(with_header)
-        stop = False
-        result = None
+        """Given a pile of script revision code, this function compiles it
+        (see compile_witch; the result is cached) and evals it. The top level
+        of a script gets the same budget as its handlers.
+
+        With TILDEMUSH_WITCH_WORKERS set, the script is loaded in a worker
+        process instead; see workers.py."""
+        if WITCH_WORKERS:
+            from .workers import RemoteEngine, get_pool
+            return RemoteEngine(self, get_pool(), witch_code, witch_budget(self.author))
         wi = WitchInterpreter(self)
-        while not stop:
-            try:
-                tree = hy.read(buff)
-                witch_ast = hy_compile(tree, '__main__')
+        with wi.budget(*witch_budget(self.author)):
+            for witch_ast in cached_compile_witch(witch_code):
                 wi.evaluate_ast(witch_ast)
-            except EOFError:
-                stop = True
         return wi.script_engine
 
     def _ensure_data(self, data_mapping):
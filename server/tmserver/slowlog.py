@@ -0,0 +1,143 @@
+"""Logging commands that take too long, along with where the time went.
+
+With TILDEMUSH_SLOW_COMMAND_MS set, every command run in the world (a call to
+GameWorld.dispatch_action from outside it, including the cascade of actions
+it sets off) is watched; if it takes at least that many milliseconds, a
+record like this is logged:
+
+  {"time": 1546300800.0, "who": "vilmibm", "room": "vilmibm/pickling-room",
+   "action": "go", "args": "north", "total_ms": 812.4,
+   "queries": [{"sql": "SELECT ...", "ms": 1.2}, ...],
+   "handlers": [{"shortname": "snoozy/jar", "action": "go", "ms": 790.3}, ...]}
+
+Records go to TILDEMUSH_SLOW_COMMAND_LOG, a JSON lines file, or, if that's
+'db', to the Log table. Either way they're written by a thread of their own so
+the command that was slow isn't held up any further; if that thread falls
+more than a queue's worth behind, records are dropped and counted in
+slow_commands_dropped. Only the first MAX_ENTRIES queries and handlers are
+kept; queries_omitted and handlers_omitted say how many more there were."""
+from contextlib import contextmanager
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from .config import SLOW_COMMAND_MS, SLOW_COMMAND_LOG
+from .metrics import METRICS
+from .models import Log
+from . import stats
+
+MAX_ENTRIES = 200
+MAX_SQL = 500
+QUEUE_SIZE = 1000
+
+
+class SlowCommand:
+    """What a command has been up to, in case it turns out to be slow."""
+    def __init__(self, sender_obj, action, action_args):
+        if sender_obj.is_player_obj:
+            self.who = sender_obj.user_account.username
+        else:
+            self.who = sender_obj.shortname
+        room = sender_obj.room
+        self.room = None if room is None else room.shortname
+        self.action = action
+        self.action_args = action_args
+        self.queries = []
+        self.handlers = []
+        self.omitted = {'queries': 0, 'handlers': 0}
+
+    def _add(self, entries, kind, entry):
+        if len(entries) < MAX_ENTRIES:
+            entries.append(entry)
+        else:
+            self.omitted[kind] += 1
+
+    def query(self, sql, seconds):
+        self._add(self.queries, 'queries', {'sql': sql[:MAX_SQL], 'ms': round(seconds * 1000, 3)})
+
+    def handler(self, shortname, action, seconds):
+        self._add(self.handlers, 'handlers',
+                  {'shortname': shortname, 'action': action, 'ms': round(seconds * 1000, 3)})
+
+    def record(self, seconds):
+        record = {
+            'time': time.time(),
+            'who': self.who,
+            'room': self.room,
+            'action': self.action,
+            'args': self.action_args,
+            'total_ms': round(seconds * 1000, 3),
+            'queries': self.queries,
+            'handlers': self.handlers,
+        }
+        for kind, omitted in self.omitted.items():
+            if omitted:
+                record['{}_omitted'.format(kind)] = omitted
+        return record
+
+
+class SlowLog:
+    def __init__(self, threshold_ms=SLOW_COMMAND_MS, path=SLOW_COMMAND_LOG, queue_size=QUEUE_SIZE):
+        self.threshold = threshold_ms / 1000
+        self.path = path
+        self.env = os.environ.get('TILDEMUSH_ENV', 'live')
+        self._queue = queue.Queue(queue_size)
+        self._writer = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    @contextmanager
+    def watch(self, sender_obj, action, action_args):
+        """Logs the command run in the with block if it's slow."""
+        if not self.enabled:
+            yield
+            return
+        command = SlowCommand(sender_obj, action, action_args)
+        started = time.monotonic()
+        try:
+            with stats.watching(command):
+                yield
+        finally:
+            elapsed = time.monotonic() - started
+            if elapsed >= self.threshold:
+                self.write(command.record(elapsed))
+
+    def write(self, record):
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_forever, name='tildemush-slowlog', daemon=True)
+            self._writer.start()
+        METRICS.incr('slow_commands')
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            METRICS.incr('slow_commands_dropped')
+
+    def _write_forever(self):
+        stats.uncounted()
+        while True:
+            record = self._queue.get()
+            try:
+                line = json.dumps(record)
+                if self.path == 'db':
+                    Log.create(env=self.env, level='WARNING', raw=line)
+                else:
+                    with open(self.path, 'a') as f:
+                        f.write(line + '\n')
+            except Exception as e:
+                logging.getLogger('tmserver').error('failed to log slow command: {}'.format(e))
+                METRICS.incr('slow_commands_dropped')
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Waits for every record so far to be written."""
+        self._queue.join()
+
+
+SLOW_LOG = SlowLog()
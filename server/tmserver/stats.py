@@ -0,0 +1,280 @@
+"""Per verb and per action instrumentation, and exporting it.
+
+Every protocol message is measured under its verb (LOGIN, COMMAND, MAP...)
+and every action run in the world under its action (say, go, look...), with
+a few things counted while it's running:
+
+  <kind>_seconds.<name>   histogram of how long it took
+  <kind>_calls.<name>     how many there have been
+  <kind>_queries.<name>   database queries issued
+  <kind>_compiles.<name>  WITCH scripts compiled
+  <kind>_handlers.<name>  WITCH handlers run
+
+where kind is verb or action. Verbs also count verb_bytes_sent.<name>, the
+bytes sent to a client while its message was being handled; every frame
+counts towards bytes_sent.<verb> and frames_sent.<verb> by the kind of frame
+it is. Totals go into db_queries, witch_compiles and witch_handlers.
+
+Anything that wants the details (which queries, which handlers and how long
+each took; see slowlog.py) can be a watcher while something runs.
+
+Counting works off a stack of tallies for whatever's running right now. World
+work only ever runs on one thread at a time (see dbthread.py and
+timeslice.py), so the stack is shared by all of them; an action suspended
+partway through keeps counting whatever else runs until it resumes, so its
+counts are approximate. To keep the number of metrics bounded, actions that
+aren't one of GAME_ACTIONS (ie, provided by some script) are lumped together
+as other.
+
+With TILDEMUSH_STATS_PORT set, everything in METRICS is served in the
+Prometheus text format on that port, on TILDEMUSH_STATS_BIND (localhost by
+default). Gods can see a summary in game with /stats."""
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+import re
+import threading
+import time
+
+from .metrics import METRICS
+from .wire import VERB_RE, VERBS
+
+# actions the game itself handles or every object provides
+GAME_ACTIONS = ('announce', 'throttles', 'stats', 'profile', 'whisper', 'look', 'create', 'edit',
+                'read', 'mode', 'go', 'home', 'foyer', 'get', 'drop', 'put', 'remove',
+                'say', 'emote', 'debug', 'contain')
+
+TALLIED = ('queries', 'compiles', 'handlers')
+TOTALS = {'queries': 'db_queries', 'compiles': 'witch_compiles', 'handlers': 'witch_handlers'}
+
+_tallies = []
+_watchers = []
+# for threads doing housekeeping of their own outside of world work
+_local = threading.local()
+
+PROMETHEUS_NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def verb_label(message):
+    verb = message.split(' ', 1)[0].split('\n', 1)[0]
+    return verb if verb in VERBS else 'other'
+
+
+def action_label(action):
+    return action if action in GAME_ACTIONS else 'other'
+
+
+def frame_kind(message, verb=None):
+    """What kind of frame message goes out as, as the wire would put it."""
+    if verb is not None:
+        return verb
+    match = VERB_RE.fullmatch(message)
+    if match is not None and match.group(1) in VERBS:
+        return match.group(1)
+    return 'TEXT'
+
+
+def count(what, n=1):
+    """Counts n of what (one of TALLIED) against the total and everything
+    running."""
+    METRICS.incr(TOTALS[what], n)
+    for tally in _tallies:
+        tally[what] += n
+
+
+@contextmanager
+def tallying(tally):
+    """Counts what happens in the with block into tally as well."""
+    _tallies.append(tally)
+    try:
+        yield tally
+    finally:
+        # not necessarily on top; see the module docstring
+        _tallies.remove(tally)
+
+
+@contextmanager
+def watching(watcher):
+    """Tells watcher about each query (watcher.query(sql, seconds)) and
+    WITCH handler (watcher.handler(shortname, action, seconds)) run in the
+    with block."""
+    _watchers.append(watcher)
+    try:
+        yield watcher
+    finally:
+        _watchers.remove(watcher)
+
+
+def watch(watcher):
+    """Makes watcher a watcher of everything from now on."""
+    _watchers.append(watcher)
+
+
+@contextmanager
+def handling(shortname, action):
+    """Counts a WITCH handler of shortname's for action running in the with
+    block."""
+    count('handlers')
+    if not _watchers:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        for watcher in _watchers:
+            watcher.handler(shortname, action, elapsed)
+
+
+def uncounted():
+    """Stops counting or watching anything the calling thread does."""
+    _local.uncounted = True
+
+
+def tallied(tally, fn):
+    """Returns fn wrapped to count into tally, wherever it ends up running."""
+    if tally is None:
+        return fn
+
+    def run(*args):
+        with tallying(tally):
+            return fn(*args)
+    return run
+
+
+def record(kind, name, seconds, tally):
+    METRICS.observe('{}_seconds.{}'.format(kind, name), seconds)
+    METRICS.incr('{}_calls.{}'.format(kind, name))
+    for what, n in tally.items():
+        METRICS.incr('{}_{}.{}'.format(kind, what, name), n)
+
+
+@contextmanager
+def measure_action(action):
+    started = time.monotonic()
+    with tallying(Counter()) as tally:
+        try:
+            yield
+        finally:
+            record('action', action_label(action), time.monotonic() - started, tally)
+
+
+def sent(kind, size, tally=None):
+    METRICS.incr('bytes_sent.{}'.format(kind), size)
+    METRICS.incr('frames_sent.{}'.format(kind))
+    if tally is not None:
+        tally['bytes_sent'] += size
+
+
+def counted(database):
+    """Makes database count the queries it runs. Returns it."""
+    execute_sql = database.execute_sql
+
+    def execute_counted(sql, *args, **kwargs):
+        if getattr(_local, 'uncounted', False):
+            return execute_sql(sql, *args, **kwargs)
+        count('queries')
+        if not _watchers:
+            return execute_sql(sql, *args, **kwargs)
+        started = time.monotonic()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - started
+            for watcher in _watchers:
+                watcher.query(sql, elapsed)
+    database.execute_sql = execute_counted
+    return database
+
+
+def summary(kind=None):
+    """Lines describing each verb and action (or just those of kind): how
+    often it's been seen, its latency quantiles and what it costs per call."""
+    lines = []
+    for k in (kind,) if kind else ('verb', 'action'):
+        prefix = '{}_calls.'.format(k)
+        names = sorted((n[len(prefix):] for n in METRICS.counters if n.startswith(prefix)),
+                       key=lambda name: -METRICS.get(prefix + name))
+        for name in names:
+            calls = METRICS.get(prefix + name)
+            histogram = METRICS.histogram('{}_seconds.{}'.format(k, name))
+            parts = ['{} {}: {} calls'.format(k, name, calls)]
+            if histogram is not None:
+                parts.append('p50/p95/p99 {:g}/{:g}/{:g}ms'.format(
+                    *(1000 * histogram.quantile(q) for q in (0.5, 0.95, 0.99))))
+            for what in TALLIED + (('bytes_sent',) if k == 'verb' else ()):
+                total = METRICS.get('{}_{}.{}'.format(k, what, name))
+                if total:
+                    parts.append('{:.1f} {}'.format(total / calls, what.replace('_', ' ')))
+            lines.append(', '.join(parts))
+    return lines
+
+
+def _prometheus_name(name):
+    metric, _, key = name.partition('.')
+    metric = 'tildemush_' + PROMETHEUS_NAME_RE.sub('_', metric)
+    if not key:
+        return metric, ''
+    key = key.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return metric, 'key="{}"'.format(key)
+
+
+def _labels(*labels):
+    labels = [l for l in labels if l]
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+
+def _family(families, metric, kind):
+    """Returns the name and list of samples of the family metric belongs
+    in. The same name may be used for (say) a gauge and a histogram, which
+    Prometheus doesn't allow, so the second gets its kind appended."""
+    if metric in families and families[metric][0] != kind:
+        metric = '{}_{}'.format(metric, kind)
+    return metric, families.setdefault(metric, (kind, []))[1]
+
+
+def prometheus(metrics=METRICS):
+    """Renders metrics in the Prometheus text exposition format."""
+    families = {}
+    for kind, values in (('counter', metrics.counters), ('gauge', metrics.gauges)):
+        for name, value in sorted(values.items()):
+            metric, label = _prometheus_name(name)
+            metric, family = _family(families, metric, kind)
+            family.append('{}{} {}'.format(metric, _labels(label), value))
+    for name, histogram in sorted(metrics.histograms.items()):
+        metric, label = _prometheus_name(name)
+        metric, family = _family(families, metric, 'histogram')
+        seen = 0
+        for bound, n in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            seen += n
+            family.append('{}_bucket{} {}'.format(metric, _labels(label, 'le="{}"'.format(bound)), seen))
+        family.append('{}_sum{} {}'.format(metric, _labels(label), histogram.sum))
+        family.append('{}_count{} {}'.format(metric, _labels(label), histogram.count))
+    lines = []
+    for metric, (kind, samples) in sorted(families.items()):
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request.split(b' ')[:2] == [b'GET', b'/metrics']:
+            status, body = '200 OK', prometheus().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'try /metrics\n'
+        writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode('ascii'))
+        writer.write(body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def serve(loop, bind, port):
+    """Returns a coroutine starting the metrics endpoint on loop."""
+    return asyncio.start_server(_serve_metrics, bind, port, loop=loop)
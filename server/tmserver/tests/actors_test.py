@@ -0,0 +1,70 @@
+import asyncio
+
+from ..actors import RoomLocks
+from ..models import UserAccount, GameObject
+from ..world import GameWorld
+from .tm_test_case import EventLoopMixin, TildemushTestCase, TildemushUnitTestCase
+
+
+class RoomLocksTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.locks = RoomLocks()
+        self.trail = []
+
+    async def command(self, name, room_ids, exclusive=False, pause=0.01):
+        async with self.locks.hold(room_ids, exclusive):
+            self.trail.append('{} start'.format(name))
+            await asyncio.sleep(pause)
+            self.trail.append('{} end'.format(name))
+
+    def run_all(self, *commands):
+        self.loop.run_until_complete(asyncio.gather(*commands))
+
+    def test_same_room_is_serial(self):
+        self.run_all(self.command('a', [1]), self.command('b', [1]))
+        assert self.trail == ['a start', 'a end', 'b start', 'b end']
+        assert len(self.locks) == 0
+
+    def test_different_rooms_interleave(self):
+        self.run_all(self.command('a', [1]), self.command('b', [2]))
+        assert self.trail[:2] == ['a start', 'b start']
+
+    def test_opposite_order_does_not_deadlock(self):
+        self.run_all(self.command('a', [1, 2]), self.command('b', [2, 1]))
+        assert self.trail == ['a start', 'a end', 'b start', 'b end']
+
+    def test_exclusive_waits_for_everything(self):
+        self.run_all(
+            self.command('a', [1]),
+            self.command('announce', [], exclusive=True),
+            self.command('b', [2]))
+        assert self.trail.index('announce start') == self.trail.index('a end') + 1
+        assert self.trail.index('b start') == self.trail.index('announce end') + 1
+
+    def test_covers(self):
+        hold = self.locks.hold([2, 1])
+        assert hold.covers([1])
+        assert hold.covers({1, 2})
+        assert not hold.covers([3])
+        assert not hold.covers([], exclusive=True)
+        assert self.locks.hold([], exclusive=True).covers([3])
+
+
+class RoomsForTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        self.foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        GameWorld.put_into(self.foyer, self.vil.player_obj)
+
+    def test_plain_command(self):
+        assert GameWorld.rooms_for(self.vil.player_obj, 'say', 'hi') == ({self.foyer.id}, False)
+
+    def test_home(self):
+        sanctum = GameObject.get(GameObject.shortname=='vilmibm/sanctum')
+        rooms, _ = GameWorld.rooms_for(self.vil.player_obj, 'home', '')
+        assert rooms == {self.foyer.id, sanctum.id}
+
+    def test_announce(self):
+        assert GameWorld.rooms_for(self.vil.player_obj, 'announce', 'hi') == ((), True)
@@ -141,6 +141,50 @@ async def test_game_command(client):
         'vilmibm says, "hello"'])
 
 
+async def recv_until(client, last):
+    recvd = []
+    while not recvd or recvd[-1] != last:
+        recvd.append(await client.recv())
+    return recvd
+
+
+@pytest.mark.asyncio
+async def test_request_ids(client):
+    await client.send('#a1 PING', ['#a1 PONG'])
+    await client.send('#a2 GARBAGE', ['#a2 ERROR: message not understood'])
+    await client.send('PING', ['PONG'])
+
+
+@pytest.mark.asyncio
+async def test_batch(client):
+    await client.send('REGISTER vilmibm:foobarbazquux', ['REGISTER OK'])
+    await client.send('#1 LOGIN vilmibm:foobarbazquux', ['#1 LOGIN OK'])
+    await client.send('#2 BATCH {}'.format(json.dumps(['COMMAND say hi', 'COMMAND say bye'])))
+    recvd = await recv_until(client, '#2 BATCH OK')
+    replies = [m for m in recvd if m.startswith('#')]
+    assert replies == ['#2.0 COMMAND OK', '#2.1 COMMAND OK', '#2 BATCH OK']
+    assert 'vilmibm says, "hi"' in recvd
+    assert 'vilmibm says, "bye"' in recvd
+
+
+@pytest.mark.asyncio
+async def test_batch_stops_at_failure(client):
+    await client.send('REGISTER vilmibm:foobarbazquux', ['REGISTER OK'])
+    await client.send('#1 LOGIN vilmibm:foobarbazquux', ['#1 LOGIN OK'])
+    await client.send('#2 BATCH {}'.format(json.dumps(['COMMAND announce hi', 'COMMAND say hi'])))
+    recvd = await recv_until(client, '#2 BATCH STOPPED 0')
+    replies = [m for m in recvd if m.startswith('#')]
+    assert replies == ['#2.0 {red}you are not powerful enough to do that.{/}', '#2 BATCH STOPPED 0']
+
+
+@pytest.mark.asyncio
+async def test_batch_needs_framing(client):
+    await client.setup_user('vilmibm')
+    await client.send('#2 BATCH ["COMMAND say hi"]')
+    recvd = await recv_until(client, '#2 ERROR: BATCH needs request ids; log in with one to use it')
+    assert not any('says' in m for m in recvd)
+
+
 @pytest.mark.asyncio
 async def test_announce_forbidden(client):
     await client.setup_user('vilmibm')
@@ -0,0 +1,91 @@
+import ast
+from unittest.mock import Mock, patch
+
+from ..bytecode import BytecodeInterpreter, validate
+from ..errors import WitchError, WitchBudgetExceeded
+from ..models import UserAccount, GameObject
+from ..scripting import WitchInterpreter, compile_witch
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class ValidateTest(TildemushUnitTestCase):
+    def test_rejects(self):
+        bad = [
+            'import os',
+            'from os import path',
+            'x.__class__',
+            '__import__("os")',
+            'x.gi_frame',
+            '"{0.__class__}".format(x)',
+            'class Foo: pass',
+            'lambda: 1',
+        ]
+        for code in bad:
+            with self.assertRaises(WitchError):
+                validate(ast.parse(code))
+
+    def test_accepts(self):
+        validate(ast.parse('def f(a):\n    for i in range(a):\n        says(str(i))\n'))
+
+
+class BytecodeInterpreterTest(TildemushUnitTestCase):
+    def test_namespace(self):
+        bi = BytecodeInterpreter(dict(secret=lambda: 'ok'))
+        bi(ast.parse('x = secret()'))
+        assert bi.namespace['x'] == 'ok'
+        bi(ast.parse('y = open'))
+        bi(ast.parse('z = eval("1")'))
+        assert "'eval' is not defined" in bi.error_msg
+
+    def test_metering(self):
+        bi = BytecodeInterpreter({})
+        bi(ast.parse('def f():\n    while True:\n        pass\n'))
+        bi.start_metering(100, 10)
+        with self.assertRaisesRegex(WitchBudgetExceeded, 'more than 100 steps'):
+            bi.namespace['f']()
+        bi.stop_metering()
+
+    def test_metering_comprehensions(self):
+        bi = BytecodeInterpreter({})
+        bi(ast.parse('def f():\n    return [x for x in range(10**9)]\n'
+                     'def g():\n    return [y for x in range(10) for y in range(10**9)]\n'))
+        for name in ('f', 'g'):
+            bi.start_metering(100, 10)
+            with self.assertRaisesRegex(WitchBudgetExceeded, 'more than 100 steps'):
+                bi.namespace[name]()
+            bi.stop_metering()
+        bi.start_metering(100, 10)
+        bi(ast.parse('squares = [x * x for x in range(10)]'))
+        bi.stop_metering()
+        assert bi.namespace['squares'] == [x * x for x in range(10)]
+
+
+@patch('tmserver.scripting.WITCH_BACKEND', 'bytecode')
+class BytecodeBackendTest(TildemushUnitTestCase):
+    def test_handlers(self):
+        receiver = Mock()
+        receiver.editing_set = []
+        wi = WitchInterpreter(receiver)
+        assert isinstance(wi.interpreter, BytecodeInterpreter)
+        for witch_ast in compile_witch('''
+            (incantation by vilmibm
+              (has {"name" "horse" "description" "a horse"})
+              (provides "pet" (says "neigh"))
+              (hears "*hay*" (says (+ "i love " heard))))'''):
+            wi.evaluate_ast(witch_ast)
+
+        engine = wi.script_engine
+        engine.provides['pet'](Mock(), Mock(), 'pet', '')
+        receiver.say.assert_called_with('neigh')
+        engine.hears['*hay*'](Mock(), Mock(), 'hay')
+        receiver.say.assert_called_with('i love hay')
+
+    def test_rejects_introspection(self):
+        wi = WitchInterpreter(Mock())
+        with self.assertRaisesRegex(WitchError, "no safe attribute '__subclasses__'"):
+            for witch_ast in compile_witch('''
+                (incantation by someone
+                  (provides "lol"
+                    ((get (.__subclasses__ (get print.__class__.__bases__ 0)) 323) "bash")))'''):
+                wi.evaluate_ast(witch_ast)
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from ..cluster import Cluster, MessageBus, RemoteSession, region_of
+from ..models import UserAccount, GameObject
+from ..world import GameWorld
+from .tm_test_case import EventLoopMixin, TildemushTestCase, TildemushUnitTestCase
+
+
+class RegionTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        self.foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        self.sanctum = GameObject.get(GameObject.shortname=='vilmibm/sanctum')
+
+    def test_explicit_shortname(self):
+        assert 3 == region_of(self.foyer, nodes=4, regions={'god/foyer': 3, 'god': 1})
+
+    def test_explicit_owner(self):
+        assert 2 == region_of(self.sanctum, nodes=4, regions={'vilmibm': 2})
+
+    def test_owner_hash_keeps_builds_together(self):
+        room = GameWorld.create_room(self.vil.player_obj, 'Den', 'cozy')
+        assert region_of(room, nodes=4, regions={}) == region_of(self.sanctum, nodes=4, regions={})
+
+
+class BusTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_session_forwarding(self):
+        world = mock.Mock()
+        node0 = Cluster(world, node=0, nodes=2, socket_dir=self.socket_dir)
+        node1 = Cluster(world, node=1, nodes=2, socket_dir=self.socket_dir)
+        session = mock.Mock()
+        session.user_account.id = 7
+
+        async def scenario():
+            await node0.start()
+            await node1.start()
+            await node0.session_opened(session)
+            await asyncio.sleep(0.05)
+            RemoteSession(node1, 0, 7).handle_hears(None, 'psst')
+            await asyncio.sleep(0.05)
+            await node0.bus.stop()
+            await node1.bus.stop()
+
+        self.loop.run_until_complete(scenario())
+        world.attach_session.assert_called_once()
+        assert world.attach_session.call_args[0][0] == 7
+        session.handle_hears.assert_called_once_with(None, 'psst')
+
+    def test_sessions_dropped_when_their_node_restarts(self):
+        world = mock.Mock()
+        cluster = Cluster(world, node=0, nodes=3, socket_dir=self.socket_dir, logger=mock.Mock())
+
+        async def scenario():
+            await cluster.handle({'type': 'online', 'sender': 1, 'user_account_id': 7})
+            await cluster.handle({'type': 'online', 'sender': 1, 'user_account_id': 7})
+            await cluster.handle({'type': 'online', 'sender': 2, 'user_account_id': 8})
+            await cluster.handle({'type': 'hello', 'sender': 1})
+        self.loop.run_until_complete(scenario())
+        assert world.attach_session.call_count == 2
+        world.detach_session.assert_called_once_with(7)
+        assert list(cluster.remote_sessions) == [8]
+
+    def test_refuses_shared_socket_dir(self):
+        os.chmod(self.socket_dir, 0o777)
+        bus = MessageBus(0, mock.Mock(), socket_dir=self.socket_dir, logger=mock.Mock())
+        with self.assertRaisesRegex(RuntimeError, 'mode 0700'):
+            self.loop.run_until_complete(bus.start())
+
+    def test_unreachable_node(self):
+        bus = MessageBus(0, mock.Mock(), socket_dir=self.socket_dir, logger=mock.Mock())
+        assert not self.loop.run_until_complete(bus.send(5, {'type': 'hello'}))
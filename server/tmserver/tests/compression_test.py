@@ -0,0 +1,41 @@
+from websockets.framing import Frame, OP_TEXT, OP_PING
+
+from ..compression import ThresholdDeflate, ThresholdDeflateFactory
+from .tm_test_case import TildemushUnitTestCase
+
+
+class ThresholdDeflateTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.extension = ThresholdDeflate(False, False, 15, 15, {'memLevel': 5}, min_size=64)
+
+    def test_small_frames_uncompressed(self):
+        frame = Frame(True, OP_TEXT, b'COMMAND OK')
+        assert self.extension.encode(frame) == frame
+
+    def test_large_frames_compressed(self):
+        data = b'STATE ' + b'a murky jar of pickles ' * 50
+        encoded = self.extension.encode(Frame(True, OP_TEXT, data))
+        assert encoded.rsv1
+        assert len(encoded.data) < len(data)
+
+    def test_mixed_frames_round_trip(self):
+        # skipping small messages mustn't upset the shared compression context
+        peer = ThresholdDeflate(False, False, 15, 15, min_size=64)
+        messages = [b'COMMAND OK', b'STATE ' + b'jar ' * 100, b'PONG', b'STATE ' + b'jar ' * 101]
+        for message in messages:
+            decoded = peer.decode(self.extension.encode(Frame(True, OP_TEXT, message)))
+            assert decoded.data == message
+
+    def test_control_frames_untouched(self):
+        frame = Frame(True, OP_PING, b'x' * 100)
+        assert self.extension.encode(frame) == frame
+
+    def test_factory(self):
+        factory = ThresholdDeflateFactory(
+            min_size=100, server_max_window_bits=12, compress_settings={'memLevel': 5})
+        params, extension = factory.process_request_params([], [])
+        assert isinstance(extension, ThresholdDeflate)
+        assert extension.min_size == 100
+        assert extension.local_max_window_bits == 12
+        assert ('server_max_window_bits', '12') in params
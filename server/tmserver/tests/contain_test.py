@@ -35,6 +35,16 @@ class ContainTest(TildemushTestCase):
         assert self.phone in player_obj.contains
         assert self.app in self.phone.contains
 
+    def test_ghost_busting_many_players(self):
+        snoozy = UserAccount.create(
+            username='snoozy',
+            password='foobarbazquux')
+        GameWorld.put_into(self.room, self.vil.player_obj)
+        GameWorld.put_into(self.room, snoozy.player_obj)
+        GameWorld.put_into(self.room, self.phone)
+        bust_ghosts()
+        assert list(self.room.contains) == [self.phone]
+
     def test_player_obj(self):
         player_obj = self.vil.player_obj
         assert player_obj.name == self.vil.username
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+from unittest import mock
+
+from ..dbthread import DBExecutor
+from .tm_test_case import EventLoopMixin, TildemushUnitTestCase
+
+
+class DBExecutorTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.executor = DBExecutor(queue_size=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_runs_off_the_loop_thread(self):
+        result = self.loop.run_until_complete(
+            self.executor.run(lambda x: (x * 2, threading.get_ident()), 21))
+        assert result[0] == 42
+        assert result[1] != threading.get_ident()
+
+    def test_runs_everything_on_one_thread_in_order(self):
+        trail = []
+        def work(n):
+            trail.append((n, threading.get_ident()))
+        self.loop.run_until_complete(asyncio.gather(
+            *[self.executor.run(work, n) for n in range(5)]))
+        assert [n for n, _ in trail] == list(range(5))
+        assert len({thread for _, thread in trail}) == 1
+
+    def test_errors_propagate(self):
+        def fn():
+            raise ValueError('oops')
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.executor.run(fn))
+
+    def test_submitted_failures_are_logged(self):
+        def fn():
+            raise ValueError('oops')
+        with mock.patch('tmserver.dbthread.logging') as logging:
+            self.executor.submit(fn).exception()
+            assert logging.getLogger.return_value.error.called
@@ -0,0 +1,86 @@
+from ..metrics import METRICS
+from ..models import UserAccount, GameObject
+from ..scripting import ENGINES, EngineCache, ScriptEngine
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class EngineCacheTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        METRICS.reset()
+
+    def test_evicts_least_recently_active(self):
+        cache = EngineCache(max_size=2)
+        cache.put(1, 10, ScriptEngine(None))
+        cache.put(2, 20, ScriptEngine(None))
+        cache.touch(1)
+        cache.put(3, 30, ScriptEngine(None))
+        assert 1 in cache
+        assert 2 not in cache
+        assert 3 in cache
+        assert METRICS.get('engine_cache_evictions') == 1
+
+    def test_forgets_old_drops(self):
+        cache = EngineCache(max_size=2)
+        for obj_id in range(5):
+            cache.put(obj_id, None, ScriptEngine(None))
+        assert list(cache._dropped) == [1, 2]
+        cache.put(0, None, ScriptEngine(None))
+        assert METRICS.get('engine_cache_rehydrations') == 0
+
+    def test_stale_revision_misses(self):
+        cache = EngineCache()
+        engine = ScriptEngine(None)
+        cache.put(1, 10, engine)
+        assert cache.get(1, 10) is engine
+        assert cache.get(1, 11) is None
+
+    def test_counts_rehydrations(self):
+        cache = EngineCache()
+        cache.put(1, 10, ScriptEngine(None))
+        cache.hibernate([1])
+        assert 1 not in cache
+        cache.put(1, 10, ScriptEngine(None))
+        assert METRICS.get('engine_cache_hibernations') == 1
+        assert METRICS.get('engine_cache_rehydrations') == 1
+
+
+class HibernationTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        self.foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        self.room = GameWorld.create_room(self.vil.player_obj, 'Empty Hall', 'nobody is here')
+        self.horse = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/horse', 'item', dict(name='horse', description='a horse'))
+        GameWorld.put_into(self.room, self.horse)
+        GameWorld.put_into(self.foyer, self.vil.player_obj)
+
+    def test_engines_are_shared_between_instances(self):
+        engine = self.horse.engine
+        assert GameObject.get_by_id(self.horse.id).engine is engine
+
+    def test_idle_rooms_hibernate(self):
+        self.horse.engine
+        self.foyer.engine
+        GameWorld.hibernate_idle_rooms(idle_for=60, now=0)
+        assert self.horse.id in ENGINES
+
+        GameWorld.hibernate_idle_rooms(idle_for=60, now=61)
+        assert self.horse.id not in ENGINES
+        assert self.room.id not in ENGINES
+        assert self.foyer.id in ENGINES
+        assert self.room.id not in GameWorld._last_occupied
+        assert self.foyer.id in GameWorld._last_occupied
+
+    def test_rehydrates_transparently(self):
+        hibernated = self.horse.engine
+        GameWorld.hibernate_idle_rooms(idle_for=0)
+        assert self.horse.id not in ENGINES
+
+        horse = GameObject.get_by_id(self.horse.id)
+        GameWorld.dispatch_action(self.vil.player_obj, 'look', '')
+        assert horse.engine is not hibernated
+        assert horse.get_data('name') == 'horse'
+        assert self.horse.id in ENGINES
@@ -0,0 +1,176 @@
+import asyncio
+from unittest import mock
+
+from ..actors import RoomLocks
+from ..errors import UserError
+from ..events import CascadeRoot, Event, EventQueue
+from ..models import UserAccount, GameObject
+from ..world import GameWorld
+from .tm_test_case import EventLoopMixin, TildemushTestCase, TildemushUnitTestCase
+
+
+class EventQueueTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = EventQueue(max_depth=2, max_per_root=3, logger=mock.Mock())
+        self.root = CascadeRoot('vilmibm', 'say')
+
+    def test_fifo(self):
+        first = Event('a', 'say', 'hi', 1, self.root)
+        second = Event('b', 'say', 'hi', 1, self.root)
+        self.queue.push(first)
+        self.queue.push(second)
+        assert self.queue.pop() is first
+        assert self.queue.pop() is second
+        assert len(self.queue) == 0
+
+    def test_depth_limit(self):
+        assert self.queue.push(Event('a', 'say', 'hi', 2, self.root))
+        assert not self.queue.push(Event('a', 'say', 'hi', 3, self.root))
+        assert self.root.dropped == 1
+
+    def test_per_root_limit(self):
+        for _ in range(3):
+            assert self.queue.push(Event('a', 'say', 'hi', 1, self.root))
+        assert not self.queue.push(Event('a', 'say', 'hi', 1, self.root))
+        other_root = CascadeRoot('snoozy', 'say')
+        assert self.queue.push(Event('a', 'say', 'hi', 1, other_root))
+
+    def test_pop_first(self):
+        first = Event('a', 'say', 'hi', 1, self.root)
+        second = Event('b', 'say', 'hi', 1, self.root)
+        self.queue.push(first)
+        self.queue.push(second)
+        assert self.queue.pop_first(lambda e: e.sender_obj == 'b') is second
+        assert self.queue.pop_first(lambda e: e.sender_obj == 'b') is None
+        assert self.queue.pop() is first
+
+    def test_waiting_on_a_root(self):
+        seen = []
+        self.root.when_finished(seen.append)
+        assert seen == []
+        self.root.finish('oops')
+        self.root.when_finished(seen.append)
+        assert seen == ['oops', 'oops']
+
+
+class CascadeTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        GameWorld.set_loop(None)
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        self.room = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/echo-chamber', 'room', dict(
+                name='echo chamber', description='echoey'))
+        for name in ('ping', 'pong'):
+            obj = GameObject.create_scripted_object(
+                self.vil, 'vilmibm/{}'.format(name), 'item', dict(
+                    name=name, description='a parrot'))
+            GameWorld.handle_revision(
+                self.vil.player_obj,
+                obj.shortname,
+                '''(incantation by vilmibm
+                     (has {{"name" "{}" "description" "a parrot"}})
+                     (hears "*" (says heard)))'''.format(name),
+                obj.script_revision.id)
+            GameWorld.put_into(self.room, obj)
+        GameWorld.put_into(self.room, self.vil.player_obj)
+
+    def test_runaway_cascade_is_cut_off(self):
+        with mock.patch('tmserver.world.GameWorld.perform_action',
+                        wraps=GameWorld.perform_action) as m:
+            GameWorld.dispatch_action(self.vil.player_obj, 'say', 'hello')
+
+        assert len(GameWorld._events) == 0
+        assert m.call_count <= GameWorld._events.max_per_root + 1
+        assert m.call_count > 1
+
+    def test_state_follows_what_was_said(self):
+        session = mock.Mock()
+        GameWorld.register_session(self.vil, session)
+        GameWorld.dispatch_action(self.vil.player_obj, 'say', 'hello')
+        calls = [name for name, _, _ in session.method_calls
+                 if name in ('handle_hears', 'handle_client_update')]
+        first_update = calls.index('handle_client_update')
+        assert 'handle_hears' in calls
+        assert 'handle_hears' not in calls[first_update:]
+
+
+class SlicingTest(EventLoopMixin, TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        GameWorld.set_loop(self.loop)
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        self.snoozy = UserAccount.create(username='snoozy', password='foobarbazquux')
+        self.room = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/slow-room', 'room', dict(
+                name='slow room', description='time passes slowly here'))
+        self.clock = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/clock', 'item', dict(
+                name='clock', description='it ticks'))
+        GameWorld.handle_revision(
+            self.vil.player_obj,
+            self.clock.shortname,
+            '''(incantation by vilmibm
+                 (has {"name" "clock" "description" "it ticks"})
+                 (hears "*" (for [i (range 2000)] (+ i 1))))''',
+            self.clock.script_revision.id)
+        GameWorld.put_into(self.room, self.clock)
+        GameWorld.put_into(self.room, self.vil.player_obj)
+        self.foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        GameWorld.put_into(self.foyer, self.snoozy.player_obj)
+
+    def tearDown(self):
+        GameWorld.set_loop(None)
+        super().tearDown()
+
+    def test_slow_handler_is_suspended(self):
+        with mock.patch('tmserver.scripting.WITCH_SLICE_STEPS', 100):
+            GameWorld.dispatch_action(self.vil.player_obj, 'say', 'tick tock')
+            assert self.room.id in GameWorld._suspended
+
+            # somewhere else, things carry on
+            with mock.patch('tmserver.world.GameWorld.perform_action') as m:
+                GameWorld.dispatch_action(self.snoozy.player_obj, 'say', 'hi')
+            assert m.called
+
+            # but here, they wait their turn
+            GameWorld.dispatch_action(self.vil.player_obj, 'say', 'hello?')
+            assert len(GameWorld._events) == 1
+            assert GameWorld._events._queue[0].place == self.room.id
+
+            while GameWorld._suspended or GameWorld._events:
+                self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+
+    def test_resumes_under_the_room_lock(self):
+        locks = RoomLocks()
+        GameWorld.set_room_locks(locks)
+
+        async def scenario():
+            async with locks.hold([self.room.id]):
+                GameWorld.dispatch_action(self.vil.player_obj, 'say', 'tick tock')
+                for _ in range(5):
+                    await asyncio.sleep(0)
+                # a command still holds the room, so the clock waits for it
+                assert self.room.id in GameWorld._suspended
+            while GameWorld._suspended:
+                await asyncio.sleep(0)
+        with mock.patch('tmserver.scripting.WITCH_SLICE_STEPS', 100):
+            self.loop.run_until_complete(scenario())
+
+    def test_waiting_on_commands(self):
+        with mock.patch('tmserver.scripting.WITCH_SLICE_STEPS', 100):
+            slow = GameWorld.dispatch_action(self.vil.player_obj, 'say', 'tick tock')
+            queued = GameWorld.dispatch_action(self.vil.player_obj, 'go', 'nowhere')
+            assert not slow.finished
+            assert not queued.finished
+            with self.assertRaisesRegex(UserError, 'cannot go that way'):
+                self.loop.run_until_complete(GameWorld.finished(queued))
+            assert slow.finished
+            self.loop.run_until_complete(GameWorld.finished(slow))
+
+    def test_no_loop_no_slicing(self):
+        GameWorld.set_loop(None)
+        with mock.patch('tmserver.scripting.WITCH_SLICE_STEPS', 100):
+            GameWorld.dispatch_action(self.vil.player_obj, 'say', 'tick tock')
+        assert not GameWorld._suspended
@@ -1,8 +1,9 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from ..errors import WitchError
-from ..models import GameObject, Script, ScriptRevision, UserAccount, Permission
+from ..models import GameObject, Script, ScriptRevision, UserAccount, Permission, BudgetViolation
+from ..scripting import WitchInterpreter, compile_witch
 from ..world import GameWorld
-from .tm_test_case import TildemushTestCase
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
 
 class EvilWitchTest(TildemushTestCase):
     def setUp(self):
@@ -76,3 +77,80 @@ class EvilWitchTest(TildemushTestCase):
         with self.assertRaisesRegex(NotImplementedError, 'witch_open') as cm:
             game_obj.init_scripting()
             game_obj.handle_action(GameWorld, game_obj, 'lol', '')
+
+
+class DeletedOpenTest(TildemushUnitTestCase):
+    """Deleting the WITCH open stub mustn't uncover asteval's real one from
+    the builtins the interpreters share."""
+    def assert_cannot_open(self, code):
+        wi = WitchInterpreter(MagicMock())
+        with self.assertRaisesRegex(WitchError, "name 'open' is not defined"):
+            for witch_ast in compile_witch(code):
+                wi.evaluate_ast(witch_ast)
+
+    def test_deleted(self):
+        self.assert_cannot_open('(del open) (open "/etc/passwd" "rb")')
+
+    def test_rebound_then_deleted(self):
+        self.assert_cannot_open('(setv open 1) (del open) (open "/etc/passwd" "rb")')
+
+    @patch('tmserver.scripting.WITCH_BACKEND', 'bytecode')
+    def test_deleted_bytecode(self):
+        self.test_deleted()
+
+    @patch('tmserver.scripting.WITCH_BACKEND', 'bytecode')
+    def test_rebound_then_deleted_bytecode(self):
+        self.test_rebound_then_deleted()
+
+
+class WitchBudgetTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ua = UserAccount.create(
+            username='vilmibm',
+            password='foobarbazquux')
+        self.obj = GameObject.create_scripted_object(
+            self.ua, 'vilmibm/spinner', 'item', dict(
+                name='spinner',
+                description='it spins'))
+        GameWorld.handle_revision(
+            self.ua.player_obj,
+            'vilmibm/spinner',
+            """
+            (incantation by vilmibm
+              (has {"name" "spinner" "description" "it spins"})
+              (provides "spin"
+                (while True (setv x 1)))
+              (provides "nudge"
+                (says "wheee")))""",
+            self.obj.script_revision.id)
+        self.obj = GameObject.get(GameObject.shortname=='vilmibm/spinner')
+
+    @patch('tmserver.scripting.WITCH_BUDGET', (1000, 10.0))
+    def test_step_limit(self):
+        _, result = self.obj.handle_action(GameWorld, self.ua.player_obj, 'spin', '')
+        assert result is None
+        violation = BudgetViolation.get(BudgetViolation.game_obj==self.obj)
+        assert 'more than 1000 steps' in violation.reason
+
+    @patch('tmserver.scripting.WITCH_BUDGET', (10**9, 0.05))
+    def test_time_limit(self):
+        self.obj.handle_action(GameWorld, self.ua.player_obj, 'spin', '')
+        violation = BudgetViolation.get(BudgetViolation.game_obj==self.obj)
+        assert 'time limit' in violation.reason
+
+    @patch('tmserver.scripting.WITCH_BUDGET', (1000, 10.0))
+    def test_still_works_after_violation(self):
+        self.obj.handle_action(GameWorld, self.ua.player_obj, 'spin', '')
+        with patch('tmserver.scripting.ScriptedObjectMixin.say') as m:
+            self.obj.handle_action(GameWorld, self.ua.player_obj, 'nudge', '')
+        assert m.called
+
+    @patch('tmserver.scripting.WITCH_BUDGET', (1000, 10.0))
+    @patch('tmserver.models.WITCH_QUARANTINE_AFTER', 2)
+    def test_quarantine(self):
+        self.obj.handle_action(GameWorld, self.ua.player_obj, 'spin', '')
+        assert not self.obj.is_quarantined
+        self.obj.handle_action(GameWorld, self.ua.player_obj, 'spin', '')
+        assert self.obj.is_quarantined
+        assert 'spin' not in self.obj.engine.provides
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import tempfile
+
+from ..errors import ClientQuit
+from ..frontend import CoreBridge, Frontend
+from .tm_test_case import EventLoopMixin, TildemushUnitTestCase
+
+
+class EchoServer:
+    """Stands in for GameServer, replying to every message with itself."""
+    def __init__(self):
+        self.quit = False
+
+    async def serve_messages(self, websocket, messages):
+        try:
+            async for message in messages:
+                await websocket.send('ECHO {}'.format(message))
+        except ClientQuit:
+            self.quit = True
+
+
+class CoreBridgeTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'core.sock')
+        self.server = EchoServer()
+        self.bridge = CoreBridge(self.server, path=self.path)
+
+    def tearDown(self):
+        if self.bridge.server is not None:
+            self.bridge.server.close()
+        super().tearDown()
+
+    def test_relays_both_ways(self):
+        async def scenario():
+            await self.bridge.start()
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            for msg in ({'type': 'open', 'conn': 'a'},
+                        {'type': 'open', 'conn': 'b'},
+                        {'type': 'message', 'conn': 'b', 'text': 'PING'},
+                        {'type': 'message', 'conn': 'a', 'text': 'LOGIN'}):
+                writer.write((json.dumps(msg) + '\n').encode('utf-8'))
+            replies = [json.loads(await reader.readline()) for _ in range(2)]
+            writer.write((json.dumps({'type': 'close', 'conn': 'a'}) + '\n').encode('utf-8'))
+            closing = json.loads(await reader.readline())
+            writer.close()
+            return replies, closing
+
+        replies, closing = self.loop.run_until_complete(scenario())
+        assert {(r['conn'], r['text']) for r in replies} == {('a', 'ECHO LOGIN'), ('b', 'ECHO PING')}
+        assert closing == {'type': 'close', 'conn': 'a'}
+        assert self.server.quit
+
+    def test_front_end_waits_for_the_core(self):
+        frontend = Frontend(self.loop, '127.0.0.1', 0, core_path=self.path)
+
+        async def scenario():
+            connecting = asyncio.ensure_future(frontend.connect())
+            await asyncio.sleep(0.2)
+            assert not connecting.done()
+            await self.bridge.start()
+            await asyncio.wait_for(connecting, 1)
+            frontend.writer.close()
+            # let the bridge see it go
+            await asyncio.sleep(0.05)
+
+        self.loop.run_until_complete(scenario())
+
+    def test_refuses_a_shared_directory(self):
+        os.chmod(os.path.dirname(self.path), 0o777)
+        with self.assertRaisesRegex(RuntimeError, 'mode 0700'):
+            self.loop.run_until_complete(self.bridge.start())
@@ -2,7 +2,7 @@ from unittest import mock
 from .. import models
 from ..errors import WitchError
 from ..models import UserAccount, GameObject, Contains, Script, ScriptRevision, Permission
-from ..scripting import ScriptEngine, random_number
+from ..scripting import ScriptEngine, WitchInterpreter, BASE_SYMTABLE, compile_witch, random_number
 from ..world import GameWorld
 
 from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
@@ -271,3 +271,21 @@ class TestRandomNumber(TildemushUnitTestCase):
             result = random_number(100, 90)
             assert result >= 90
             assert result <= 100
+
+
+class SharedSymbolTableTest(TildemushUnitTestCase):
+    def test_scripts_do_not_share_definitions(self):
+        first = WitchInterpreter(mock.Mock())
+        second = WitchInterpreter(mock.Mock())
+        first.evaluate_ast(compile_witch('(setv sqrt 3)')[-1])
+        assert first.interpreter.symtable['sqrt'] == 3
+        assert second.interpreter.symtable['sqrt'] is BASE_SYMTABLE['sqrt']
+        assert 'sqrt' not in first.interpreter.no_deepcopy
+        assert 'sqrt' in second.interpreter.no_deepcopy
+
+    def test_builtin_handlers(self):
+        engine = ScriptEngine(mock.Mock())
+        engine.add_provides_handler('say', 'custom')
+        assert engine.intransitive_handler('say') == 'custom'
+        assert engine.intransitive_handler('whisper').__func__ is ScriptEngine._whisper_handler
+        assert engine.intransitive_handler('nonsense') is ScriptEngine.noop
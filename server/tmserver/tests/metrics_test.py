@@ -0,0 +1,26 @@
+from ..metrics import Histogram, Metrics
+from .tm_test_case import TildemushUnitTestCase
+
+
+class HistogramTest(TildemushUnitTestCase):
+    def test_quantiles(self):
+        histogram = Histogram(buckets=(1, 2, 5, 10))
+        for value in [0.5] * 50 + [1.5] * 40 + [4] * 9 + [20]:
+            histogram.observe(value)
+        assert histogram.count == 100
+        assert histogram.counts == [50, 40, 9, 0, 1]
+        assert histogram.quantile(0.5) == 1
+        assert histogram.quantile(0.9) == 2
+        assert histogram.quantile(0.99) == 5
+        assert histogram.quantile(1) == 10
+
+    def test_empty(self):
+        assert Histogram().quantile(0.5) == 0
+
+    def test_metrics_histograms(self):
+        metrics = Metrics()
+        assert metrics.histogram('latency') is None
+        metrics.observe('latency', 0.2)
+        assert metrics.histogram('latency').count == 1
+        metrics.reset()
+        assert metrics.histogram('latency') is None
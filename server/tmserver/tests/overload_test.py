@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from ..core import UserSession
+from ..metrics import METRICS
+from ..overload import OVERLOAD, OverloadMonitor
+from ..world import GameWorld
+from .tm_test_case import EventLoopMixin, TildemushUnitTestCase
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, frame):
+        self.sent.append(frame)
+
+
+class OverloadMonitorTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        METRICS.reset()
+        self.monitor = OverloadMonitor(push_lag=0.1, bulk_lag=0.25, login_lag=0.5, retry_after=5)
+
+    def test_lag_is_smoothed(self):
+        self.monitor.measured(0.2)
+        assert not self.monitor.shedding_pushes
+        for _ in range(5):
+            self.monitor.measured(0.2)
+        assert self.monitor.shedding_pushes
+        assert METRICS.get('loop_lag_seconds') == self.monitor.lag
+        assert METRICS.histogram('loop_lag_seconds').count == 6
+
+    def test_refusals_by_level(self):
+        self.monitor.lag = 0.3
+        assert self.monitor.refuse('MAP') == 5
+        assert self.monitor.refuse('REVISION {}') == 5
+        assert self.monitor.refuse('LOGIN vilmibm:foobarbazquux') is None
+        assert self.monitor.refuse('COMMAND say hi') is None
+        self.monitor.lag = 0.6
+        assert self.monitor.refuse('LOGIN vilmibm:foobarbazquux') == 5
+        assert METRICS.get('overload_shed.MAP') == 1
+        assert METRICS.get('overload_shed.LOGIN') == 1
+
+    def test_zero_disables(self):
+        monitor = OverloadMonitor(push_lag=0, bulk_lag=0, login_lag=0)
+        monitor.lag = 10
+        assert not monitor.shedding_pushes
+        assert monitor.refuse('MAP') is None
+
+    def test_measures_the_loop(self):
+        loop = asyncio.new_event_loop()
+        monitor = OverloadMonitor(interval=0.01)
+        monitor.start(loop)
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        loop.close()
+        assert METRICS.histogram('loop_lag_seconds').count >= 2
+
+
+class StateSheddingTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = FakeSocket()
+        self.session = UserSession(self.loop, GameWorld, self.socket)
+
+    def tearDown(self):
+        OVERLOAD.reset()
+        super().tearDown()
+
+    def sent_states(self):
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        return [json.loads(f[len('STATE '):])['n'] for f in self.socket.sent]
+
+    def test_every_state_sent_normally(self):
+        for n in range(3):
+            self.session.handle_client_update({'n': n})
+        assert self.sent_states() == [0, 1, 2]
+
+    def test_queued_states_coalesce_under_load(self):
+        OVERLOAD.lag = 1
+        for n in range(3):
+            self.session.handle_client_update({'n': n})
+        assert self.sent_states() == [2]
+        self.session.handle_client_update({'n': 3})
+        assert self.sent_states() == [2, 3]
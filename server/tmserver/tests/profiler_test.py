@@ -0,0 +1,145 @@
+import os
+import sys
+import tempfile
+import threading
+from unittest import mock
+
+from ..errors import UserError
+from ..models import UserAccount
+from ..profiler import ANNOTATED, Profile, SamplingProfiler, _witch_frame, collapse
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class Jar:
+    shortname = 'snoozy/jar'
+
+    def handle_action(self):
+        return sys._getframe()
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class ProfilerTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_collapse_annotates_witch_frames(self):
+        with mock.patch.dict(ANNOTATED, {Jar.handle_action.__code__: _witch_frame}):
+            stack = collapse(Jar().handle_action())
+        assert stack[-2:] == ['profiler_test.py:handle_action', 'witch:snoozy/jar']
+        assert stack[-3] == 'profiler_test.py:test_collapse_annotates_witch_frames'
+
+    def test_profile(self):
+        stop = threading.Event()
+        spinner = threading.Thread(target=spin, args=(stop,), name='spinner one')
+        waiter = threading.Thread(target=stop.wait)
+        spinner.start()
+        waiter.start()
+        try:
+            profiler = SamplingProfiler(interval=0.005, max_seconds=1, directory=self.dir.name)
+            profile = profiler.profile(0.1)
+        finally:
+            stop.set()
+            spinner.join()
+            waiter.join()
+        assert profile.samples > 5
+        spun = sum(count for stack, count in profile.stacks.items()
+                   if stack.startswith('spinner_one;') and 'profiler_test.py:spin' in stack)
+        assert spun > 0
+        assert profile.idle > 0
+        assert not any(stack.endswith('threading.py:wait') for stack in profile.stacks)
+
+        path = profiler.write(profile)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == len(profile.stacks)
+        stack, count = lines[0].rsplit(' ', 1)
+        assert profile.stacks[stack] == int(count)
+
+    def test_one_at_a_time(self):
+        profiler = SamplingProfiler(interval=0.005, max_seconds=0.05, directory=self.dir.name)
+        finished = threading.Event()
+        results = []
+
+        def done(path, profile):
+            results.append((path, profile))
+            finished.set()
+        assert profiler.start(10, done) == 0.05
+        assert profiler.start(10, done) is None
+        assert finished.wait(5)
+        path, profile = results[0]
+        assert os.path.exists(path)
+        assert profile.summary(path).startswith('{} samples over 0.05s'.format(profile.samples))
+        finished.clear()
+        assert profiler.start(0.01, done) == 0.01
+        assert finished.wait(5)
+
+    def test_reports_failures(self):
+        missing = os.path.join(self.dir.name, 'missing')
+        profiler = SamplingProfiler(interval=0.005, max_seconds=0.05, directory=missing)
+        finished = threading.Event()
+        results = []
+
+        def done(path, profile, error=None):
+            results.append((path, profile, error))
+            finished.set()
+        assert profiler.start(0.01, done) == 0.01
+        assert finished.wait(5)
+        path, profile, error = results[0]
+        assert path is None
+        assert isinstance(error, FileNotFoundError)
+        # and it's free to run again
+        finished.clear()
+        assert profiler.start(0.01, done) == 0.01
+        assert finished.wait(5)
+
+    def test_hottest(self):
+        profile = Profile(1, 0.01)
+        profile.stacks['main;a;b'] = 3
+        profile.stacks['main;c;b'] = 1
+        profile.stacks['main;a'] = 4
+        assert profile.hottest(2) == [('b', 0.5), ('a', 0.5)]
+
+
+class ProfileCommandTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux', is_god=True)
+        self.snoozy = UserAccount.create(username='snoozy', password='foobarbazquux')
+        self.session = mock.Mock()
+        GameWorld.register_session(self.vil, self.session)
+
+    def test_forbidden(self):
+        with self.assertRaisesRegex(UserError, 'not powerful enough'):
+            GameWorld.handle_profile(self.snoozy.player_obj, '5')
+
+    def test_bad_seconds(self):
+        with self.assertRaisesRegex(UserError, 'try /profile'):
+            GameWorld.handle_profile(self.vil.player_obj, 'forever')
+
+    def test_profiles(self):
+        profiler = mock.Mock()
+        profiler.start.return_value = 5
+        with mock.patch('tmserver.world.PROFILER', profiler):
+            GameWorld.handle_profile(self.vil.player_obj, '5')
+            self.session.handle_hears.assert_called_with(self.vil.player_obj, 'profiling for 5s')
+            seconds, done = profiler.start.call_args[0]
+            assert seconds == 5
+            profile = Profile(5, 0.01)
+            done('profile.collapsed', profile)
+            self.session.handle_hears.assert_called_with(
+                self.vil.player_obj, profile.summary('profile.collapsed'))
+            done(None, None, OSError('disk full'))
+            self.session.handle_hears.assert_called_with(
+                self.vil.player_obj, 'profiling failed: disk full')
+            profiler.start.return_value = None
+            with self.assertRaisesRegex(UserError, 'already running'):
+                GameWorld.handle_profile(self.vil.player_obj, '')
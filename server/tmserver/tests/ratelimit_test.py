@@ -0,0 +1,159 @@
+from collections import Counter
+import time
+from unittest import mock
+
+from ..core import GameServer, UserSession
+from ..errors import ClientError, UserError
+from ..models import UserAccount
+from ..ratelimit import RATE_LIMITER, RateLimiter, limit_key
+from ..world import GameWorld
+from .tm_test_case import EventLoopMixin, TildemushTestCase, TildemushUnitTestCase
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimiterTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.limiter = RateLimiter(limits={
+            '*': (10, 5),
+            'COMMAND': (1, 2),
+            'COMMAND say': (5, 4),
+            'MAP': None,
+        }, mode='reject', max_delay=1, clock=self.clock)
+
+    def test_limit_key(self):
+        assert limit_key('COMMAND say hi there') == 'COMMAND say'
+        assert limit_key('COMMAND look') == 'COMMAND look'
+        assert limit_key('MAP') == 'MAP'
+        assert limit_key('REVISION {"code": "..."}') == 'REVISION'
+
+    def test_burst_then_refill(self):
+        assert self.limiter.check('vil', 'COMMAND go north') == 0
+        assert self.limiter.check('vil', 'COMMAND look') == 0
+        assert self.limiter.check('vil', 'COMMAND go south') == 1
+        self.clock.now = 1
+        assert self.limiter.check('vil', 'COMMAND go south') == 0
+
+    def test_specific_limits_are_separate(self):
+        # COMMAND create keeps its default limit, (0.2, 3)
+        for _ in range(3):
+            assert self.limiter.check('vil', 'COMMAND create item foo') == 0
+        assert self.limiter.check('vil', 'COMMAND create item bar') == 5
+        for _ in range(2):
+            assert self.limiter.check('vil', 'COMMAND say hi') == 0
+
+    def test_session_wide_limit(self):
+        for _ in range(5):
+            assert self.limiter.check('vil', 'PING') == 0
+        assert self.limiter.check('vil', 'PING') == 0.1
+        # refused messages don't use up tokens from anything
+        self.clock.now = 0.1
+        assert self.limiter.check('vil', 'COMMAND look') == 0
+
+    def test_clients_are_separate(self):
+        for _ in range(2):
+            self.limiter.check('vil', 'COMMAND look')
+        assert self.limiter.check('vil', 'COMMAND look') > 0
+        assert self.limiter.check('snoozy', 'COMMAND look') == 0
+
+    def test_removed_and_exempt_limits(self):
+        for _ in range(5):
+            assert self.limiter.check('vil', 'MAP') == 0
+        assert self.limiter.check('vil', 'QUIT') == 0
+
+    def test_counted_by_limit(self):
+        self.limiter.record('vil', 'COMMAND poke snoozy', 'rejected')
+        self.limiter.record('vil', 'COMMAND zxcvbn', 'rejected')
+        self.limiter.record('vil', 'COMMAND say hi', 'rejected')
+        self.limiter.record('vil', 'GARBAGE1234', 'rejected')
+        assert self.limiter.throttled['vil'] == Counter({
+            ('COMMAND', 'rejected'): 2,
+            ('COMMAND say', 'rejected'): 1,
+            ('other', 'rejected'): 1})
+
+    def test_rejects_bad_limits(self):
+        with self.assertRaisesRegex(ValueError, 'COMMAND say'):
+            RateLimiter(limits={'COMMAND say': (0, 5)})
+        with self.assertRaisesRegex(ValueError, 'MAP'):
+            RateLimiter(limits={'MAP': (1, 0.5)})
+
+    def test_summary(self):
+        self.limiter.record('vil', 'COMMAND create item foo', 'rejected')
+        self.limiter.record('vil', 'COMMAND create item foo', 'rejected')
+        self.limiter.record('snoozy', 'MAP', 'delayed')
+        assert self.limiter.summary() == [
+            'vil: COMMAND create 2 rejected',
+            'snoozy: MAP 1 delayed']
+        assert self.limiter.summary('snoozy') == ['snoozy: MAP 1 delayed']
+
+
+class ThrottleTest(EventLoopMixin, TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        RATE_LIMITER.reset()
+        self.server = GameServer(GameWorld, loop=self.loop, logger=mock.Mock())
+        self.server.rate_limiter = RateLimiter(
+            limits={'COMMAND': (1, 1)}, mode='reject', clock=Clock())
+        self.user_session = UserSession(self.loop, GameWorld, None)
+
+    def test_rejects(self):
+        self.loop.run_until_complete(self.server.throttle(self.user_session, 'COMMAND look'))
+        with self.assertRaisesRegex(ClientError, 'throttled; try again in 1.0s'):
+            self.loop.run_until_complete(self.server.throttle(self.user_session, 'COMMAND look'))
+        key = self.server.throttle_key(self.user_session)
+        assert self.server.rate_limiter.throttled[key][('COMMAND', 'rejected')] == 1
+
+    def test_delays(self):
+        self.server.rate_limiter = RateLimiter(
+            limits={'COMMAND': (20, 1)}, mode='delay', max_delay=1)
+        self.loop.run_until_complete(self.server.throttle(self.user_session, 'COMMAND look'))
+        self.loop.run_until_complete(self.server.throttle(self.user_session, 'COMMAND look'))
+        assert self.user_session.waited > 0
+        key = self.server.throttle_key(self.user_session)
+        assert self.server.rate_limiter.throttled[key][('COMMAND', 'delayed')] == 1
+
+    def test_delay_is_bounded(self):
+        limiter = self.server.rate_limiter = RateLimiter(
+            limits={'COMMAND': (20, 1)}, mode='delay', max_delay=0.2)
+        started = time.monotonic()
+        # as if someone else kept taking the token first
+        with mock.patch.object(limiter, 'check', return_value=0.05):
+            with self.assertRaisesRegex(ClientError, 'throttled'):
+                self.loop.run_until_complete(self.server.throttle(self.user_session, 'COMMAND look'))
+        assert time.monotonic() - started < 0.25
+        key = self.server.throttle_key(self.user_session)
+        assert limiter.throttled[key][('COMMAND', 'rejected')] == 1
+
+
+class ThrottlesCommandTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        RATE_LIMITER.reset()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux', is_god=True)
+        self.snoozy = UserAccount.create(username='snoozy', password='foobarbazquux')
+        self.session = mock.Mock()
+        GameWorld.register_session(self.vil, self.session)
+
+    def tearDown(self):
+        RATE_LIMITER.reset()
+
+    def test_forbidden(self):
+        with self.assertRaisesRegex(UserError, 'not powerful enough'):
+            GameWorld.handle_throttles(self.snoozy.player_obj, '')
+
+    def test_lists_throttled(self):
+        GameWorld.handle_throttles(self.vil.player_obj, '')
+        self.session.handle_hears.assert_called_with(
+            self.vil.player_obj, 'nobody has been throttled')
+        RATE_LIMITER.record('snoozy', 'COMMAND create item foo', 'rejected')
+        GameWorld.handle_throttles(self.vil.player_obj, 'snoozy')
+        self.session.handle_hears.assert_called_with(
+            self.vil.player_obj, 'snoozy: COMMAND create 1 rejected')
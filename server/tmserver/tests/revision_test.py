@@ -4,6 +4,8 @@ from unittest.mock import Mock, patch
 from ..core import GameServer, UserSession
 from ..errors import ClientError, RevisionError
 from ..models import GameObject, UserAccount, ScriptRevision
+from ..sandbox import TrialResult, trial_revision
+from ..scripting import AST_CACHE
 from ..world import GameWorld
 from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
 
@@ -183,6 +185,38 @@ class GameWorldRevisionHandlingTest(TildemushTestCase):
 
         assert expected == result
 
+    def test_failed_trial(self):
+        trial = TrialResult(errors=['it took too long'])
+        with patch('tmserver.scripting.ScriptedObjectMixin.init_scripting') as m:
+            result = GameWorld.handle_revision(
+                self.vil.player_obj,
+                'vilmibm/snoozy',
+                '(while True (setv x 1))',
+                self.snoozy.script_revision.id,
+                trial=trial)
+
+        assert not m.called
+        assert result['errors'] == ['it took too long']
+
+    def test_successful_trial(self):
+        new_code = """
+        (incantation "snoozy"
+          (has {"name" "snoozy"  "description" "just a horse"})
+          (provides "pet"
+             (says "neigh")))
+        """.rstrip().lstrip()
+        trial = trial_revision(new_code)
+        assert trial.ok
+        result = GameWorld.handle_revision(
+            self.vil.player_obj,
+            'vilmibm/snoozy',
+            new_code,
+            self.snoozy.script_revision.id,
+            trial=trial)
+
+        assert result['errors'] == []
+        assert new_code in AST_CACHE
+
 
 class GameObjectRevisionUpdateTest(TildemushTestCase):
     def setUp(self):
@@ -0,0 +1,36 @@
+from ..sandbox import trial_revision
+from .tm_test_case import TildemushUnitTestCase
+
+
+class TrialRevisionTest(TildemushUnitTestCase):
+    def test_success(self):
+        result = trial_revision('''
+        (incantation by vilmibm
+          (has {"name" "snoozy" "description" "a horse"})
+          (hears "*pet*" (says "neigh")))''')
+        assert result.ok
+        assert result.asts
+
+    def test_witch_error(self):
+        result = trial_revision('(lol)')
+        assert not result.ok
+        assert result.errors == [
+            ";_; There is a problem with your witch script: name 'lol' is not defined"]
+
+    def test_read_error(self):
+        result = trial_revision('(incantation by vilmibm (has {"name"')
+        assert not result.ok
+        assert 'ends partway through a form' in result.errors[0]
+
+    def test_timeout(self):
+        result = trial_revision('''
+        (incantation by vilmibm
+          (while True (setv x 1)))''', timeout=0.5)
+        assert not result.ok
+        assert 'took longer than 0.5s' in result.errors[0]
+
+    def test_memory_limit(self):
+        result = trial_revision('''
+        (incantation by vilmibm
+          (setv x (* "a" 1000000000)))''', memory_limit=256 * 1024 * 1024)
+        assert not result.ok
@@ -0,0 +1,122 @@
+import asyncio
+
+from ..scheduler import BULK, INTERACTIVE, Scheduler, lent, priority_of
+from .tm_test_case import EventLoopMixin, TildemushUnitTestCase
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class SchedulerTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.trail = []
+
+    async def message(self, scheduler, name, priority, hold=None):
+        async with scheduler.slot(priority):
+            self.trail.append(name)
+            if hold is not None:
+                await hold.wait()
+
+    def test_priority_of(self):
+        assert priority_of('PING') == INTERACTIVE
+        assert priority_of('COMMAND say hi') == INTERACTIVE
+        assert priority_of('COMMAND go north') == INTERACTIVE
+        assert priority_of('MAP') == BULK
+        assert priority_of('REVISION {}') == BULK
+        assert priority_of('COMMAND announce HELLO') == BULK
+
+    def run_queued(self, scheduler, *messages):
+        """Starts a message that holds the only slot, queues messages behind
+        it, then lets it finish."""
+        async def go():
+            hold = asyncio.Event()
+            first = asyncio.ensure_future(self.message(scheduler, 'first', INTERACTIVE, hold))
+            await asyncio.sleep(0)
+            rest = [asyncio.ensure_future(self.message(scheduler, name, priority))
+                    for name, priority in messages]
+            await asyncio.sleep(0)
+            hold.set()
+            await asyncio.gather(first, *rest)
+        self.loop.run_until_complete(go())
+
+    def test_interactive_goes_first(self):
+        scheduler = Scheduler(concurrency=1, limits={}, max_wait=10, clock=self.clock)
+        self.run_queued(scheduler, ('map', BULK), ('say', INTERACTIVE), ('go', INTERACTIVE))
+        assert self.trail == ['first', 'say', 'go', 'map']
+
+    def test_bulk_is_not_starved(self):
+        scheduler = Scheduler(concurrency=1, limits={}, max_wait=10, clock=self.clock)
+        async def go():
+            hold = asyncio.Event()
+            first = asyncio.ensure_future(self.message(scheduler, 'first', INTERACTIVE, hold))
+            await asyncio.sleep(0)
+            bulk = asyncio.ensure_future(self.message(scheduler, 'map', BULK))
+            await asyncio.sleep(0)
+            self.clock.now = 11
+            say = asyncio.ensure_future(self.message(scheduler, 'say', INTERACTIVE))
+            await asyncio.sleep(0)
+            hold.set()
+            await asyncio.gather(first, bulk, say)
+        self.loop.run_until_complete(go())
+        assert self.trail == ['first', 'map', 'say']
+
+    def test_per_class_limits(self):
+        scheduler = Scheduler(concurrency=4, limits={BULK: 1}, clock=self.clock)
+        async def go():
+            hold = asyncio.Event()
+            tasks = [asyncio.ensure_future(self.message(scheduler, 'map', BULK, hold)),
+                     asyncio.ensure_future(self.message(scheduler, 'revision', BULK, hold)),
+                     asyncio.ensure_future(self.message(scheduler, 'say', INTERACTIVE, hold))]
+            await asyncio.sleep(0)
+            assert scheduler.running == {INTERACTIVE: 1, BULK: 1}
+            assert len(scheduler) == 1
+            hold.set()
+            await asyncio.gather(*tasks)
+        self.loop.run_until_complete(go())
+        assert self.trail == ['map', 'say', 'revision']
+        assert scheduler.running == {INTERACTIVE: 0, BULK: 0}
+
+    def test_cancelled_waiters_are_skipped(self):
+        scheduler = Scheduler(concurrency=1, limits={}, clock=self.clock)
+        async def go():
+            hold = asyncio.Event()
+            first = asyncio.ensure_future(self.message(scheduler, 'first', INTERACTIVE, hold))
+            await asyncio.sleep(0)
+            gone = asyncio.ensure_future(self.message(scheduler, 'gone', INTERACTIVE))
+            after = asyncio.ensure_future(self.message(scheduler, 'after', INTERACTIVE))
+            await asyncio.sleep(0)
+            gone.cancel()
+            hold.set()
+            await asyncio.gather(first, after)
+        self.loop.run_until_complete(go())
+        assert self.trail == ['first', 'after']
+        assert scheduler.running == {INTERACTIVE: 0, BULK: 0}
+
+    def test_lent_slot(self):
+        scheduler = Scheduler(concurrency=1, limits={}, clock=self.clock)
+        async def waits_on_rooms(rooms):
+            async with scheduler.slot(INTERACTIVE) as slot:
+                self.trail.append('first')
+                async with lent(slot):
+                    await rooms.wait()
+                assert slot.held
+                self.trail.append('first again')
+        async def go():
+            rooms = asyncio.Event()
+            first = asyncio.ensure_future(waits_on_rooms(rooms))
+            await asyncio.sleep(0)
+            await self.message(scheduler, 'say', INTERACTIVE)
+            rooms.set()
+            await first
+            async with lent(None):
+                pass
+        self.loop.run_until_complete(go())
+        assert self.trail == ['first', 'say', 'first again']
+        assert scheduler.running == {INTERACTIVE: 0, BULK: 0}
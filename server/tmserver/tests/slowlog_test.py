@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import time
+from unittest import mock
+
+from ..models import Log, UserAccount
+from ..slowlog import SlowLog
+from .. import stats
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class FakeDatabase:
+    def execute_sql(self, sql, params=None):
+        return sql
+
+
+def sender():
+    sender_obj = mock.Mock(is_player_obj=True)
+    sender_obj.user_account.username = 'vilmibm'
+    sender_obj.room.shortname = 'vilmibm/pickling-room'
+    return sender_obj
+
+
+class SlowLogTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'slow.jsonl')
+        self.db = stats.counted(FakeDatabase())
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_disabled(self):
+        slow_log = SlowLog(threshold_ms=0, path=self.path)
+        with slow_log.watch(sender(), 'go', 'north'):
+            time.sleep(0.01)
+        assert self.records() == []
+
+    def test_fast_commands_arent_logged(self):
+        slow_log = SlowLog(threshold_ms=1000, path=self.path)
+        with slow_log.watch(sender(), 'go', 'north'):
+            self.db.execute_sql('SELECT 1')
+        slow_log.flush()
+        assert self.records() == []
+
+    def test_slow_command(self):
+        slow_log = SlowLog(threshold_ms=20, path=self.path)
+        with slow_log.watch(sender(), 'go', 'north'):
+            self.db.execute_sql('SELECT 1')
+            with stats.handling('snoozy/jar', 'go'):
+                time.sleep(0.03)
+        slow_log.flush()
+        [record] = self.records()
+        assert record['who'] == 'vilmibm'
+        assert record['room'] == 'vilmibm/pickling-room'
+        assert record['action'] == 'go'
+        assert record['args'] == 'north'
+        assert record['total_ms'] >= 30
+        assert [q['sql'] for q in record['queries']] == ['SELECT 1']
+        [handler] = record['handlers']
+        assert handler['shortname'] == 'snoozy/jar'
+        assert handler['action'] == 'go'
+        assert handler['ms'] >= 30
+
+    def test_too_many_queries(self):
+        slow_log = SlowLog(threshold_ms=1, path=self.path)
+        with slow_log.watch(sender(), 'look', ''):
+            for _ in range(250):
+                self.db.execute_sql('SELECT 1')
+            time.sleep(0.01)
+        slow_log.flush()
+        [record] = self.records()
+        assert len(record['queries']) == 200
+        assert record['queries_omitted'] == 50
+
+
+class SlowLogTableTest(TildemushTestCase):
+    def test_logs_to_table(self):
+        vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        slow_log = SlowLog(threshold_ms=1, path='db')
+        with slow_log.watch(vil.player_obj, 'look', ''):
+            time.sleep(0.01)
+        slow_log.flush()
+        log = Log.get(Log.level == 'WARNING')
+        record = json.loads(log.raw)
+        assert record['who'] == 'vilmibm'
+        assert record['action'] == 'look'
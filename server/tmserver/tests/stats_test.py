@@ -0,0 +1,126 @@
+from collections import Counter
+from unittest import mock
+
+from ..errors import UserError
+from ..metrics import METRICS, Metrics
+from ..models import UserAccount
+from .. import stats
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class FakeDatabase:
+    def execute_sql(self, sql, params=None):
+        return sql
+
+
+class StatsTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        METRICS.reset()
+
+    def tearDown(self):
+        METRICS.reset()
+
+    def test_labels(self):
+        assert stats.verb_label('COMMAND go north') == 'COMMAND'
+        assert stats.verb_label('MAP') == 'MAP'
+        assert stats.verb_label('HELLO there') == 'other'
+        assert stats.action_label('go') == 'go'
+        assert stats.action_label('pet') == 'other'
+        assert stats.frame_kind('STATE {}') == 'STATE'
+        assert stats.frame_kind('ERROR: nope') == 'ERROR'
+        assert stats.frame_kind('vilmibm says, "hi"') == 'TEXT'
+        assert stats.frame_kind('whatever', verb='TEXT') == 'TEXT'
+
+    def test_tallies_nest(self):
+        outer, inner = Counter(), Counter()
+        with stats.tallying(outer):
+            stats.count('queries')
+            with stats.tallying(inner):
+                stats.count('handlers', 2)
+        stats.count('queries')
+        assert outer == {'queries': 1, 'handlers': 2}
+        assert inner == {'handlers': 2}
+        assert METRICS.get('db_queries') == 2
+        assert METRICS.get('witch_handlers') == 2
+
+    def test_counted_database(self):
+        db = stats.counted(FakeDatabase())
+        tally = Counter()
+        run = stats.tallied(tally, lambda: db.execute_sql('SELECT 1'))
+        assert run() == 'SELECT 1'
+        assert tally['queries'] == 1
+        assert stats.tallied(None, len) is len
+
+    def test_measure_action(self):
+        with stats.measure_action('go'):
+            stats.count('queries', 3)
+        with stats.measure_action('pet'):
+            stats.count('compiles')
+        assert METRICS.get('action_calls.go') == 1
+        assert METRICS.get('action_queries.go') == 3
+        assert METRICS.histogram('action_seconds.go').count == 1
+        assert METRICS.get('action_compiles.other') == 1
+
+    def test_summary(self):
+        stats.record('verb', 'COMMAND', 0.003, Counter(queries=4, bytes_sent=100))
+        stats.record('verb', 'COMMAND', 0.2, Counter(queries=2))
+        stats.record('verb', 'MAP', 0.02, Counter())
+        assert stats.summary('verb') == [
+            'verb COMMAND: 2 calls, p50/p95/p99 5/250/250ms, 3.0 queries, 50.0 bytes sent',
+            'verb MAP: 1 calls, p50/p95/p99 25/25/25ms']
+        assert stats.summary('action') == []
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.incr('verb_calls.COMMAND', 2)
+        metrics.incr('rate_limit_rejected.COMMAND "say"')
+        metrics.set('engine_cache_size', 3)
+        metrics.observe('verb_seconds.MAP', 0.02)
+        text = stats.prometheus(metrics)
+        assert '# TYPE tildemush_verb_calls counter\ntildemush_verb_calls{key="COMMAND"} 2\n' in text
+        assert 'tildemush_rate_limit_rejected{key="COMMAND \\"say\\""} 1' in text
+        assert '# TYPE tildemush_engine_cache_size gauge\ntildemush_engine_cache_size 3\n' in text
+        assert '# TYPE tildemush_verb_seconds histogram' in text
+        assert 'tildemush_verb_seconds_bucket{key="MAP",le="0.01"} 0' in text
+        assert 'tildemush_verb_seconds_bucket{key="MAP",le="0.025"} 1' in text
+        assert 'tildemush_verb_seconds_bucket{key="MAP",le="+Inf"} 1' in text
+        assert 'tildemush_verb_seconds_count{key="MAP"} 1' in text
+
+    def test_prometheus_kinds_dont_share_names(self):
+        metrics = Metrics()
+        metrics.set('loop_lag_seconds', 0.1)
+        metrics.observe('loop_lag_seconds', 0.1)
+        text = stats.prometheus(metrics)
+        assert '# TYPE tildemush_loop_lag_seconds gauge' in text
+        assert '# TYPE tildemush_loop_lag_seconds_histogram histogram' in text
+        assert 'tildemush_loop_lag_seconds_histogram_count 1' in text
+
+
+class StatsCommandTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        METRICS.reset()
+        self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux', is_god=True)
+        self.snoozy = UserAccount.create(username='snoozy', password='foobarbazquux')
+        self.session = mock.Mock()
+        GameWorld.register_session(self.vil, self.session)
+
+    def tearDown(self):
+        METRICS.reset()
+
+    def test_forbidden(self):
+        with self.assertRaisesRegex(UserError, 'not powerful enough'):
+            GameWorld.handle_stats(self.snoozy.player_obj, '')
+
+    def test_actions_are_measured(self):
+        GameWorld.handle_stats(self.vil.player_obj, 'action')
+        self.session.handle_hears.assert_called_with(
+            self.vil.player_obj, 'nothing has been measured yet')
+        GameWorld.dispatch_action(self.vil.player_obj, 'look', '')
+        assert METRICS.get('action_calls.look') == 1
+        assert METRICS.get('action_queries.look') > 0
+        GameWorld.handle_stats(self.vil.player_obj, 'action')
+        heard = self.session.handle_hears.call_args[0][1]
+        assert heard.startswith('action look: 1 calls, p50/p95/p99')
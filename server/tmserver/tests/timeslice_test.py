@@ -0,0 +1,44 @@
+from ..timeslice import SlicePool, checkpoint
+from .tm_test_case import TildemushUnitTestCase
+
+
+class SliceTest(TildemushUnitTestCase):
+    def test_runs_between_checkpoints(self):
+        trail = []
+        def fn():
+            trail.append(1)
+            checkpoint()
+            trail.append(2)
+            checkpoint()
+            trail.append(3)
+            return 'done'
+
+        sliced = SlicePool(max_threads=1).slice(fn)
+        assert not sliced.run()
+        assert trail == [1]
+        assert not sliced.run()
+        assert trail == [1, 2]
+        assert sliced.run()
+        assert trail == [1, 2, 3]
+        assert sliced.result == 'done'
+
+    def test_errors_are_kept(self):
+        def fn():
+            raise ValueError('oops')
+        sliced = SlicePool(max_threads=1).slice(fn)
+        assert sliced.run()
+        assert isinstance(sliced.error, ValueError)
+
+    def test_workers_are_bounded_and_reused(self):
+        pool = SlicePool(max_threads=1)
+        first = pool.slice(checkpoint)
+        assert not first.run()
+        assert pool.slice(lambda: None) is None
+        assert first.run()
+        second = pool.slice(lambda: 'again')
+        assert second.worker is first.worker
+        assert second.run()
+        assert second.result == 'again'
+
+    def test_checkpoint_outside_slice(self):
+        assert checkpoint() == 0
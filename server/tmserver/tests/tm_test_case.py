@@ -1,3 +1,4 @@
+import asyncio
 import os
 import unittest
 
@@ -17,3 +18,19 @@ class TildemushTestCase(TildemushUnitTestCase):
 
         reset_db()
         GameWorld.reset()
+
+
+class EventLoopMixin:
+    """Gives each test a new event loop, self.loop, installed as the current
+    one while it runs, and puts back whatever was current before afterwards
+    so later tests don't find a closed loop."""
+    def setUp(self):
+        super().setUp()
+        self._previous_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self._previous_loop)
+        super().tearDown()
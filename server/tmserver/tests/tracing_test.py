@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from ..models import UserAccount, GameObject
+from .. import stats
+from ..tracing import Tracer
+from .. import world
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class FakeDatabase:
+    def execute_sql(self, sql, params=None):
+        return sql
+
+
+class TracingTestMixin:
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'trace.json')
+        self.tracer = Tracer(path=self.path)
+
+    def tearDown(self):
+        super().tearDown()
+        if self.tracer in stats._watchers:
+            stats._watchers.remove(self.tracer)
+        self.dir.cleanup()
+
+    def spans(self):
+        self.tracer.flush()
+        with open(self.path) as f:
+            # the closing bracket is left off
+            events = json.loads(f.read().rstrip().rstrip(',') + ']')
+        return {e['name']: e for e in events}
+
+
+class TracerTest(TracingTestMixin, TildemushUnitTestCase):
+    def test_disabled(self):
+        tracer = Tracer(path=None)
+        assert tracer.trace('message', 'COMMAND') is None
+        with tracer.span('action', 'look') as span:
+            assert span is None
+
+    def test_unsampled(self):
+        tracer = Tracer(path=self.path, sample=0)
+        assert tracer.trace('message', 'COMMAND') is None
+
+    def test_no_trace_no_spans(self):
+        with self.tracer.span('action', 'look') as span:
+            assert span is None
+        assert self.tracer.open('frame', 'STATE', None) is None
+
+    def test_spans_nest(self):
+        root = self.tracer.trace('message', 'COMMAND', who='vilmibm')
+        db = self.tracer.open('db', 'dispatch_action', root)
+
+        def work():
+            with self.tracer.span('action', 'say', args='hi'):
+                with self.tracer.span('handler', 'snoozy/jar', action='say'):
+                    stats.counted(FakeDatabase()).execute_sql('SELECT 1')
+            return self.tracer.current()
+        assert self.tracer.within(db, work)() is db
+        assert self.tracer.current() is None
+        self.tracer.close(db)
+        frame = self.tracer.open('frame', 'TEXT', root, bytes=10)
+        self.tracer.close(frame)
+        self.tracer.close(root)
+
+        spans = self.spans()
+        message = spans['COMMAND']
+        assert message['args']['parent'] is None
+        assert message['args']['who'] == 'vilmibm'
+        trace = message['args']['trace']
+        assert all(s['args']['trace'] == trace and s['tid'] == trace for s in spans.values())
+        parents = {name: s['args']['parent'] for name, s in spans.items()}
+        ids = {name: s['args']['span'] for name, s in spans.items()}
+        assert parents['dispatch_action'] == ids['COMMAND']
+        assert parents['say'] == ids['dispatch_action']
+        assert parents['snoozy/jar'] == ids['say']
+        assert parents['SELECT'] == ids['snoozy/jar']
+        assert parents['TEXT'] == ids['COMMAND']
+        assert spans['SELECT']['cat'] == 'query'
+        assert spans['say']['ph'] == 'X'
+
+
+class TracedDispatchTest(TracingTestMixin, TildemushTestCase):
+    def test_nested_dispatch_parented_by_cause(self):
+        vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        GameWorld.put_into(GameObject.get(GameObject.shortname=='god/foyer'), vil.player_obj)
+        root = self.tracer.trace('message', 'COMMAND')
+        with mock.patch.object(world, 'TRACER', self.tracer):
+            self.tracer.within(root, GameWorld.dispatch_action)(vil.player_obj, 'look', '')
+        self.tracer.close(root)
+        spans = self.spans()
+        assert spans['look']['cat'] == 'action'
+        assert spans['look']['args']['parent'] == spans['COMMAND']['args']['span']
@@ -0,0 +1,85 @@
+from concurrent.futures import ProcessPoolExecutor
+import time
+
+from ..models import UserAccount, GameObject, ScriptRevision
+from ..scripting import AST_CACHE, ASTCache, SCRIPT_TEMPLATES
+from ..warmup import active_codes, precompile, shutdown
+from ..world import GameWorld
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
+
+
+class ASTCacheTest(TildemushUnitTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = ASTCache(max_size=2)
+        cache.put('a', [1])
+        cache.put('b', [2])
+        cache.get('a')
+        cache.put('c', [3])
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert len(cache) == 2
+
+
+class PrecompileTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        AST_CACHE.clear()
+
+    def test_fills_cache(self):
+        code = SCRIPT_TEMPLATES['item'].format(
+            author='vilmibm', name='horse', description='a horse')
+        assert 1 == precompile([code], budget=30, workers=1)
+        assert code in AST_CACHE
+
+    def test_skips_broken_scripts(self):
+        assert 0 == precompile(['(incantation by vilmibm (has {"name"'], budget=30, workers=1)
+
+    def test_respects_budget(self):
+        code = SCRIPT_TEMPLATES['item'].format(
+            author='vilmibm', name='horse', description='a horse')
+        assert 0 == precompile([code], budget=0, workers=1)
+        assert code not in AST_CACHE
+
+    def test_shutdown_kills_stuck_workers(self):
+        executor = ProcessPoolExecutor(max_workers=1)
+        stuck = executor.submit(time.sleep, 60)
+        while not stuck.running():
+            time.sleep(0.01)
+        processes = list(executor._processes.values())
+        started = time.monotonic()
+        shutdown(executor, grace=0.1)
+        assert time.monotonic() - started < 5
+        assert not any(p.is_alive() for p in processes)
+
+
+class ActiveCodesTest(TildemushTestCase):
+    def test_only_active_objects(self):
+        vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        horse = GameObject.create_scripted_object(
+            vil, 'vilmibm/horse', 'item', dict(name='horse', description='a horse'))
+        GameObject.create_scripted_object(
+            vil, 'vilmibm/cow', 'item', dict(name='cow', description='a cow'))
+        GameWorld.put_into(foyer, horse)
+
+        codes = active_codes()
+        assert horse.get_code() in codes
+        assert foyer.get_code() in codes
+        assert not any('a cow' in c for c in codes)
+
+    def test_latest_revision(self):
+        vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
+        foyer = GameObject.get(GameObject.shortname=='god/foyer')
+        horse = GameObject.create_scripted_object(
+            vil, 'vilmibm/horse', 'item', dict(name='horse', description='a horse'))
+        GameWorld.put_into(foyer, horse)
+        old_code = horse.get_code()
+        ScriptRevision.create(
+            script=horse.script_revision.script,
+            code=horse.get_code(use_db_data=False) + '\n; revised')
+
+        codes = active_codes()
+        assert horse.get_code() in codes
+        assert horse.get_code().endswith('; revised')
+        assert old_code not in codes
@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import traceback
+
+from ..watchdog import Watchdog, call_site
+from .tm_test_case import EventLoopMixin, TildemushUnitTestCase
+
+
+def hog(seconds):
+    time.sleep(seconds)
+
+
+class WatchdogTest(EventLoopMixin, TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'watchdog.log')
+
+    def tearDown(self):
+        super().tearDown()
+        self.dir.cleanup()
+
+    def test_disabled_by_default(self):
+        watchdog = Watchdog(threshold_ms=0, path=self.path)
+        watchdog.start(self.loop)
+        assert not watchdog.enabled
+        assert not os.path.exists(self.path)
+
+    def test_call_site_is_our_code(self):
+        def inner():
+            return traceback.extract_stack()
+        site = call_site(inner())
+        assert site.startswith('tmserver/tests/watchdog_test.py:')
+        assert site.endswith('in inner')
+
+    def test_captures_stall(self):
+        watchdog = Watchdog(threshold_ms=50, path=self.path)
+        watchdog.start(self.loop)
+        self.addCleanup(watchdog.stop)
+        watchdog.note('UserSession<vilmibm>', 'COMMAND look')
+        self.loop.call_soon(hog, 0.3)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        assert len(records) == 1
+        record = records[0]
+        assert record['stalled_ms'] > 50
+        assert record['who'] == 'UserSession<vilmibm>'
+        assert record['message'] == 'COMMAND look'
+        assert 'in hog' in record['site']
+        assert any('hog' in frame for frame in record['stack'])
+
+        with open(self.path + '.sites') as f:
+            assert f.read() == '1\t{}\n'.format(record['site'])
+
+    def test_idle_after_message(self):
+        watchdog = Watchdog(threshold_ms=50, path=self.path)
+        watchdog.start(self.loop)
+        self.addCleanup(watchdog.stop)
+        watchdog.note('UserSession<vilmibm>', 'COMMAND look')
+        watchdog.note('UserSession<vilmibm>', None)
+        self.loop.call_soon(hog, 0.3)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+
+        with open(self.path) as f:
+            record = json.loads(f.readline())
+        assert record['who'] is None
+        assert record['message'] is None
+
+    def test_only_clears_own_message(self):
+        watchdog = Watchdog(threshold_ms=50, path=self.path)
+        watchdog.note('UserSession<vilmibm>', 'COMMAND look')
+        watchdog.note('UserSession<selfsame>', None)
+        assert watchdog.current == ('UserSession<vilmibm>', 'COMMAND look')
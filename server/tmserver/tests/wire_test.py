@@ -0,0 +1,76 @@
+import json
+
+import msgpack
+
+from ..errors import ClientError
+from ..wire import MsgpackWire, TextWire, VERBS, wire_for, MSGPACK_SUBPROTOCOL
+from .tm_test_case import TildemushUnitTestCase
+
+
+class TextWireTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wire = TextWire()
+
+    def test_decode(self):
+        assert self.wire.decode('COMMAND go north') == (None, 'COMMAND go north')
+        assert self.wire.decode('#12 COMMAND go north') == ('12', 'COMMAND go north')
+
+    def test_encode(self):
+        assert self.wire.encode('COMMAND OK') == 'COMMAND OK'
+        assert self.wire.encode('COMMAND OK', request_id='3') == '#3 COMMAND OK'
+        assert self.wire.encode('STATE', payload={'a': 1}) == 'STATE {"a": 1}'
+
+    def test_binary_frames_rejected(self):
+        with self.assertRaises(ClientError):
+            self.wire.decode(b'PING')
+
+
+class MsgpackWireTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wire = MsgpackWire()
+
+    def decode(self, **fields):
+        return self.wire.decode(msgpack.packb(fields, use_bin_type=True))
+
+    def encode(self, *args, **kwargs):
+        return msgpack.unpackb(self.wire.encode(*args, **kwargs), raw=False)
+
+    def test_negotiation(self):
+        assert isinstance(wire_for(MSGPACK_SUBPROTOCOL), MsgpackWire)
+        assert isinstance(wire_for(None), TextWire)
+
+    def test_decode_requests(self):
+        assert self.decode(v=VERBS['PING']) == (None, 'PING')
+        assert self.decode(v=VERBS['LOGIN'], i=7, username='vilmibm', password='hunter22') == \
+            ('7', 'LOGIN vilmibm:hunter22')
+        assert self.decode(v=VERBS['COMMAND'], action='go', args='north') == (None, 'COMMAND go north')
+        assert self.decode(v=VERBS['COMMAND'], action='look') == (None, 'COMMAND look')
+
+    def test_decode_batch(self):
+        _, message = self.decode(v=VERBS['BATCH'], i='b', commands=[
+            {'action': 'go', 'args': 'north'}, {'action': 'look'}])
+        assert json.loads(message[len('BATCH '):]) == ['COMMAND go north', 'COMMAND look']
+
+    def test_decode_revision(self):
+        _, message = self.decode(v=VERBS['REVISION'], shortname='vilmibm/foo', code='(x)', current_rev=3)
+        assert json.loads(message[len('REVISION '):]) == {
+            'shortname': 'vilmibm/foo', 'code': '(x)', 'current_rev': 3}
+
+    def test_decode_garbage(self):
+        with self.assertRaises(ClientError):
+            self.wire.decode(b'\xc1garbage')
+        with self.assertRaises(ClientError):
+            self.decode(v=99)
+        with self.assertRaises(ClientError):
+            self.wire.decode('PING')
+
+    def test_encode(self):
+        assert self.encode('COMMAND OK', request_id='3') == {'v': VERBS['COMMAND'], 't': 'OK', 'i': '3'}
+        assert self.encode('PONG') == {'v': VERBS['PONG']}
+        assert self.encode('ERROR: no such user') == {'v': VERBS['ERROR'], 't': 'no such user'}
+        assert self.encode('MAP\n+--+') == {'v': VERBS['MAP'], 't': '+--+'}
+        assert self.encode('STATE', payload={'motd': 'hi'}) == {'v': VERBS['STATE'], 'p': {'motd': 'hi'}}
+        assert self.encode('{red}nope{/}') == {'v': VERBS['TEXT'], 't': '{red}nope{/}'}
+        assert self.encode('PING says hi', verb='TEXT') == {'v': VERBS['TEXT'], 't': 'PING says hi'}
@@ -0,0 +1,111 @@
+from unittest import mock
+
+from ..scripting import ProxyGameObject
+from ..workers import RemoteEngine, WorkerPool, WorkerReceiver, apply_effects
+from .tm_test_case import TildemushUnitTestCase
+
+COUNTER = '''
+(incantation by vilmibm
+  (has {"name" "counter" "description" "it counts" "count" 0})
+  (hears "*"
+    (set-data "count" (+ 1 (get-data "count")))
+    (says (str (get-data "count")))))'''
+
+BUDGET = (100000, 5.0)
+
+
+class FakeObject:
+    def __init__(self, obj_id):
+        self.id = obj_id
+        self.shortname = 'vilmibm/counter-{}'.format(obj_id)
+        self.name = 'counter'
+        self.data = {}
+        self.editing_set = []
+        self.said = []
+
+    def get_by_id(self, obj_id):
+        return self
+
+    def _ensure_data(self, data):
+        self.data = dict(data)
+
+    def set_data(self, key, value):
+        self.data[key] = value
+
+    def set_perms(self, **kwargs):
+        pass
+
+    def say(self, message):
+        self.said.append(message)
+
+    def emote(self, message):
+        pass
+
+
+class ApplyEffectsTest(TildemushUnitTestCase):
+    def test_in_order(self):
+        receiver = WorkerReceiver(1)
+        receiver.set_data('mood', 'good')
+        receiver.say('hi')
+        receiver.tell_sender(mock.Mock(id=2), 'go', 'north')
+        obj = mock.Mock(editing_set=[])
+        apply_effects(obj, receiver.take_effects())
+        assert obj.mock_calls[:2] == [mock.call.set_data('mood', 'good'), mock.call.say('hi')]
+        obj.tell_sender.assert_called_once_with(obj.get_by_id.return_value, 'go', 'north')
+        assert receiver.effects == []
+
+    def test_no_set_data_while_editing(self):
+        obj = mock.Mock(editing_set=['someone'])
+        apply_effects(obj, [('set_data', 'mood', 'bad')])
+        assert not obj.set_data.called
+
+
+class WorkerPoolTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = WorkerPool(size=2)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def hear(self, engine):
+        engine.hears['*'](ProxyGameObject(engine.receiver_model),
+                          ProxyGameObject(FakeObject(0)),
+                          'hello')
+
+    def test_load_and_call(self):
+        engine = RemoteEngine(FakeObject(1), self.pool, COUNTER, BUDGET)
+        assert engine.receiver_model.data['count'] == 0
+        assert list(engine.hears) == ['*']
+        self.hear(engine)
+        assert engine.receiver_model.data['count'] == 1
+        assert engine.receiver_model.said == ['1']
+
+    def test_batch_applies_in_call_order(self):
+        engines = [RemoteEngine(FakeObject(i), self.pool, COUNTER, BUDGET) for i in range(4)]
+        with self.pool.batch():
+            for engine in engines:
+                self.hear(engine)
+            self.hear(engines[0])
+        assert engines[0].receiver_model.said == ['1', '2']
+        assert all(e.receiver_model.said == ['1'] for e in engines[1:])
+
+    def test_reloads_after_drop(self):
+        engine = RemoteEngine(FakeObject(1), self.pool, COUNTER, BUDGET)
+        engine.release()
+        self.hear(engine)
+        assert engine.receiver_model.data['count'] == 1
+
+    def test_restarts_unresponsive_workers(self):
+        engine = RemoteEngine(FakeObject(1), self.pool, '''
+            (incantation by vilmibm
+              (has {"name" "adder" "description" "it adds"})
+              (hears "*" (sum (range (** 10 10)))))''', (100000, 0.1))
+        engine.receiver_model.budget_exceeded = mock.Mock()
+        worker = self.pool.worker_for(1)
+        pid = worker.proc.pid
+        with mock.patch('tmserver.workers.REPLY_GRACE', 0.1):
+            self.hear(engine)
+        engine.receiver_model.budget_exceeded.assert_called_once_with(
+            '*', 'ran for more than its time limit')
+        assert worker.proc.pid != pid
@@ -0,0 +1,106 @@
+"""Suspendable execution of world actions.
+
+asteval evaluates a handler by recursing through its AST on the Python stack,
+so there's no way to pause it halfway and come back later on the same thread.
+Instead an action that might run a long handler is started on one of a few
+worker threads that run in lockstep with the event loop: at any moment exactly
+one of the loop thread and the worker is running, the other is blocked
+handing control back and forth. That keeps every piece of world state (and
+the event loop itself) effectively single threaded while letting a handler
+stop at checkpoint() and let the loop get on with other work.
+
+Workers are kept around rather than started per action so each holds on to
+its database connection."""
+import threading
+import time
+
+from .config import WITCH_SLICE_THREADS
+
+_local = threading.local()
+
+
+class Slice:
+    """One suspendable run of fn."""
+    def __init__(self, fn, worker):
+        self.fn = fn
+        self.worker = worker
+        self.started = False
+        self.done = False
+        self.result = None
+        self.error = None
+        self.parked = threading.Event()
+
+    def run(self):
+        """Starts or resumes fn. Blocks until it either reaches a checkpoint
+        or finishes; returns whether it finished."""
+        self.parked.clear()
+        if not self.started:
+            self.started = True
+            self.worker.slice = self
+        self.worker.go.set()
+        self.parked.wait()
+        return self.done
+
+
+class _Worker(threading.Thread):
+    def __init__(self, pool):
+        super().__init__(name='witch-slice', daemon=True)
+        self.pool = pool
+        self.slice = None
+        self.go = threading.Event()
+
+    def run(self):
+        _local.worker = self
+        while True:
+            self.go.wait()
+            self.go.clear()
+            current = self.slice
+            try:
+                current.result = current.fn()
+            except BaseException as e:
+                current.error = e
+            current.done = True
+            self.slice = None
+            self.pool._idle.append(self)
+            current.parked.set()
+
+    def suspend(self):
+        self.slice.parked.set()
+        self.go.wait()
+        self.go.clear()
+
+
+class SlicePool:
+    def __init__(self, max_threads=WITCH_SLICE_THREADS):
+        self.max_threads = max_threads
+        self._idle = []
+        self._started = 0
+
+    def slice(self, fn):
+        """Returns a Slice that will run fn on a free worker, or None if every
+        worker is busy with a suspended slice."""
+        if not self._idle:
+            if self._started >= self.max_threads:
+                return None
+            worker = _Worker(self)
+            worker.start()
+            self._started += 1
+        else:
+            worker = self._idle.pop()
+        return Slice(fn, worker)
+
+    @property
+    def busy(self):
+        return self._started - len(self._idle)
+
+
+def checkpoint():
+    """Called by interpreters every so many steps. Inside a slice, suspends
+    until the slice is resumed and returns how many seconds that took;
+    anywhere else, returns 0 right away."""
+    worker = getattr(_local, 'worker', None)
+    if worker is None or worker.slice is None:
+        return 0
+    started = time.monotonic()
+    worker.suspend()
+    return time.monotonic() - started
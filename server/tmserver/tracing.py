@@ -0,0 +1,191 @@
+"""Tracing what a message from a client causes, all the way down.
+
+A command fans out: dispatch_action runs it, objects' WITCH handlers react,
+what they say and do is dispatched in turn, and STATE updates go out to
+whoever's nearby. With TILDEMUSH_TRACE_FILE set, each message a client sends
+starts a trace and everything it causes records a span in that trace, whose
+parent is whatever caused it:
+
+  message  the message itself, from when it's received to when it's handled
+  db       a piece of work sent off to the world (see GameServer.db), from
+           when it's queued to when it's done
+  action   an action run in the world: the command, or something a handler
+           caused, parented by whatever was running when it was dispatched
+           rather than whatever happens to be running when it's run
+  handler  a WITCH handler
+  query    a database query
+  frame    a frame sent to a client
+
+TILDEMUSH_TRACE_SAMPLE is the fraction of messages traced. Spans are written
+by a thread of their own to the trace file in Chrome's trace event format
+(load it in chrome://tracing or Perfetto). Every trace is drawn as its own
+track, so one slow cascade shows up as a flame chart. The file is a JSON
+array with no closing bracket, which the format allows, so it can be read
+while the server is still writing to it.
+
+Like the tallies in stats.py, the spans running right now are kept on a stack
+shared by everything doing world work, which only ever runs on one thread at
+a time; a span suspended partway through (see timeslice.py) can end up the
+parent of spans that run before it resumes."""
+from contextlib import contextmanager
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from .config import TRACE_FILE, TRACE_SAMPLE
+from .metrics import METRICS
+from . import stats
+
+QUEUE_SIZE = 10000
+MAX_ARG = 200
+
+_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, trace_id, parent_id, category, name, args):
+        self.id = next(_ids)
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.category = category
+        self.name = name
+        self.args = args
+        self.started = time.monotonic()
+
+    def event(self, ended):
+        """This span as a Chrome trace complete event."""
+        args = dict(self.args, trace=self.trace_id, span=self.id, parent=self.parent_id)
+        return {'name': self.name, 'cat': self.category, 'ph': 'X', 'pid': os.getpid(),
+                'tid': self.trace_id, 'ts': round(self.started * 1e6),
+                'dur': round((ended - self.started) * 1e6), 'args': args}
+
+
+def _clip(args):
+    return {k: v[:MAX_ARG] if isinstance(v, str) else v for k, v in args.items()}
+
+
+class Tracer:
+    def __init__(self, path=TRACE_FILE, sample=TRACE_SAMPLE, queue_size=QUEUE_SIZE):
+        self.path = path
+        self.sample = sample
+        self._stack = []
+        self._queue = queue.Queue(queue_size)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._watching = False
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def trace(self, category, name, **args):
+        """Starts a new trace with a root span, or returns None if this one
+        isn't sampled. Close it with close()."""
+        if not self.enabled or random.random() >= self.sample:
+            return None
+        if not self._watching:
+            # database queries come to us the same way they go to the slow
+            # command log
+            stats.watch(self)
+            self._watching = True
+        span = Span(None, None, category, name, _clip(args))
+        span.trace_id = span.id
+        return span
+
+    def open(self, category, name, parent, **args):
+        """Starts a child span of parent (if it's being traced, else returns
+        None) without making it the current span, for code that awaits.
+        Close it with close()."""
+        if parent is None:
+            return None
+        return Span(parent.trace_id, parent.id, category, name, _clip(args))
+
+    def close(self, span):
+        if span is None:
+            return
+        self._write(span.event(time.monotonic()))
+
+    def current(self):
+        return self._stack[-1] if self._stack else None
+
+    @contextmanager
+    def span(self, category, name, parent=None, **args):
+        """Records the with block as a span, the child of parent or else the
+        current span, and makes it the current span while it runs. Nothing is
+        recorded if neither is being traced."""
+        span = self.open(category, name, parent or self.current(), **args)
+        if span is None:
+            yield None
+            return
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            self._stack.remove(span)
+            self.close(span)
+
+    def within(self, span, fn):
+        """Returns fn wrapped to run with span current, wherever it ends up
+        running."""
+        if span is None:
+            return fn
+
+        def run(*args):
+            self._stack.append(span)
+            try:
+                return fn(*args)
+            finally:
+                self._stack.remove(span)
+        return run
+
+    # as a watcher; see stats.py
+    def query(self, sql, seconds):
+        parent = self.current()
+        if parent is None:
+            return
+        span = Span(parent.trace_id, parent.id, 'query', sql.split(' ', 1)[0], {'sql': sql[:MAX_ARG]})
+        span.started = time.monotonic() - seconds
+        self.close(span)
+
+    def handler(self, shortname, action, seconds):
+        # handlers get spans of their own, so they can be parents
+        pass
+
+    def _write(self, event):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_forever, name='tildemush-tracer', daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            METRICS.incr('trace_spans_dropped')
+
+    def _write_forever(self):
+        stats.uncounted()
+        with open(self.path, 'a') as f:
+            if f.tell() == 0:
+                f.write('[\n')
+            while True:
+                event = self._queue.get()
+                try:
+                    f.write(json.dumps(event) + ',\n')
+                    if self._queue.empty():
+                        f.flush()
+                except Exception as e:
+                    logging.getLogger('tmserver').error('failed to write trace span: {}'.format(e))
+                finally:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Waits for every span so far to be written."""
+        self._queue.join()
+
+
+TRACER = Tracer()
@@ -1,4 +1,6 @@
+import os
 import re
+import stat
 
 ARG_RE_RAW = '(\'[^\']+?\'|"[^"]+?"|[^"\' ]+)'
 ARG_RE = re.compile(ARG_RE_RAW)
@@ -38,3 +40,14 @@ def split_args(arg_str):
             for s
             in ARG_RE.split(arg_str)
             if not (is_whitespace(s) or s in ('"', "'"))]
+
+def private_dir(path):
+    """Makes the directory path if need be and checks only this process's user
+    can get into it, so nobody else can connect to (or stand in for) the
+    sockets in it. Raises RuntimeError if it can't be trusted."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(
+            '{} must be a directory owned by this user with mode 0700'.format(path))
+    return path
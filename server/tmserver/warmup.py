@@ -0,0 +1,115 @@
+"""Boot time precompilation of WITCH scripts.
+
+After a restart every object's script would otherwise be read and compiled by
+Hy the first time something happens near it. This module compiles the head
+revision of every active object in a pool of worker processes and loads the
+results into scripting.AST_CACHE before the server starts accepting
+connections. Anything left over when the time budget runs out compiles lazily
+like it always has."""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import threading
+import time
+
+from .config import WARMUP_BUDGET, WARMUP_WORKERS
+from .models import Contains, GameObject, ScriptRevision
+from .scripting import AST_CACHE, compile_witch
+
+PROGRESS_STEPS = 10
+# how long to give compiles that are already running to finish once we stop
+# waiting for them
+SHUTDOWN_GRACE = 5
+
+
+def active_codes():
+    """Returns the set of distinct code strings (with db data substituted in,
+    just like the engine property would compile) for every active object.
+
+    Active means the same thing as in GameWorld.all_active_objects, but the
+    objects come back in one query along with the latest revision of each
+    one's script, rather than one or two more queries per object."""
+    current = ScriptRevision.alias()
+    latest = ScriptRevision.alias()
+    active = Contains.select(Contains.outer_obj) | Contains.select(Contains.inner_obj)
+    query = GameObject\
+        .select(GameObject, latest)\
+        .join(current, on=(GameObject.script_revision == current.id))\
+        .switch(GameObject)\
+        .join(latest, on=(latest.script == current.script), attr='latest_rev')\
+        .where(GameObject.id.in_(active))\
+        .order_by(GameObject.id, latest.created_at.desc())\
+        .distinct(GameObject.id)
+    return {obj.get_code(revision=obj.latest_rev) for obj in query}
+
+
+def precompile(codes, budget=WARMUP_BUDGET, workers=WARMUP_WORKERS, logger=None):
+    """Compiles codes in a process pool, putting results into AST_CACHE as they
+    finish. Stops waiting after budget seconds. Returns the number of codes
+    that made it into the cache."""
+    if logger is None:
+        logger = logging.getLogger('tmserver')
+
+    codes = [c for c in codes if c not in AST_CACHE]
+    total = len(codes)
+    if total == 0:
+        return 0
+
+    logger.info('warming up {} scripts with a {}s budget'.format(total, budget))
+    deadline = time.monotonic() + budget
+    compiled = 0
+    failed = 0
+    next_report = 1
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        pending = {executor.submit(compile_witch, c): c for c in codes}
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                code = pending.pop(future)
+                try:
+                    AST_CACHE.put(code, future.result())
+                    compiled += 1
+                except Exception as e:
+                    # broken scripts will report their errors properly when
+                    # they're used; nothing to do about them here.
+                    failed += 1
+
+            finished = compiled + failed
+            if finished * PROGRESS_STEPS >= total * next_report:
+                logger.info('warmup: {}/{} scripts compiled'.format(finished, total))
+                next_report = (finished * PROGRESS_STEPS) // total + 1
+
+        if pending:
+            logger.info('warmup budget exhausted; {} scripts will compile lazily'.format(
+                len(pending)))
+    finally:
+        for future in pending:
+            future.cancel()
+        shutdown(executor)
+
+    if failed:
+        logger.info('warmup: {} scripts failed to compile'.format(failed))
+
+    return compiled
+
+
+def shutdown(executor, grace=SHUTDOWN_GRACE):
+    """Shuts executor down, waiting up to grace seconds for the compiles its
+    workers are already running. Workers still going after that are killed,
+    so none are left for the interpreter to wait on at exit."""
+    stopper = threading.Thread(target=executor.shutdown, kwargs={'wait': True}, daemon=True)
+    stopper.start()
+    stopper.join(grace)
+    if stopper.is_alive():
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        stopper.join(grace)
+
+
+def warm_up(budget=WARMUP_BUDGET, workers=WARMUP_WORKERS, logger=None):
+    return precompile(active_codes(), budget=budget, workers=workers, logger=logger)
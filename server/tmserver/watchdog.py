@@ -0,0 +1,129 @@
+"""A watchdog that catches whatever's blocking the event loop, in the act.
+
+Opt in with TILDEMUSH_WATCHDOG_MS. The loop then bumps a heartbeat several
+times per that many milliseconds, and a separate thread checks on it. When
+the heartbeat is late by more than the threshold, the thread grabs the loop
+thread's stack (with sys._current_frames) along with the message being
+handled when it stopped, and appends a JSON line about it to
+TILDEMUSH_WATCHDOG_FILE, a rotating log. Each stall is reported once.
+
+Stalls are also counted by call site: the innermost frame of the stack that's
+tildemush's own code (so a stall in bcrypt or psycopg2 is pinned on what
+called it). The counts so far, most frequent first, are rewritten to the same
+path plus .sites after every stall."""
+from collections import Counter
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import sys
+import threading
+import time
+import traceback
+
+from .config import WATCHDOG_MS, WATCHDOG_FILE, WATCHDOG_MAX_BYTES, WATCHDOG_BACKUPS
+
+OWN_CODE = os.path.dirname(os.path.abspath(__file__))
+
+
+def call_site(stack):
+    """Names where in tildemush a stack (from traceback.extract_stack) was."""
+    for frame in reversed(stack):
+        if frame.filename.startswith(OWN_CODE):
+            return '{}:{} in {}'.format(
+                os.path.relpath(frame.filename, os.path.dirname(OWN_CODE)), frame.lineno, frame.name)
+    if stack:
+        frame = stack[-1]
+        return '{}:{} in {}'.format(frame.filename, frame.lineno, frame.name)
+    return 'unknown'
+
+
+class Watchdog:
+    def __init__(self, threshold_ms=WATCHDOG_MS, path=WATCHDOG_FILE,
+                 max_bytes=WATCHDOG_MAX_BYTES, backups=WATCHDOG_BACKUPS):
+        self.threshold = threshold_ms / 1000
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sites = Counter()
+        self.loop = None
+        self.loop_thread = None
+        self.last_beat = None
+        # (who, message) being handled, as last noted on the loop; None when
+        # nothing is
+        self.current = None
+        self._reported = False
+        self._stopped = threading.Event()
+        self.logger = None
+        self.handler = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def start(self, loop):
+        """Starts watching loop, which must be run on the calling thread."""
+        if not self.enabled:
+            return
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.logger = logging.getLogger('tmserver.watchdog')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RotatingFileHandler(
+            self.path, maxBytes=self.max_bytes, backupCount=self.backups)
+        self.logger.addHandler(self.handler)
+        self._beat()
+        threading.Thread(target=self._watch, name='tildemush-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    def note(self, who, message):
+        """Records that message from who is what the loop's handling now, or
+        with message None, that who's done and the loop isn't handling
+        anything for them."""
+        if message is not None:
+            self.current = (who, message)
+        elif self.current is not None and self.current[0] == who:
+            self.current = None
+
+    def _beat(self):
+        self.last_beat = time.monotonic()
+        self.loop.call_later(self.threshold / 4, self._beat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 4):
+            stalled = time.monotonic() - self.last_beat
+            if stalled <= self.threshold:
+                self._reported = False
+            elif not self._reported:
+                self._reported = True
+                self.capture(stalled)
+
+    def capture(self, stalled):
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = traceback.extract_stack(frame) if frame is not None else []
+        site = call_site(stack)
+        self.sites[site] += 1
+        who, message = self.current or (None, None)
+        self.logger.warning(json.dumps({
+            'time': time.time(),
+            'stalled_ms': round(stalled * 1000),
+            'site': site,
+            'who': who,
+            'message': message[:200] if message else message,
+            'stack': traceback.format_list(stack),
+        }))
+        self.write_sites()
+
+    def write_sites(self):
+        with open(self.path + '.sites', 'w') as f:
+            for site, count in self.sites.most_common():
+                f.write('{}\t{}\n'.format(count, site))
+
+
+WATCHDOG = Watchdog()
@@ -0,0 +1,159 @@
+"""How protocol messages are encoded on the wire.
+
+The default is the text protocol: `LOGIN vilmibm:password`, `COMMAND go
+north`, `STATE {...json...}` and so on, optionally tagged with a request id
+as in `#12 COMMAND go north` (see GameServer.handle_message).
+
+A client that offers the `tildemush.msgpack` websocket subprotocol when it
+connects gets the binary protocol instead, if the server has msgpack
+installed. Every frame is then a MessagePack map keyed by short strings:
+
+  v: the verb's code, from VERBS
+  i: the request id, if any
+  t: the text of the message after its verb (eg the OK of COMMAND OK, or
+     what a player hears for TEXT)
+  p: the structured payload of STATE and OBJECT frames
+
+and the fields of client requests are:
+
+  LOGIN, REGISTER: username, password
+  COMMAND: action, args
+  BATCH: commands, a list of {action, args} maps
+  REVISION: shortname, code, current_rev
+
+Decoded requests are turned into the messages the text protocol would have
+sent, through a table of verb codes, so both protocols are handled alike; the
+savings are mostly on the way out, where STATE and OBJECT payloads are packed
+as they are rather than being turned into JSON."""
+import json
+import re
+
+from .errors import ClientError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'tildemush.msgpack'
+
+REQUEST_ID_RE = re.compile(r'^#([\w.-]{1,40}) (.*)$', re.DOTALL)
+VERB_RE = re.compile(r'^([A-Z]+):?(?:[ \n](.*))?$', re.DOTALL)
+
+VERBS = {
+    'LOGIN': 1,
+    'REGISTER': 2,
+    'COMMAND': 3,
+    'BATCH': 4,
+    'REFRESH': 5,
+    'REVISION': 6,
+    'MAP': 7,
+    'QUIT': 8,
+    'PING': 9,
+    'PONG': 10,
+    'STATE': 11,
+    'OBJECT': 12,
+    'ERROR': 13,
+    'TEXT': 14,
+    'BUSY': 15,
+}
+
+
+def _command(fields):
+    if fields.get('args'):
+        return 'COMMAND {} {}'.format(fields['action'], fields['args'])
+    return 'COMMAND {}'.format(fields['action'])
+
+
+def _revision(fields):
+    return 'REVISION {}'.format(json.dumps(
+        {k: fields.get(k) for k in ('shortname', 'code', 'current_rev')}))
+
+
+# verb code -> function turning a request's fields into its text message
+REQUESTS = {
+    VERBS['LOGIN']: lambda f: 'LOGIN {}:{}'.format(f['username'], f['password']),
+    VERBS['REGISTER']: lambda f: 'REGISTER {}:{}'.format(f['username'], f['password']),
+    VERBS['COMMAND']: _command,
+    VERBS['BATCH']: lambda f: 'BATCH {}'.format(json.dumps([_command(c) for c in f['commands']])),
+    VERBS['REFRESH']: lambda f: 'REFRESH',
+    VERBS['REVISION']: _revision,
+    VERBS['MAP']: lambda f: 'MAP',
+    VERBS['QUIT']: lambda f: 'QUIT',
+    VERBS['PING']: lambda f: 'PING',
+}
+
+
+class TextWire:
+    binary = False
+
+    def encode(self, message, payload=None, request_id=None, verb=None):
+        """Returns the frame for message. payload, if given, is JSON-able data
+        following message (as in STATE {...}); request_id tags a reply; verb
+        says what kind of message it is when it isn't message's first word
+        (only the binary protocol cares)."""
+        if payload is not None:
+            message = '{} {}'.format(message, json.dumps(payload))
+        if request_id is not None:
+            message = '#{} {}'.format(request_id, message)
+        return message
+
+    def decode(self, frame):
+        """Returns the request id (or None) and text message of a frame from
+        a client."""
+        if not isinstance(frame, str):
+            raise ClientError('expected a text frame')
+        match = REQUEST_ID_RE.fullmatch(frame)
+        if match is None:
+            return None, frame
+        return match.groups()
+
+
+class MsgpackWire:
+    binary = True
+
+    def encode(self, message, payload=None, request_id=None, verb=None):
+        frame = {}
+        if verb is None:
+            match = VERB_RE.fullmatch(message)
+            if match is not None and match.group(1) in VERBS:
+                verb, message = match.group(1), match.group(2)
+            else:
+                verb = 'TEXT'
+        frame['v'] = VERBS[verb]
+        if message is not None:
+            frame['t'] = message
+        if payload is not None:
+            frame['p'] = payload
+        if request_id is not None:
+            frame['i'] = request_id
+        return msgpack.packb(frame, use_bin_type=True)
+
+    def decode(self, frame):
+        if not isinstance(frame, bytes):
+            raise ClientError('expected a binary frame')
+        try:
+            fields = msgpack.unpackb(frame, raw=False)
+            to_message = REQUESTS[fields['v']]
+            request_id = fields.get('i')
+            return (None if request_id is None else str(request_id)), to_message(fields)
+        except ClientError:
+            raise
+        except Exception:
+            raise ClientError('malformed binary frame')
+
+
+TEXT_WIRE = TextWire()
+
+
+def subprotocols():
+    """The websocket subprotocols this server can speak."""
+    if msgpack is None:
+        return []
+    return [MSGPACK_SUBPROTOCOL]
+
+
+def wire_for(subprotocol):
+    if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+        return MsgpackWire()
+    return TEXT_WIRE
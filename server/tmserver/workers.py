@@ -0,0 +1,384 @@
+"""Running WITCH scripts in worker processes.
+
+Normally every object's engine lives in the server process and all scripting
+happens on one core. With TILDEMUSH_WITCH_WORKERS set, engines instead live in
+a pool of worker processes, each object always going to the same worker (its
+id modulo the number of workers). The server keeps a RemoteEngine per object
+that knows which handlers the script defines; calling one sends the call to the
+worker and gets back a list of effects (says, set_data, tell_sender...) that
+the server then applies to the real game object, in order.
+
+Workers never touch the database. Each call carries the object's data so
+get_data answers from it, and set_data is both applied locally and sent back
+as an effect.
+
+Inside a batch (see GameWorld.perform_action), calls are sent without waiting
+for their replies, so handlers in different workers run at the same time.
+Replies are collected and their effects applied in the order the calls were
+made, which keeps the outcome the same as running them one after another.
+
+A worker gets the script's time budget plus REPLY_GRACE seconds to reply. One
+that takes longer is stuck somewhere the budget can't interrupt it (a single
+huge builtin call, say), so it's restarted and the script is treated as having
+blown its budget."""
+from contextlib import contextmanager
+import itertools
+import logging
+from multiprocessing import Pipe, Process
+
+from .config import WITCH_WORKERS
+from .errors import WitchError, WitchBudgetExceeded
+from .scripting import ScriptEngine, WitchInterpreter, cached_compile_witch
+
+_load_ids = itertools.count(1)
+CRASHED = ('error', 'WitchError', 'the script worker crashed', [])
+TIMED_OUT = ('error', WitchBudgetExceeded.__name__, 'ran for more than its time limit', [])
+REPLY_GRACE = 1.0
+
+
+def _reply_timeout(msg):
+    # loads and calls both end with the (steps, seconds) budget
+    return msg[-1][1] + REPLY_GRACE
+
+
+class Ref:
+    """Stands in for another game object inside a worker."""
+    def __init__(self, obj_id):
+        self.id = obj_id
+
+
+class WorkerReceiver:
+    """Stands in for the GameObject a script belongs to inside a worker,
+    recording everything the script does to the world as effects."""
+    def __init__(self, obj_id):
+        self.id = obj_id
+        self.data = {}
+        self.editing_set = []
+        self.effects = []
+
+    def get_by_id(self, obj_id):
+        return Ref(obj_id)
+
+    def _ensure_data(self, data):
+        self.data = data
+        self.effects.append(('ensure_data', data))
+
+    def set_data(self, key, value):
+        self.data[key] = value
+        self.effects.append(('set_data', key, value))
+
+    def get_data(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set_perms(self, **kwargs):
+        self.effects.append(('set_perms', kwargs))
+
+    def say(self, message):
+        self.effects.append(('say', message))
+
+    def emote(self, message):
+        self.effects.append(('emote', message))
+
+    def tell_sender(self, sender_obj, action, args):
+        self.effects.append(('tell_sender', sender_obj.id, action, args))
+
+    def move_sender(self, sender_obj, direction):
+        self.effects.append(('move_sender', sender_obj.id, direction))
+
+    def teleport_sender(self, sender_obj, target_room_name):
+        self.effects.append(('teleport_sender', sender_obj.id, target_room_name))
+
+    def take_effects(self):
+        effects = self.effects
+        self.effects = []
+        return effects
+
+
+def _handler_keys(engine):
+    return list(engine.provides), list(engine.hears), list(engine.sees)
+
+
+def _serve(conn):
+    """A worker's main loop. Replies to every load and call, in order."""
+    # obj id -> (load id, WitchInterpreter)
+    interpreters = {}
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        op = msg[0]
+        if op == 'load':
+            _, obj_id, load_id, code, data, budget = msg
+            receiver = WorkerReceiver(obj_id)
+            receiver.data = data
+            wi = WitchInterpreter(receiver)
+            try:
+                with wi.budget(*budget):
+                    for witch_ast in cached_compile_witch(code):
+                        wi.evaluate_ast(witch_ast)
+            except Exception as e:
+                conn.send(('error', e.__class__.__name__, str(e), receiver.take_effects()))
+                continue
+            interpreters[obj_id] = (load_id, wi)
+            conn.send(('ok', _handler_keys(wi.script_engine), receiver.take_effects()))
+        elif op == 'call':
+            _, obj_id, kind, key, args, data, budget = msg
+            if obj_id not in interpreters:
+                conn.send(('missing',))
+                continue
+            _, wi = interpreters[obj_id]
+            receiver = wi.script_engine.receiver_model
+            if data is not None:
+                receiver.data = data
+            handler = getattr(wi.script_engine, kind)[key]
+            try:
+                with wi.budget(*budget):
+                    handler(*args)
+            except Exception as e:
+                conn.send(('error', e.__class__.__name__, str(e), receiver.take_effects()))
+                continue
+            conn.send(('ok', None, receiver.take_effects()))
+        elif op == 'drop':
+            _, obj_id, load_id = msg
+            if obj_id in interpreters and interpreters[obj_id][0] == load_id:
+                del interpreters[obj_id]
+
+
+class Worker:
+    def __init__(self):
+        self.conn = None
+        self.proc = None
+        # bumped on every (re)start so replies owed by a dead process aren't
+        # waited for on its replacement's pipe.
+        self.generation = 0
+        self.start()
+
+    def start(self):
+        self.generation += 1
+        self.conn, child_conn = Pipe()
+        self.proc = Process(target=_serve, args=(child_conn,), name='witch-worker', daemon=True)
+        self.proc.start()
+        child_conn.close()
+
+    def restart(self):
+        self.conn.close()
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.proc.join()
+        self.start()
+
+    def stop(self):
+        self.conn.close()
+        self.proc.join(timeout=1)
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+
+class PendingCall:
+    def __init__(self, engine, worker, msg):
+        self.engine = engine
+        self.worker = worker
+        self.generation = worker.generation
+        self.msg = msg
+
+
+class WorkerPool:
+    def __init__(self, size=WITCH_WORKERS, logger=None):
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.logger = logger
+        self.workers = [Worker() for _ in range(size)]
+        self._batch = None
+
+    def worker_for(self, obj_id):
+        return self.workers[obj_id % len(self.workers)]
+
+    def _request(self, worker, msg):
+        try:
+            worker.conn.send(msg)
+            return self._receive(worker, _reply_timeout(msg))
+        except (EOFError, OSError) as e:
+            return self._worker_died(worker, e)
+
+    def _receive(self, worker, timeout):
+        if not worker.conn.poll(timeout):
+            self.logger.error('WITCH worker {} took longer than {}s to reply; restarting it'.format(
+                worker.proc.pid, timeout))
+            worker.restart()
+            return TIMED_OUT
+        return worker.conn.recv()
+
+    def _worker_died(self, worker, e):
+        # everything the worker had loaded is gone; RemoteEngines reload
+        # themselves when they find out.
+        self.logger.error('WITCH worker {} died: {}'.format(worker.proc.pid, e))
+        worker.restart()
+        return CRASHED
+
+    def load(self, obj_id, code, data, budget):
+        """Loads code as obj_id's script in its worker. Returns (load id,
+        handler keys, effects); raises WitchError if the script is broken."""
+        load_id = next(_load_ids)
+        reply = self._request(self.worker_for(obj_id), ('load', obj_id, load_id, code, data, budget))
+        if reply[0] == 'error':
+            raise WitchError(reply[2])
+        return load_id, reply[1], reply[2]
+
+    def drop(self, obj_id, load_id):
+        try:
+            self.worker_for(obj_id).conn.send(('drop', obj_id, load_id))
+        except OSError:
+            pass
+
+    def in_batch(self, obj_id):
+        return self._batch is not None and any(p.engine.obj_id == obj_id for p in self._batch)
+
+    def call(self, engine, kind, key, args, data, budget):
+        """Calls a handler of engine's script. data is the object's current
+        data, or None to have the worker keep using what it has."""
+        msg = ('call', engine.obj_id, kind, key, args, data, budget)
+        pending = PendingCall(engine, self.worker_for(engine.obj_id), msg)
+        if self._batch is not None:
+            try:
+                pending.worker.conn.send(msg)
+            except OSError as e:
+                self._worker_died(pending.worker, e)
+            self._batch.append(pending)
+            return
+        self._finish(pending, self._request(pending.worker, msg))
+
+    @contextmanager
+    def batch(self):
+        """Calls made in the with block run concurrently across workers; their
+        effects are applied in call order when it exits. The first error any
+        of them hit is raised after everything before it has been applied."""
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            pending, self._batch = self._batch, None
+            replies = []
+            for p in pending:
+                if p.generation != p.worker.generation:
+                    replies.append(CRASHED)
+                    continue
+                try:
+                    # earlier calls to the same worker have replied by now, so
+                    # this one has had at most its own budget to run
+                    replies.append(self._receive(p.worker, _reply_timeout(p.msg)))
+                except (EOFError, OSError) as e:
+                    replies.append(self._worker_died(p.worker, e))
+            error = None
+            for p, reply in zip(pending, replies):
+                try:
+                    self._finish(p, reply)
+                except Exception as e:
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+
+    def _finish(self, pending, reply):
+        engine = pending.engine
+        if reply[0] == 'missing':
+            engine.reload()
+            reply = self._request(pending.worker, pending.msg)
+        if reply[0] == 'ok':
+            apply_effects(engine.receiver_model, reply[2])
+            return
+        _, error_type, message, effects = reply
+        apply_effects(engine.receiver_model, effects)
+        if error_type == WitchBudgetExceeded.__name__:
+            engine.receiver_model.budget_exceeded(pending.msg[3], message)
+            return
+        raise WitchError(message)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+def apply_effects(obj, effects):
+    for effect in effects:
+        op, *args = effect
+        if op == 'ensure_data':
+            obj._ensure_data(*args)
+        elif op == 'set_data':
+            if len(obj.editing_set) == 0:
+                obj.set_data(*args)
+        elif op == 'set_perms':
+            obj.set_perms(**args[0])
+        elif op == 'say':
+            obj.say(*args)
+        elif op == 'emote':
+            obj.emote(*args)
+        elif op in ('tell_sender', 'move_sender', 'teleport_sender'):
+            sender_id, *rest = args
+            getattr(obj, op)(obj.get_by_id(sender_id), *rest)
+
+
+class RemoteHandler:
+    def __init__(self, engine, kind, key):
+        self.engine = engine
+        self.kind = kind
+        self.key = key
+
+    def __call__(self, *args):
+        self.engine.call(self.kind, self.key, args)
+
+
+class RemoteEngine(ScriptEngine):
+    """A ScriptEngine whose script handlers run in a worker process."""
+    def __init__(self, receiver_model, pool, code, budget):
+        super().__init__(receiver_model)
+        self.pool = pool
+        self.obj_id = receiver_model.id
+        self.code = code
+        self.budget_limits = budget
+        self.load_id = None
+        self.reload()
+
+    def reload(self):
+        self.load_id, keys, effects = self.pool.load(
+            self.obj_id, self.code, dict(self.receiver_model.data), self.budget_limits)
+        provides, hears, sees = keys
+        self.provides = {k: RemoteHandler(self, 'provides', k) for k in provides}
+        self.hears = {k: RemoteHandler(self, 'hears', k) for k in hears}
+        self.sees = {k: RemoteHandler(self, 'sees', k) for k in sees}
+        apply_effects(self.receiver_model, effects)
+
+    def call(self, kind, key, args):
+        data = None
+        if not self.pool.in_batch(self.obj_id):
+            # otherwise the worker's copy already has this batch's earlier
+            # changes, which haven't been applied here yet.
+            data = self.receiver_model.get_by_id(self.obj_id).data
+        self.pool.call(self, kind, key, args, data, self.budget_limits)
+
+    def release(self):
+        self.pool.drop(self.obj_id, self.load_id)
+
+
+_pool = None
+
+def get_pool():
+    """Returns the worker pool, starting it the first time. Returns None
+    unless TILDEMUSH_WITCH_WORKERS is set."""
+    global _pool
+    if _pool is None and WITCH_WORKERS:
+        _pool = WorkerPool()
+    return _pool
+
+
+@contextmanager
+def batch():
+    pool = get_pool()
+    if pool is None:
+        yield
+        return
+    with pool.batch():
+        yield
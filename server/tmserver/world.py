@@ -1,13 +1,26 @@
+import asyncio
+from functools import partial
 import itertools
+import logging
 import re
+import time
 
 from slugify import slugify
 
-from .config import get_db
+from .config import get_db, EVENTS_PER_TICK, HIBERNATE_AFTER, WITCH_SLICE_STEPS
 from .constants import DIRECTIONS, REVERSE_DIRS
 from .errors import RevisionError, WitchError, ClientError, UserError
+from . import workers
+from .events import CascadeRoot, Event, EventQueue
 from .mapping import render_map
 from .models import Contains, GameObject, Script, ScriptRevision, Permission, Editing, LastSeen
+from .profiler import PROFILER
+from .ratelimit import RATE_LIMITER
+from .scripting import AST_CACHE, ENGINES
+from .slowlog import SLOW_LOG
+from . import stats
+from .timeslice import SlicePool
+from .tracing import TRACER
 from .util import strip_color_codes, split_args, ARG_RE
 
 OBJECT_DENIED = 'You grab a hold of {} but no matter how hard you pull it stays rooted in place.'
@@ -21,10 +34,77 @@ REMOVE_ARGS_RE = re.compile(r'^(.+) from (.+)$')
 
 class GameWorld:
     _sessions = {}
+    _events = EventQueue()
+    _current_event = None
+    _loop = None
+    _executor = None
+    _room_locks = None
+    _last_occupied = {}
+    _slices = SlicePool()
+    # place id -> (event, Slice) for actions suspended partway through
+    _suspended = {}
+    # places with a _resume or _drain scheduled
+    _resuming = set()
+    _draining = set()
 
     @classmethod
     def reset(cls):
         cls._sessions = {}
+        cls._events.clear()
+        cls._current_event = None
+        cls._loop = None
+        cls._executor = None
+        cls._suspended = {}
+        cls._room_locks = None
+        cls._resuming = set()
+        cls._draining = set()
+        cls._last_occupied = {}
+        ENGINES.clear()
+
+    @classmethod
+    def set_loop(cls, loop):
+        """Once a loop is set, queued events beyond EVENTS_PER_TICK are
+        processed on later turns of it. Without one (ie, in tests that poke
+        the world directly) queued events are all processed right away."""
+        cls._loop = loop
+
+    @classmethod
+    def set_executor(cls, executor):
+        """With a DBExecutor set, the world's own deferred work runs on its
+        thread, alongside everything GameServer hands it; see dbthread.py."""
+        cls._executor = executor
+
+    @classmethod
+    def set_room_locks(cls, room_locks):
+        """With RoomLocks set, work deferred on a place's events holds that
+        place's lock while it runs, as the commands that queued them did; see
+        actors.py."""
+        cls._room_locks = room_locks
+
+    @classmethod
+    def defer(cls, fn, place=None):
+        """Runs fn later: on the database thread if there is one, otherwise
+        on the loop's next turn. Given the place fn's work happens in, it
+        first waits for that place's room lock, if there are room locks."""
+        if place is not None and cls._room_locks is not None:
+            cls._loop.call_soon_threadsafe(
+                lambda: asyncio.ensure_future(cls._locked(place, fn), loop=cls._loop))
+        elif cls._executor is not None:
+            cls._executor.submit(fn)
+        else:
+            cls._loop.call_soon(fn)
+
+    @classmethod
+    async def _locked(cls, place, fn):
+        async with cls._room_locks.hold([place]):
+            await cls.run_off_loop(fn)
+
+    @classmethod
+    async def run_off_loop(cls, fn, *args):
+        """Runs fn(*args) wherever world work runs and returns the result."""
+        if cls._executor is None:
+            return fn(*args)
+        return await cls._executor.run(fn, *args)
 
     @classmethod
     def register_session(cls, user_account, user_session):
@@ -67,6 +147,16 @@ class GameWorld:
 
             LastSeen.create(user_account=user_account, room=room)
 
+    @classmethod
+    def attach_session(cls, user_account_id, session):
+        """Records a session for a user without touching the world; used for
+        users connected to other nodes of a cluster."""
+        cls._sessions[user_account_id] = session
+
+    @classmethod
+    def detach_session(cls, user_account_id):
+        cls._sessions.pop(user_account_id, None)
+
     @classmethod
     def get_session(cls, user_account_id):
         session = cls._sessions.get(user_account_id)
@@ -137,6 +227,256 @@ class GameWorld:
 
     @classmethod
     def dispatch_action(cls, sender_obj, action, action_args):
+        """Runs an action in the world. Called from outside of the world (ie,
+        a user's command) it's run right away as the root of a new cascade.
+        Called while another action is running (ie, a WITCH script saying
+        something) it's queued as a child of that action instead.
+
+        If an action in the same place is suspended partway through a slow
+        handler, a new command is queued behind it so objects there still see
+        actions in the order they happened. A command that's queued, or is
+        itself suspended, hasn't run when this returns; it returns the
+        command's CascadeRoot, which finished() can wait on."""
+        if cls._current_event is not None:
+            parent = cls._current_event
+            event = Event(sender_obj, action, action_args, parent.depth + 1, parent.root,
+                          TRACER.current())
+            if cls._suspended:
+                cls.place_of_event(event)
+            cls._events.push(event)
+            return None
+
+        event = Event(sender_obj, action, action_args, 0, CascadeRoot(sender_obj, action),
+                      TRACER.current())
+        if cls._suspended and cls.place_of_event(event) in cls._suspended:
+            cls._events.push(event)
+            return event.root
+
+        event.root.running += 1
+        with SLOW_LOG.watch(sender_obj, action, action_args):
+            try:
+                cls._start_event(event)
+            except Exception:
+                cls._event_done(event.root)
+                raise
+            finally:
+                cls.process_events(root=event.root)
+        return event.root
+
+    @classmethod
+    async def finished(cls, root):
+        """Waits for the command at root (as returned by dispatch_action) to
+        have run, and raises the UserError it failed with, if any. Call it
+        from the loop."""
+        if root is None:
+            return
+        if not root.finished:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+
+            def done(error):
+                loop.call_soon_threadsafe(
+                    lambda: future.done() or future.set_result(error))
+            root.when_finished(done)
+            await future
+        if root.error is not None:
+            raise root.error
+
+    @classmethod
+    def rooms_for(cls, sender_obj, action, action_args):
+        """Returns (ids of the rooms a command touches, whether it touches the
+        whole world) for the room locking protocol described in actors.py.
+        This is a best effort: a command that turns out to be invalid may name
+        rooms it never ends up touching, which only costs it a wait."""
+        if action == 'announce':
+            return (), True
+
+        room = sender_obj.room
+        rooms = {sender_obj.id if room is None else room.id}
+        target_name = None
+        if action == 'go' and room is not None:
+            exit_obj = cls.resolve_exit(room, cls.process_direction(action_args))
+            if exit_obj is not None:
+                route = exit_obj.get_data('exit', {}).get(room.shortname)
+                if route is not None:
+                    target_name = route[1]
+        elif action == 'home':
+            target_name = '{}/sanctum'.format(sender_obj.user_account.username)
+        elif action == 'foyer':
+            target_name = 'god/foyer'
+
+        if target_name is not None:
+            target = GameObject.get_or_none(GameObject.shortname==target_name)
+            if target is not None:
+                rooms.add(target.id)
+
+        return rooms, False
+
+    @classmethod
+    def place_of(cls, obj):
+        """The id of whatever an action by obj affects: the room it's in, or
+        itself if it's not in anything."""
+        room = obj.room
+        return obj.id if room is None else room.id
+
+    @classmethod
+    def place_of_event(cls, event):
+        """place_of the event's sender, looked up the first time it's
+        needed (as it's queued, if anything is suspended then) and remembered
+        after that."""
+        if event.place is None:
+            event.place = cls.place_of(event.sender_obj)
+        return event.place
+
+    @classmethod
+    def process_events(cls, place=None, root=None):
+        """Runs queued events; only those in place, or in root's cascade, if
+        given. Events in a place with a suspended action wait for it to
+        finish. If there's a loop, stops after EVENTS_PER_TICK and leaves the
+        rest to be picked back up on later turns of it."""
+        def runnable(e):
+            if root is not None and e.root is not root:
+                return False
+            if place is None and not cls._suspended:
+                return True
+            e_place = cls.place_of_event(e)
+            return (place is None or e_place == place) and e_place not in cls._suspended
+
+        processed = 0
+        while cls._events:
+            if cls._loop is not None and processed >= EVENTS_PER_TICK:
+                break
+            event = cls._events.pop_first(runnable)
+            if event is None:
+                break
+            try:
+                cls._start_event(event)
+            except Exception as e:
+                cls._finish(event, e)
+            processed += 1
+        if cls._loop is not None and cls._events:
+            cls._schedule_drains()
+
+    @classmethod
+    def _schedule_drains(cls):
+        """Schedules processing of the queued events that can run, one place
+        at a time under its room lock if there are room locks, otherwise all
+        together. Those in places with a suspended action are left to it."""
+        places = {cls.place_of_event(e) for e in cls._events} - set(cls._suspended)
+        if places and cls._room_locks is None:
+            places = {None}
+        for place in places - cls._draining:
+            cls._draining.add(place)
+            cls.defer(partial(cls._drain, place), place)
+
+    @classmethod
+    def _drain(cls, place):
+        cls._draining.discard(place)
+        cls.process_events(place=place)
+
+    @classmethod
+    def _finish(cls, event, error=None):
+        """Records that event has run, now that it's no longer running where
+        it was dispatched. A command's own UserError goes back to whoever's
+        waiting on it (see finished); anything else that went wrong is
+        reported."""
+        cls._event_done(event.root)
+        if event.depth == 0:
+            if isinstance(error, UserError):
+                event.root.finish(error)
+                return
+            event.root.finish()
+        if error is not None:
+            cls._report_failure(event, error)
+
+    @classmethod
+    def _event_done(cls, root):
+        """Counts one of root's events as finished; once none are left
+        running, sends the STATE updates they held back."""
+        root.running -= 1
+        if root.running == 0:
+            updates, root.updates = root.updates, []
+            for user_account in updates:
+                cls.send_client_update(user_account)
+
+    @classmethod
+    def _report_failure(cls, event, e):
+        if isinstance(e, UserError):
+            # there's no command to fail anymore, so tell whoever started
+            # this cascade what went wrong.
+            root_sender = event.root.sender_obj
+            if root_sender.is_player_obj:
+                cls.user_hears(root_sender, root_sender, '{{red}}{}{{/}}'.format(e))
+        else:
+            logging.getLogger('tmserver').error('failed to run {}: {}'.format(event, e))
+
+    @classmethod
+    def _start_event(cls, event):
+        """Runs event. With a loop to come back on, it's run in a slice so a
+        slow handler can be suspended; errors from an event that finishes
+        without being suspended are raised as if it ran directly."""
+        sliced = None
+        if cls._loop is not None and WITCH_SLICE_STEPS:
+            sliced = cls._slices.slice(lambda: cls._run_event(event))
+        if sliced is None:
+            cls._run_event(event)
+            cls._finish(event)
+            return
+
+        if cls._step_slice(event, sliced):
+            if sliced.error is not None:
+                raise sliced.error
+            cls._finish(event)
+            return
+
+        place = cls.place_of_event(event)
+        cls._suspended[place] = (event, sliced)
+        cls._schedule_resume(place)
+
+    @classmethod
+    def _schedule_resume(cls, place):
+        if place not in cls._resuming:
+            cls._resuming.add(place)
+            cls.defer(partial(cls._resume, place), place)
+
+    @classmethod
+    def _step_slice(cls, event, sliced):
+        previous = cls._current_event
+        cls._current_event = event
+        try:
+            return sliced.run()
+        finally:
+            cls._current_event = previous
+
+    @classmethod
+    def _resume(cls, place):
+        """Gives the action suspended in place another slice and, once it's
+        finished, runs whatever was waiting on it."""
+        cls._resuming.discard(place)
+        if place not in cls._suspended:
+            return
+        event, sliced = cls._suspended[place]
+        if not cls._step_slice(event, sliced):
+            cls._schedule_resume(place)
+            return
+        del cls._suspended[place]
+        cls._finish(event, sliced.error)
+        cls.process_events(place=place)
+
+    @classmethod
+    def _run_event(cls, event):
+        previous = cls._current_event
+        cls._current_event = event
+        try:
+            with stats.measure_action(event.action), \
+                 TRACER.span('action', event.action, parent=event.cause,
+                             sender=event.sender_obj.shortname, args=event.action_args):
+                cls.perform_action(event.sender_obj, event.action, event.action_args)
+        finally:
+            cls._current_event = previous
+
+    @classmethod
+    def perform_action(cls, sender_obj, action, action_args):
         # The following are commands that have special meaning to the game. Some of them also get
         # passed to objects in a player's scope; some don't. This is pretty ugly right now but it's
         # not worth investing in refactoring until post-beta, I don't think.
@@ -144,6 +484,15 @@ class GameWorld:
         # admin
         if action == 'announce':
             cls.handle_announce(sender_obj, action_args)
+        elif action == 'throttles':
+            cls.handle_throttles(sender_obj, action_args)
+            return
+        elif action == 'stats':
+            cls.handle_stats(sender_obj, action_args)
+            return
+        elif action == 'profile':
+            cls.handle_profile(sender_obj, action_args)
+            return
 
         # chatting
         elif action == 'whisper':
@@ -185,18 +534,24 @@ class GameWorld:
         # if we make it here it means we've encountered a command to which
         # objects in the area should have a chance to respond.
         aoe = cls.area_of_effect(sender_obj)
-        for o in aoe:
-            is_transitive, _ = o.handle_action(cls, sender_obj, action, action_args)
-            if is_transitive:
-                # If a user just wanted to interact with a single object, don't
-                # continue allowing other objects to respond to the action.
-                break
+        # with script workers, handlers in different workers run concurrently
+        with workers.batch():
+            for o in aoe:
+                is_transitive, _ = o.handle_action(cls, sender_obj, action, action_args)
+                if is_transitive:
+                    # If a user just wanted to interact with a single object, don't
+                    # continue allowing other objects to respond to the action.
+                    break
 
         # this is going to often be redundant and in the future we should be
         # smarter, but too many cases weren't triggering a client update.
+        # held until the rest of the cascade has run; see CascadeRoot
         for o in aoe:
             if o.is_player_obj:
-                cls.send_client_update(o.user_account)
+                if cls._current_event is None:
+                    cls.send_client_update(o.user_account)
+                else:
+                    cls._current_event.root.updates.append(o.user_account)
 
     @classmethod
     def resolve_obj(cls, scope, search_str, ignore=lambda o: False):
@@ -242,6 +597,42 @@ class GameWorld:
                                               .distinct(GameObject.id))
         return all_containing_objects.union(all_contained_objects)
 
+    @classmethod
+    def hibernate_idle_rooms(cls, idle_for=HIBERNATE_AFTER, now=None):
+        """Drops the cached engines of objects whose surroundings no player
+        has been in for idle_for seconds. An object's surroundings are
+        whatever directly contains it, or itself if nothing does. Rooms never
+        seen occupied count from the first time this runs, and are forgotten
+        once none of their objects have engines. Returns how many engines
+        were dropped."""
+        if now is None:
+            now = time.monotonic()
+        cached_ids = ENGINES.ids()
+        if not cached_ids:
+            return 0
+
+        players = GameObject.select(GameObject.id).where(GameObject.is_player_obj==True)
+        occupied = {c.outer_obj_id for c in Contains.select().where(Contains.inner_obj.in_(players))}
+        occupied.update(p.id for p in players)
+        for place_id in occupied:
+            cls._last_occupied[place_id] = now
+
+        places = {obj_id: obj_id for obj_id in cached_ids}
+        for c in Contains.select().where(Contains.inner_obj.in_(cached_ids)):
+            places[c.inner_obj_id] = c.outer_obj_id
+
+        idle = []
+        for obj_id, place_id in places.items():
+            last = cls._last_occupied.setdefault(place_id, now)
+            if now - last >= idle_for:
+                idle.append(obj_id)
+
+        ENGINES.hibernate(idle)
+        awake = {place_id for obj_id, place_id in places.items() if obj_id in ENGINES}
+        cls._last_occupied = {place_id: last for place_id, last in cls._last_occupied.items()
+                              if place_id in awake}
+        return len(idle)
+
     @classmethod
     def handle_get(cls, sender_obj, action_args):
         """This action looks for an object:
@@ -651,6 +1042,59 @@ class GameWorld:
         for o in aoe:
             o.handle_action(cls, sender_obj, 'announce', action_args)
 
+    @classmethod
+    def handle_throttles(cls, sender_obj, action_args):
+        """Tells a god who has been rate limited for what (or, given a
+        username, just them)."""
+        if not sender_obj.user_account.is_god:
+            raise UserError('you are not powerful enough to do that.')
+        lines = RATE_LIMITER.summary(action_args.strip() or None)
+        if not lines:
+            lines = ['nobody has been throttled']
+        cls.user_hears(sender_obj, sender_obj, '\n'.join(lines))
+
+    @classmethod
+    def handle_stats(cls, sender_obj, action_args):
+        """Tells a god how each protocol verb and game action has been doing
+        (or, given verb or action, just those)."""
+        if not sender_obj.user_account.is_god:
+            raise UserError('you are not powerful enough to do that.')
+        kind = action_args.strip() or None
+        if kind not in (None, 'verb', 'action'):
+            raise UserError('try /stats, /stats verb or /stats action')
+        lines = stats.summary(kind)
+        if not lines:
+            lines = ['nothing has been measured yet']
+        cls.user_hears(sender_obj, sender_obj, '\n'.join(lines))
+
+    @classmethod
+    def handle_profile(cls, sender_obj, action_args):
+        """Profiles the server for a number of seconds (10 by default) and
+        tells the god who asked where the flame graph went; see profiler.py."""
+        if not sender_obj.user_account.is_god:
+            raise UserError('you are not powerful enough to do that.')
+        try:
+            seconds = float(action_args.strip() or 10)
+        except ValueError:
+            raise UserError('try /profile or /profile 30')
+
+        def done(path, profile, error=None):
+            # called from the profiler's thread
+            def report():
+                if error is not None:
+                    cls.user_hears(sender_obj, sender_obj, 'profiling failed: {}'.format(error))
+                else:
+                    cls.user_hears(sender_obj, sender_obj, profile.summary(path))
+            if cls._loop is None:
+                report()
+            else:
+                cls._loop.call_soon_threadsafe(cls.defer, report)
+
+        seconds = PROFILER.start(seconds, done)
+        if seconds is None:
+            raise UserError('a profile is already running')
+        cls.user_hears(sender_obj, sender_obj, 'profiling for {:g}s'.format(seconds))
+
     @classmethod
     def handle_whisper(cls, sender_obj, action_args):
         action_args = action_args.split(' ')
@@ -829,7 +1273,11 @@ class GameWorld:
             'code': code}
 
     @classmethod
-    def handle_revision(cls, owner_obj, shortname, code, current_rev):
+    def handle_revision(cls, owner_obj, shortname, code, current_rev, trial=None):
+        """Saves a new revision of shortname's code. If trial (a
+        sandbox.TrialResult) is passed, the code has already been compiled and
+        evaluated out of process: its errors are reported as-is and the live
+        engine is only rebuilt if it succeeded."""
         result = None
         with get_db().atomic():
             # TODO #87 should be caught and logged to witch error console
@@ -872,11 +1320,22 @@ class GameWorld:
 
             witch_errors = []
 
-            try:
-                obj.init_scripting(use_db_data=False)
-            except WitchError as e:
-                # i don't actually have a good reason for errors being a list yet
-                witch_errors.append(str(e))
+            if trial is not None and not trial.ok:
+                witch_errors.extend(trial.errors)
+            else:
+                if trial is not None:
+                    # this saves compiling the revision again, but its top
+                    # level still has to be evaluated here: the engine it
+                    # builds closes over this object and can't be sent back
+                    # from the trial's process. The trial has shown it finishes
+                    # within REVISION_TIMEOUT, and it runs under the author's
+                    # WITCH budget (see _execute_script) all the same.
+                    AST_CACHE.put(rev.code, trial.asts)
+                try:
+                    obj.init_scripting(use_db_data=False)
+                except WitchError as e:
+                    # i don't actually have a good reason for errors being a list yet
+                    witch_errors.append(str(e))
 
             result = cls.object_state(obj)
             result['errors'] = witch_errors